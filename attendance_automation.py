@@ -22,6 +22,7 @@ from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
 from collections import defaultdict
 import glob
+from sqlite_profiles import connect as connect_db, restore_durable
 
 
 def _synthetic_log_datetime_to_iso(log_date_str, log_time_str):
@@ -57,7 +58,7 @@ def _write_synthetic_logs_to_db(log_history_dir, synthetic_rows):
         safe_user = "".join(c if c.isalnum() or c in "._-" else "_" for c in str(user_id))
         db_filename = f"{session_id}_{safe_user}.db"
         db_path = os.path.join(log_history_dir, db_filename)
-        conn = sqlite3.connect(db_path)
+        conn = connect_db(db_path)
         try:
             cur = conn.cursor()
             cur.execute("""
@@ -112,6 +113,7 @@ def _write_synthetic_logs_to_db(log_history_dir, synthetic_rows):
             created_paths.append(db_path)
         finally:
             conn.close()
+    restore_durable(created_paths)
     return created_paths
 
 
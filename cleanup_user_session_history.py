@@ -1,12 +1,20 @@
 import argparse
 import os
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
 from typing import Optional
 
+from compact_history import LAYOUT_TABLES, ROWS_TABLE, encoded_columns, is_compact
+from sharded_history import SHARD_TABLE, USERS_TABLE, is_shard, list_shards, prune_users
+from sqlite_profiles import connect_read_only
+from file_validation import load_validation_cache, save_validation_cache, validate_file, is_valid
+
 
 SQLITE_HEADER = b"SQLite format 3\x00"
 
+RECLAIM_MODES = ("vacuum", "incremental")
+
 
 def has_sqlite_header(filepath: str) -> bool:
     if not os.path.exists(filepath) or os.path.getsize(filepath) < 16:
@@ -62,64 +70,117 @@ def get_table_names(conn: sqlite3.Connection) -> list[str]:
     return [r[0] for r in cur.fetchall()]
 
 
-def table_row_count(conn: sqlite3.Connection, table: str) -> int:
+def table_has_rows(conn: sqlite3.Connection, table: str) -> bool:
     cur = conn.cursor()
-    cur.execute(f"SELECT COUNT(*) FROM {table}")
-    return int(cur.fetchone()[0])
+    cur.execute(f"SELECT EXISTS (SELECT 1 FROM {table})")
+    return bool(cur.fetchone()[0])
 
 
-def delete_old_attendance_rows(conn: sqlite3.Connection, cutoff_str: str) -> int:
+def scan_date_expr(cols: list[str]) -> Optional[str]:
     """
-    Delete attendance rows older than cutoff_str (YYYY-MM-DD).
+    Expression giving a row's scan date (YYYY-MM-DD).
     Prefers scanTime (ISO), then dateTime (ISO), then log_date (YYYY-MM-DD).
     """
+    if "scanTime" in cols:
+        return "substr(scanTime, 1, 10)"
+    if "dateTime" in cols:
+        return "substr(dateTime, 1, 10)"
+    if "log_date" in cols:
+        return "log_date"
+    return None
+
+
+def attendance_table(conn: sqlite3.Connection) -> tuple[Optional[str], Optional[str]]:
+    """
+    Return (table, scan date expression) of the table holding a DB's attendance rows,
+    or (None, None) if it has none. In the compact layout (see compact_history.py)
+    that is its rows table, using only the columns it stores as plain text; in a
+    shard of the sharded store (see sharded_history.py), its user_attendance table.
+    """
     cur = conn.cursor()
 
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='attendance'")
+    if is_shard(conn):
+        table = SHARD_TABLE
+        encoded = ()
+    elif is_compact(conn):
+        table = ROWS_TABLE
+        encoded = encoded_columns(conn)
+    else:
+        table = "attendance"
+        encoded = ()
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
     if not cur.fetchone():
-        return 0
+        return None, None
 
-    cur.execute("PRAGMA table_info(attendance)")
-    cols = [r[1] for r in cur.fetchall()]
+    cur.execute(f"PRAGMA table_info({table})")
+    expr = scan_date_expr([r[1] for r in cur.fetchall() if r[1] not in encoded])
+    if expr is None:
+        return None, None
+    return table, expr
 
-    if "scanTime" in cols:
-        where_expr = "substr(scanTime, 1, 10) < ?"
-    elif "dateTime" in cols:
-        where_expr = "substr(dateTime, 1, 10) < ?"
-    elif "log_date" in cols:
-        where_expr = "log_date < ?"
-    else:
+
+def delete_old_attendance_rows(conn: sqlite3.Connection, cutoff_str: str) -> int:
+    """
+    Delete attendance rows older than cutoff_str (YYYY-MM-DD).
+    A DB with nothing older than the cutoff is recognised by one read-only
+    MIN() query (a table scan; no index is created, since that would rewrite
+    every DB) and is not written to.
+    """
+    cur = conn.cursor()
+    table, expr = attendance_table(conn)
+    if table is None:
         return 0
 
-    cur.execute(f"SELECT COUNT(*) FROM attendance WHERE {where_expr}", (cutoff_str,))
-    to_delete = int(cur.fetchone()[0])
-    if to_delete <= 0:
+    cur.execute(f"SELECT MIN({expr}) FROM {table}")
+    oldest = cur.fetchone()[0]
+    if oldest is None or oldest >= cutoff_str:
         return 0
 
-    cur.execute(f"DELETE FROM attendance WHERE {where_expr}", (cutoff_str,))
-    return to_delete
+    cur.execute(f"DELETE FROM {table} WHERE {expr} < ?", (cutoff_str,))
+    return cur.rowcount
+
+
+def reclaim_space(conn: sqlite3.Connection, mode: str) -> None:
+    """
+    Return the pages freed by deleted rows to the filesystem.
+    'vacuum' rebuilds the file; 'incremental' switches the DB to auto_vacuum=INCREMENTAL
+    once (which needs a VACUUM) and afterwards only releases its free pages.
+    """
+    if mode == "incremental":
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            conn.execute("PRAGMA incremental_vacuum").fetchall()
+            return
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
 
 
 def is_db_empty(conn: sqlite3.Connection) -> bool:
     """
-    Consider DB empty if it has no rows across all non-internal tables.
+    Consider DB empty if it has no rows across all non-internal tables
+    (the compact layout's dictionary and layout tables don't count).
     """
-    tables = [t for t in get_table_names(conn) if t not in ("sqlite_sequence",)]
+    tables = [t for t in get_table_names(conn) if t not in ("sqlite_sequence",) + LAYOUT_TABLES]
     if not tables:
         return True
-    total = 0
     for t in tables:
         try:
-            total += table_row_count(conn, t)
+            if table_has_rows(conn, t):
+                return False
         except sqlite3.Error:
-            # If a table can't be counted, assume DB isn't safely "empty"
+            # If a table can't be read, assume DB isn't safely "empty"
             return False
-    return total == 0
+    return True
 
 
-def process_db(db_path: str, cutoff_str: str, delete_empty_dbs: bool) -> tuple[int, bool]:
+def process_db(
+    db_path: str,
+    cutoff_str: str,
+    delete_empty_dbs: bool,
+    reclaim: Optional[str] = None,
+) -> tuple[int, bool]:
     """
     Returns (rows_deleted, db_removed)
+    With reclaim ('vacuum' or 'incremental'), DBs that lost rows are also shrunk.
     """
     if not has_sqlite_header(db_path):
         print(f"  [SKIP] Non-SQLite file: {os.path.basename(db_path)}")
@@ -129,7 +190,11 @@ def process_db(db_path: str, cutoff_str: str, delete_empty_dbs: bool) -> tuple[i
     try:
         deleted = delete_old_attendance_rows(conn, cutoff_str)
         if deleted > 0:
+            if is_shard(conn):
+                prune_users(conn)
             conn.commit()
+            if reclaim:
+                reclaim_space(conn, reclaim)
 
         removed = False
         if delete_empty_dbs and is_db_empty(conn):
@@ -144,20 +209,126 @@ def process_db(db_path: str, cutoff_str: str, delete_empty_dbs: bool) -> tuple[i
             pass
 
 
+def plan_db(
+    db_path: str,
+    cutoff_str: str,
+    delete_empty_dbs: bool,
+    reclaim: Optional[str] = None,
+) -> dict:
+    """
+    --plan for one DB (opened read-only): its rows, how many are older than the
+    cutoff, whether it would be removed as empty, and its size before and
+    (estimated) after. Without reclaim, freed pages stay in the file.
+    """
+    size = os.path.getsize(db_path)
+    plan = {"rows": 0, "old_rows": 0, "removed": False, "size": size, "size_after": size}
+    conn = connect_read_only(db_path)
+    try:
+        table, expr = attendance_table(conn)
+        if table is not None:
+            plan["rows"] = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            plan["old_rows"] = conn.execute(
+                f"SELECT COUNT(*) FROM {table} WHERE {expr} < ?", (cutoff_str,)
+            ).fetchone()[0]
+
+        # Left empty: no rows remain and no other table holds data (a shard drops its
+        # users with its last rows)
+        ignored = ("sqlite_sequence", table) + LAYOUT_TABLES + ((USERS_TABLE,) if table == SHARD_TABLE else ())
+        others_empty = all(
+            not table_has_rows(conn, t) for t in get_table_names(conn) if t not in ignored
+        )
+    finally:
+        conn.close()
+
+    if delete_empty_dbs and plan["rows"] == plan["old_rows"] and others_empty:
+        plan["removed"] = True
+        plan["size_after"] = 0
+    elif reclaim and plan["old_rows"]:
+        plan["size_after"] = round(size * (1 - plan["old_rows"] / plan["rows"]))
+    return plan
+
+
+def _process_db_job(job: tuple) -> tuple[int, bool]:
+    """ProcessPoolExecutor entry point for process_db"""
+    return process_db(*job)
+
+
+def print_plan(valid_files: list[str], jobs: list[tuple]) -> None:
+    """Print what a cleanup run would do, per DB and in total (nothing is written)."""
+    total_old = 0
+    total_rows = 0
+    removed = 0
+    touched = 0
+    size = 0
+    size_after = 0
+    for db_path, job in zip(valid_files, jobs):
+        name = os.path.basename(db_path)
+        try:
+            plan = plan_db(*job)
+        except sqlite3.Error as e:
+            print(f"  [SKIP] {name}: {e}")
+            continue
+        total_rows += plan["rows"]
+        total_old += plan["old_rows"]
+        size += plan["size"]
+        size_after += plan["size_after"]
+        if plan["removed"]:
+            removed += 1
+            print(f"  [PLAN] {name}: would be removed ({plan['old_rows']} old row(s), empty after cleanup)")
+        elif plan["old_rows"]:
+            touched += 1
+            print(f"  [PLAN] {name}: would delete {plan['old_rows']} of {plan['rows']} row(s)")
+
+    print(f"Plan: delete {total_old} of {total_rows} row(s) in {touched} DB(s), remove {removed} empty DB(s).")
+    print(f"Plan: {size / (1024 * 1024):.1f} MB -> ~{size_after / (1024 * 1024):.1f} MB.")
+    if not total_old and not removed:
+        print("Plan: nothing to do, the cleanup would be a no-op.")
+
+
 def main() -> int:
     parser = argparse.ArgumentParser(
         description="Cleanup user_session_history DBs: delete rows older than N years and remove empty DBs."
     )
     parser.add_argument("--dir", default=None, help="Path to user_session_history directory (optional).")
+    parser.add_argument(
+        "--shards",
+        metavar="DIR",
+        default=None,
+        help="Clean the sharded user history store in DIR instead (see sharded_history.py).",
+    )
     parser.add_argument("--years", type=int, default=4, help="Delete entries older than this many years (default: 4).")
     parser.add_argument(
         "--keep-empty",
         action="store_true",
         help="Do not delete empty DB files after cleanup (default deletes empties).",
     )
+    parser.add_argument(
+        "--quick-check",
+        action="store_true",
+        help="Also run PRAGMA quick_check on new or changed DBs before cleaning them.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes; DBs are cleaned in parallel (default: 1).",
+    )
+    parser.add_argument(
+        "--reclaim",
+        choices=RECLAIM_MODES,
+        default=None,
+        help="Shrink DBs that lost rows: full VACUUM, or incremental_vacuum (default: no shrinking).",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Only report what would be deleted and removed, and the expected size; write nothing.",
+    )
     args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
 
-    user_dir = resolve_user_session_history_dir(args.dir)
+    user_dir = args.shards or resolve_user_session_history_dir(args.dir)
     if not user_dir:
         print("user_session_history directory not found. Nothing to do.")
         return 0
@@ -165,22 +336,45 @@ def main() -> int:
     cutoff = subtract_years(date.today(), int(args.years))
     cutoff_str = cutoff.strftime("%Y-%m-%d")
 
-    db_files = sorted(list_db_files(user_dir))
+    db_files = list_shards(user_dir) if args.shards else sorted(list_db_files(user_dir))
     print(f"Scanning {len(db_files)} DBs in: {user_dir}")
     print(f"Deleting attendance entries older than: {cutoff_str} ({args.years} years)")
 
+    # Files known to be invalid are skipped without opening them
+    validation_cache = load_validation_cache()
+    valid_files = []
+    for db_path in db_files:
+        entry = validate_file(validation_cache, db_path, args.quick_check)
+        if is_valid(entry):
+            valid_files.append(db_path)
+        else:
+            print(f"  [SKIP] Invalid DB ({entry['status']}): {os.path.basename(db_path)}")
+
+    jobs = [(db_path, cutoff_str, not args.keep_empty, args.reclaim) for db_path in valid_files]
+    if args.plan:
+        print_plan(valid_files, jobs)
+        return 0
+
+    if args.workers > 1:
+        print(f"Cleaning on {args.workers} worker processes...")
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(_process_db_job, jobs))
+    else:
+        results = [process_db(*job) for job in jobs]
+
     total_deleted = 0
     total_removed = 0
-    for db_path in db_files:
+    for db_path, (deleted, removed) in zip(valid_files, results):
         name = os.path.basename(db_path)
-        deleted, removed = process_db(db_path, cutoff_str, delete_empty_dbs=(not args.keep_empty))
+        total_deleted += deleted
         if removed:
             total_removed += 1
-            print(f"  [OK] {name}: removed (empty after cleanup)")
+            print(f"  [OK] {name}: removed ({deleted} old row(s), empty after cleanup)")
         else:
-            total_deleted += deleted
             print(f"  [OK] {name}: deleted {deleted} old row(s)")
 
+    save_validation_cache(validation_cache)
+    print(f"Validated {validation_cache['probed']} new or changed DB(s).")
     print(f"Done. Deleted {total_deleted} row(s). Removed {total_removed} empty DB(s).")
     return 0
 
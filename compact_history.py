@@ -0,0 +1,307 @@
+"""
+Compact User History Layout
+
+Packs a user session history DB (user_session_history/<user_id>.db) into a
+dictionary-encoded layout. Most attendance columns repeat the same long text on
+every row (session, subject, user, division, department, session timestamps), so:
+
+- attendance_values  dictionary: one row per distinct text value (id, value)
+- attendance_rows    the attendance rows, with those columns stored as value ids
+- attendance_layout  the original CREATE TABLE and the encoded column names
+- attendance         a view with the original columns (same names, same order),
+                     decoding the value ids, plus INSTEAD OF triggers, so readers
+                     and writers that use `attendance` keep working unchanged
+
+The ids, indexes and AUTOINCREMENT sequence of the attendance table are kept.
+scanTime and log_time are nearly unique per row and stay as plain text (the
+cleanup compares scanTime dates directly).
+
+Usage:
+    python compact_history.py                 # pack every DB in user_session_history/
+    python compact_history.py --unpack        # back to the plain attendance table
+    python compact_history.py path/to/1.db ...
+"""
+
+import argparse
+import os
+import shutil
+import sqlite3
+
+VALUES_TABLE = 'attendance_values'
+ROWS_TABLE = 'attendance_rows'
+LAYOUT_TABLE = 'attendance_layout'
+
+# Tables that belong to the layout itself (not user data)
+LAYOUT_TABLES = (VALUES_TABLE, LAYOUT_TABLE)
+
+# Columns stored as value ids when present with TEXT affinity
+ENCODED_COLUMNS = (
+    'sessionId', 'subject', 'dateTime', 'batch', 'syncedAt', 'log_date',
+    'created_at', 'updated_at', 'notes', 'user_name', 'user_id', 'division', 'department',
+)
+
+# Only packed when this column is present (the cleanup's scan date)
+REQUIRED_COLUMN = 'scanTime'
+
+
+def is_compact(conn, schema='main'):
+    """True if the DB holds attendance in the compact layout"""
+    return conn.execute(
+        f"SELECT 1 FROM {schema}.sqlite_master WHERE type='table' AND name=?", (LAYOUT_TABLE,)
+    ).fetchone() is not None
+
+
+def encoded_columns(conn, schema='main'):
+    """Names of the attendance columns a compact DB stores as value ids"""
+    row = conn.execute(
+        f"SELECT value FROM {schema}.{LAYOUT_TABLE} WHERE key = 'encoded_columns'"
+    ).fetchone()
+    return tuple(row[0].split(',')) if row and row[0] else ()
+
+
+def _has_text_affinity(declared_type):
+    declared_type = (declared_type or '').upper()
+    return 'INT' not in declared_type and any(t in declared_type for t in ('CHAR', 'CLOB', 'TEXT'))
+
+
+def _encode(value_sql):
+    """SQL giving the value id of value_sql (NULL stays NULL)"""
+    return f"(SELECT id FROM {VALUES_TABLE} WHERE value = CAST({value_sql} AS TEXT))"
+
+
+def _add_values_sql(value_sqls, source):
+    """INSERT adding the not yet known, non-NULL values of value_sqls (read FROM source)"""
+    union = ' UNION '.join(f"SELECT CAST({v} AS TEXT) AS v FROM {source}" for v in value_sqls)
+    return (
+        f"INSERT INTO {VALUES_TABLE} (value) SELECT v FROM ({union}) "
+        f"WHERE v IS NOT NULL AND v NOT IN (SELECT value FROM {VALUES_TABLE}) ORDER BY v"
+    )
+
+
+def _rows_table_sql(table_info, encoded, autoincrement):
+    """CREATE TABLE for attendance_rows: attendance's columns, encoded ones as INTEGER"""
+    definitions = []
+    for _, name, declared_type, notnull, default, pk in table_info:
+        if pk:
+            definitions.append(f"{name} INTEGER PRIMARY KEY{' AUTOINCREMENT' if autoincrement else ''} NOT NULL")
+            continue
+        definition = f"{name} {'INTEGER' if name in encoded else declared_type}".rstrip()
+        if notnull:
+            definition += ' NOT NULL'
+        if default is not None and name not in encoded:
+            definition += f' DEFAULT {default}'
+        definitions.append(definition)
+    return f"CREATE TABLE {ROWS_TABLE} ({', '.join(definitions)})"
+
+
+def _view_select(columns, encoded):
+    """SELECT for the attendance view: one LEFT JOIN per encoded column decodes its value ids"""
+    aliases = {c: f"v{i}" for i, c in enumerate(c for c in columns if c in encoded)}
+    select = ', '.join(
+        f"{aliases[c]}.value AS {c}" if c in aliases else f"r.{c} AS {c}" for c in columns
+    )
+    joins = ''.join(
+        f" LEFT JOIN {VALUES_TABLE} {alias} ON {alias}.id = r.{c}" for c, alias in aliases.items()
+    )
+    return f"SELECT {select} FROM {ROWS_TABLE} r{joins}"
+
+
+def _trigger_sqls(columns, encoded):
+    """INSTEAD OF INSERT / UPDATE / DELETE triggers on the attendance view"""
+    new_values = _add_values_sql([f'NEW.{c}' for c in encoded], '(SELECT 1)')
+    column_list = ', '.join(columns)
+    values = ', '.join(_encode(f'NEW.{c}') if c in encoded else f'NEW.{c}' for c in columns)
+    assignments = ', '.join(
+        f"{c} = {_encode(f'NEW.{c}') if c in encoded else f'NEW.{c}'}" for c in columns
+    )
+    return [
+        f"CREATE TRIGGER attendance_insert INSTEAD OF INSERT ON attendance BEGIN "
+        f"{new_values}; INSERT INTO {ROWS_TABLE} ({column_list}) VALUES ({values}); END",
+        f"CREATE TRIGGER attendance_update INSTEAD OF UPDATE ON attendance BEGIN "
+        f"{new_values}; UPDATE {ROWS_TABLE} SET {assignments} WHERE id = OLD.id; END",
+        f"CREATE TRIGGER attendance_delete INSTEAD OF DELETE ON attendance BEGIN "
+        f"DELETE FROM {ROWS_TABLE} WHERE id = OLD.id; END",
+    ]
+
+
+def insert_sqls(columns, encoded, source):
+    """
+    Statements appending rows of `source` (a table or schema.table with the plain
+    attendance columns) to a compact DB: new dictionary values first, then the rows.
+    The second statement's rowcount is the number of rows added.
+    """
+    encoded = [c for c in columns if c in encoded]
+    column_list = ', '.join(columns)
+    select = ', '.join(_encode(f's.{c}') if c in encoded else f's.{c}' for c in columns)
+    statements = [_add_values_sql(encoded, source)] if encoded else []
+    statements.append(
+        f"INSERT OR IGNORE INTO {ROWS_TABLE} ({column_list}) SELECT {select} FROM {source} s"
+    )
+    return statements
+
+
+def _attendance_indexes(conn, table):
+    return [row[0] for row in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL ORDER BY name",
+        (table,),
+    )]
+
+
+def _has_sequences(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_sequence'").fetchone() is not None
+
+
+def _sequence(conn, table):
+    if not _has_sequences(conn):
+        return None
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_sequence(conn, table, seq):
+    """Give `table` the AUTOINCREMENT sequence `seq` (None: no sequence row, as before)"""
+    if not _has_sequences(conn):
+        return
+    conn.execute("DELETE FROM sqlite_sequence WHERE name=?", (table,))
+    if seq is not None:
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, seq))
+
+
+def _rewrite(db_path, transform):
+    """Apply transform(conn) to a copy of db_path in one transaction, VACUUM it and swap it in"""
+    tmp_path = db_path + '.compact.tmp'
+    shutil.copyfile(db_path, tmp_path)
+    try:
+        conn = sqlite3.connect(tmp_path, isolation_level=None)
+        try:
+            conn.execute('BEGIN')
+            transform(conn)
+            conn.execute('COMMIT')
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+        os.replace(tmp_path, db_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def pack_user_db(db_path):
+    """
+    Convert db_path to the compact layout. Returns False (file untouched) if it is
+    already compact, has no attendance table or no scanTime column.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        if is_compact(conn):
+            return False
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='attendance'").fetchone()
+        if row is None:
+            return False
+        table_info = conn.execute('PRAGMA table_info(attendance)').fetchall()
+    finally:
+        conn.close()
+    create_sql = row[0]
+    columns = [col[1] for col in table_info]
+    if REQUIRED_COLUMN not in columns:
+        return False
+    encoded = [col[1] for col in table_info
+               if col[1] in ENCODED_COLUMNS and not col[5] and _has_text_affinity(col[2])]
+    pk_columns = [col[1] for col in table_info if col[5]]
+    if pk_columns != ['id']:
+        return False
+
+    def transform(conn):
+        seq = _sequence(conn, 'attendance')
+        indexes = _attendance_indexes(conn, 'attendance')
+        conn.execute(f"CREATE TABLE {LAYOUT_TABLE} (key TEXT PRIMARY KEY, value TEXT)")
+        conn.executemany(
+            f"INSERT INTO {LAYOUT_TABLE} (key, value) VALUES (?, ?)",
+            [('attendance_sql', create_sql), ('encoded_columns', ','.join(encoded))],
+        )
+        conn.execute(f"CREATE TABLE {VALUES_TABLE} (id INTEGER PRIMARY KEY, value NOT NULL UNIQUE)")
+        conn.execute(_rows_table_sql(table_info, encoded, 'AUTOINCREMENT' in create_sql.upper()))
+        for statement in insert_sqls(columns, encoded, '(SELECT * FROM attendance ORDER BY id)'):
+            conn.execute(statement)
+        conn.execute('DROP TABLE attendance')
+        _set_sequence(conn, ROWS_TABLE, seq)
+        for index_sql in indexes:
+            conn.execute(index_sql.replace(' attendance(', f' {ROWS_TABLE}(', 1)
+                         .replace(' attendance (', f' {ROWS_TABLE} (', 1))
+        conn.execute(f"CREATE VIEW attendance AS {_view_select(columns, encoded)}")
+        for trigger_sql in _trigger_sqls(columns, encoded):
+            conn.execute(trigger_sql)
+
+    _rewrite(db_path, transform)
+    return True
+
+
+def unpack_user_db(db_path):
+    """
+    Convert a compact DB back to the plain attendance table it was packed from.
+    Returns False (file untouched) if it is not compact.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        if not is_compact(conn):
+            return False
+    finally:
+        conn.close()
+
+    def transform(conn):
+        create_sql = conn.execute(
+            f"SELECT value FROM {LAYOUT_TABLE} WHERE key = 'attendance_sql'"
+        ).fetchone()[0]
+        seq = _sequence(conn, ROWS_TABLE)
+        indexes = _attendance_indexes(conn, ROWS_TABLE)
+        conn.execute("CREATE TEMP TABLE decoded AS SELECT * FROM main.attendance")
+        conn.execute('DROP VIEW main.attendance')
+        conn.execute(create_sql)
+        conn.execute('INSERT INTO main.attendance SELECT * FROM temp.decoded ORDER BY id')
+        conn.execute('DROP TABLE temp.decoded')
+        for table in (ROWS_TABLE, VALUES_TABLE, LAYOUT_TABLE):
+            conn.execute(f'DROP TABLE {table}')
+        _set_sequence(conn, 'attendance', seq)
+        for index_sql in indexes:
+            conn.execute(index_sql.replace(f' {ROWS_TABLE}(', ' attendance(', 1)
+                         .replace(f' {ROWS_TABLE} (', ' attendance (', 1))
+
+    _rewrite(db_path, transform)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack user history DBs into the compact layout (or unpack them).")
+    parser.add_argument("paths", nargs="*", help="DB files (default: every DB in --dir).")
+    parser.add_argument("--dir", default="user_session_history", help="User history directory (default: user_session_history).")
+    parser.add_argument("--unpack", action="store_true", help="Convert compact DBs back to the plain attendance table.")
+    args = parser.parse_args()
+
+    paths = args.paths or [
+        os.path.join(args.dir, name) for name in sorted(os.listdir(args.dir)) if name.endswith('.db')
+    ]
+    convert = unpack_user_db if args.unpack else pack_user_db
+    size_before = 0
+    size_after = 0
+    converted = 0
+    for path in paths:
+        before = os.path.getsize(path)
+        try:
+            changed = convert(path)
+        except sqlite3.Error as e:
+            print(f"  ✗ {os.path.basename(path)}: {e}")
+            continue
+        after = os.path.getsize(path)
+        size_before += before
+        size_after += after
+        if changed:
+            converted += 1
+            print(f"  ✓ {os.path.basename(path)}: {before / 1024:.0f} KB → {after / 1024:.0f} KB")
+
+    action = 'Unpacked' if args.unpack else 'Packed'
+    print(f"\n✓ {action} {converted} of {len(paths)} DB(s): "
+          f"{size_before / 1024 / 1024:.1f} MB → {size_after / 1024 / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
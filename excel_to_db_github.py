@@ -10,6 +10,8 @@ HOW IT WORKS (all 5 pipeline steps in one go):
            (year, batch, sessionId, hashed email of the teacher/user)
   Step 2 - Match the hashed email to user details (user_id, user_name,
            division, department) using the userID-email lookup file
+           (compiled into merge_state/user_lookup.db, which is only
+           rebuilt when the lookup file changes)
   Step 3 - Enrich every row:
              - scanTime  = log_date + log_time combined into ISO format
              - dateTime  = earliest scanTime in the session
@@ -38,11 +40,19 @@ import re
 import sqlite3
 import hashlib
 import logging
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from typing import Optional
 
+import numpy as np
+import openpyxl
 import pandas as pd
+from openpyxl.cell.cell import ERROR_CODES
+
+from source_manifest import MANIFEST_DIR, file_sha256
+from sqlite_profiles import connect as connect_db, connect_read_only, restore_durable
 
 # ==============================================================================
 #  SESSION ID GENERATOR
@@ -153,15 +163,35 @@ def parse_filename(filename: str) -> dict:
 #  PART 2 -- USER LOOKUP
 # ==============================================================================
 
-def load_user_lookup(lookup_path: str) -> dict:
+# Compiled copy of the lookup workbook, rebuilt only when the workbook changes
+LOOKUP_INDEX_PATH = os.path.join(MANIFEST_DIR, "user_lookup.db")
+
+LOOKUP_INDEX_SCHEMA = """
+CREATE TABLE users (
+    email_hash TEXT PRIMARY KEY,
+    user_id    TEXT,
+    user_name  TEXT,
+    division   TEXT,
+    department TEXT
+);
+CREATE INDEX idx_users_user_id ON users(user_id);
+
+CREATE TABLE meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+USER_FIELDS = ("user_id", "user_name", "division", "department")
+
+
+def read_user_table(lookup_path: str) -> dict:
     """
     Read userID-email.xlsx and return a dict:
         { hashed_email_string : { user_id, user_name, division, department } }
 
     The email column in the file is expected to already be the SHA-256 hash.
     """
-    logging.info(f"Loading user lookup: {lookup_path}")
-
     ext = Path(lookup_path).suffix.lower()
     df = pd.read_csv(lookup_path) if ext == ".csv" else pd.read_excel(lookup_path)
 
@@ -180,8 +210,122 @@ def load_user_lookup(lookup_path: str) -> dict:
                 "division":   str(row["division"]).strip() if pd.notna(row["division"]) else "N/A",
                 "department": str(row["department"]).strip() if pd.notna(row["department"]) else "N/A",
             }
+    return lookup
+
+
+def _index_source(index_path: str) -> Optional[str]:
+    """SHA-256 of the workbook the index was compiled from (None if missing or unreadable)."""
+    if not os.path.exists(index_path):
+        return None
+    try:
+        conn = connect_read_only(index_path)
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'source_sha256'").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+
+def compile_user_lookup(lookup_path: str, index_path: str = LOOKUP_INDEX_PATH) -> bool:
+    """
+    Make sure index_path holds the users of lookup_path, keyed by email hash
+    and indexed by user_id.  The index is rebuilt (into a temporary file that
+    then replaces it) only when the workbook's SHA-256 differs from the one
+    recorded in it.  Returns True if it was rebuilt.
+    """
+    source_sha256 = file_sha256(lookup_path)
+    if _index_source(index_path) == source_sha256:
+        return False
+
+    users = read_user_table(lookup_path)
+    os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = connect_db(tmp_path)
+    try:
+        conn.executescript(LOOKUP_INDEX_SCHEMA)
+        with conn:
+            conn.executemany(
+                "INSERT INTO users VALUES (?, ?, ?, ?, ?)",
+                [(key, *(user[f] for f in USER_FIELDS)) for key, user in users.items()],
+            )
+            conn.execute("INSERT INTO meta VALUES ('source_sha256', ?)", (source_sha256,))
+    finally:
+        conn.close()
+    restore_durable([tmp_path])
+    os.replace(tmp_path, index_path)
+    return True
+
+
+class UserLookup(Mapping):
+    """
+    { hashed_email : { user_id, user_name, division, department } } served from
+    the compiled lookup index, plus by_user_id().  Rows are fetched on demand
+    and remembered; pickling keeps only the index path, so worker processes
+    reopen the index instead of receiving the whole table.
+    """
+
+    def __init__(self, index_path: str = LOOKUP_INDEX_PATH):
+        self.index_path = index_path
+        self._conn = None
+        self._users = {}
+
+    def __getstate__(self):
+        return {"index_path": self.index_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["index_path"])
+
+    def _query(self, sql: str, params: tuple = ()):
+        if self._conn is None:
+            self._conn = connect_read_only(self.index_path)
+        return self._conn.execute(sql, params)
+
+    def _user(self, column: str, value: str) -> Optional[dict]:
+        if (column, value) not in self._users:
+            row = self._query(
+                f"SELECT {', '.join(USER_FIELDS)} FROM users WHERE {column} = ? ORDER BY rowid LIMIT 1",
+                (value,),
+            ).fetchone()
+            self._users[(column, value)] = dict(zip(USER_FIELDS, row)) if row else None
+        return self._users[(column, value)]
+
+    def __getitem__(self, hashed_email: str) -> dict:
+        user = self._user("email_hash", hashed_email)
+        if user is None:
+            raise KeyError(hashed_email)
+        return user
+
+    def __contains__(self, hashed_email) -> bool:
+        return self._user("email_hash", hashed_email) is not None
+
+    def __iter__(self):
+        return (row[0] for row in self._query("SELECT email_hash FROM users ORDER BY rowid").fetchall())
+
+    def __len__(self) -> int:
+        return self._query("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def by_user_id(self, user_id: str) -> Optional[dict]:
+        """User details for a user_id, or None if it is not in the lookup."""
+        return self._user("user_id", user_id)
+
 
-    logging.info(f"  Loaded {len(lookup):,} users from lookup file")
+def load_user_lookup(lookup_path: str, index_path: str = LOOKUP_INDEX_PATH) -> UserLookup:
+    """
+    Return the user lookup for userID-email.xlsx:
+        { hashed_email_string : { user_id, user_name, division, department } }
+
+    It is served from a compiled SQLite index (compile_user_lookup) so the
+    workbook is only parsed again when its contents change.
+    """
+    logging.info(f"Loading user lookup: {lookup_path}")
+    rebuilt = compile_user_lookup(lookup_path, index_path)
+    lookup = UserLookup(index_path)
+    source = "lookup file" if rebuilt else f"cached index {index_path}"
+    logging.info(f"  Loaded {len(lookup):,} users from {source}")
     return lookup
 
 
@@ -205,6 +349,19 @@ def resolve_user(hashed_email: Optional[str], lookup: dict) -> dict:
     return DEVELOPER_USER
 
 
+def resolve_user_id(user_id: str, lookup: dict) -> dict:
+    """
+    Return user details for a User ID read from the sheet itself.
+    Falls back to the Developer name/division/department if it is unknown.
+    """
+    by_user_id = getattr(lookup, "by_user_id", None)
+    if by_user_id is not None:
+        user = by_user_id(user_id)
+    else:   # a plain {hash: details} dict
+        user = next((u for u in lookup.values() if u["user_id"] == user_id), None)
+    return user or DEVELOPER_USER
+
+
 def resolve_user_from_plain_email(plain_email: str, lookup: dict) -> dict:
     """
     Hash a plain email address with SHA-256 then look it up.
@@ -289,6 +446,210 @@ def is_valid_time(time_val) -> bool:
         return False
 
 
+def format_id(id_val) -> str:
+    """Return a student / user ID cell as text (211559.0 -> '211559')."""
+    if pd.isna(id_val):
+        return ""
+    if str(id_val).replace(".0", "").isdigit():
+        return str(int(id_val))
+    return str(id_val)
+
+
+# ------------------------------------------------------------------------------
+#  Vectorized versions of the helpers above, used by process_excel_file().
+#  String cells are factorized first so every distinct value is parsed once
+#  (a scanner sheet repeats the same few dates thousands of times).  The
+#  common shapes -- digit IDs, dd/mm/yyyy dates, hh:mm:ss times, numeric and
+#  datetime columns -- are handled with pandas/NumPy column operations and
+#  anything else goes through the scalar helper, so the result is always
+#  identical to .apply(helper).
+# ------------------------------------------------------------------------------
+
+_DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+_CLOCK_PATTERN = r"([0-9]{1,2}):([0-9]{2}):([0-9]{2})"
+
+
+def _string_codes(series: pd.Series):
+    """
+    Factorize the string cells of a column.
+    Returns (codes, uniques): codes[i] is the position of row i in uniques,
+    or -1 for NaN and non-string cells.
+    """
+    codes = np.full(len(series), -1, dtype=np.intp)
+    uniques = pd.Series([], dtype=object)
+    if series.dtype == object or isinstance(series.dtype, pd.StringDtype):
+        try:
+            is_text = series.str.len().notna().to_numpy()
+        except AttributeError:   # object column without a single string cell
+            return codes, uniques
+        if is_text.any():
+            codes[is_text], found = pd.factorize(series[is_text])
+            uniques = pd.Series(np.asarray(found, dtype=object), dtype=object)
+    return codes, uniques
+
+
+def _apply_to_strings(series: pd.Series, result: np.ndarray, done: np.ndarray, fast, func) -> None:
+    """
+    Fill result for the string cells of series.  fast(uniques) returns
+    (values, covered) for the distinct strings; uncovered ones use func.
+    """
+    codes, uniques = _string_codes(series)
+    if uniques.empty:
+        return
+    values, covered = fast(uniques)
+    values = np.array(values, dtype=object)
+    if not covered.all():
+        values[~covered] = [func(v) for v in uniques[~covered]]
+    has = codes >= 0
+    result[has] = values[codes[has]]
+    done |= has
+
+
+def _fill_rest(result: np.ndarray, series: pd.Series, done: np.ndarray, func) -> None:
+    """Run the scalar helper on every cell the column paths did not cover."""
+    rest = ~done
+    if rest.any():
+        result[rest] = [func(v) for v in series.to_numpy(dtype=object)[rest]]
+
+
+def _date_exists(year: np.ndarray, month: np.ndarray, day: np.ndarray) -> np.ndarray:
+    """Element-wise 'datetime(year, month, day) would not raise' (1 <= year <= 9999)."""
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    days = _DAYS_IN_MONTH[np.clip(month, 1, 12) - 1] + ((month == 2) & leap)
+    return (month >= 1) & (month <= 12) & (day >= 1) & (day <= days)
+
+
+def format_id_series(series: pd.Series) -> pd.Series:
+    """Vectorized format_id()."""
+    result = np.empty(len(series), dtype=object)
+    done = np.zeros(len(series), dtype=bool)
+
+    def fast(uniques):
+        digits = uniques.str.fullmatch(r"[0-9]{1,4300}").to_numpy(dtype=bool)
+        values = np.empty(len(uniques), dtype=object)
+        # int("007") drops the leading zeros
+        values[digits] = uniques[digits].str.lstrip("0").replace("", "0").to_numpy(dtype=object)
+        return values, digits
+
+    if pd.api.types.is_integer_dtype(series):
+        result[:] = series.astype(str).to_numpy(dtype=object)
+        done[:] = True
+    elif pd.api.types.is_float_dtype(series):
+        values = series.to_numpy(dtype="float64")
+        # whole numbers below 1e16 print as 'N.0' (no exponent) -> str(int(x))
+        with np.errstate(invalid="ignore"):
+            whole = (
+                ~np.isnan(values) & ~np.signbit(values)
+                & (values < 1e16) & (np.floor(values) == values)
+            )
+        result[whole] = values[whole].astype(np.int64).astype(str)
+        done |= whole
+    else:
+        _apply_to_strings(series, result, done, fast, format_id)
+
+    _fill_rest(result, series, done, format_id)
+    return pd.Series(result, index=series.index, dtype=object)
+
+
+def is_valid_time_series(series: pd.Series) -> pd.Series:
+    """Vectorized is_valid_time()."""
+    result = np.zeros(len(series), dtype=bool)
+    done = series.isna().to_numpy(copy=True)
+
+    def fast(uniques):
+        text = uniques.str.strip()
+        parts = text.str.extract("^" + _CLOCK_PATTERN + "$")
+        matched = parts[0].notna().to_numpy()
+        h, m, s = (parts[i][matched].astype(int).to_numpy() for i in range(3))
+        values = np.zeros(len(uniques), dtype=bool)
+        values[matched] = (h <= 23) & (m <= 59) & (s <= 59)
+        # '\d' in is_valid_time also accepts non-ASCII digits: leave those to it
+        covered = matched | ~text.str.contains(r"[^\x00-\x7f]").to_numpy(dtype=bool)
+        return values, covered
+
+    if series.dtype == object or isinstance(series.dtype, pd.StringDtype):
+        _apply_to_strings(series, result, done, fast, is_valid_time)
+    else:
+        done[:] = True   # numbers and datetimes never print as a bare hh:mm:ss
+
+    _fill_rest(result, series, done, is_valid_time)
+    return pd.Series(result, index=series.index, dtype=bool)
+
+
+def format_log_date_series(series: pd.Series) -> pd.Series:
+    """Vectorized format_log_date()."""
+    result = np.empty(len(series), dtype=object)
+    missing = series.isna().to_numpy()
+    done = missing.copy()
+    result[missing] = ""
+
+    def fast(uniques):
+        text = uniques.str.strip()
+        dmy = text.str.fullmatch(r"[0-9]{2}/[0-9]{2}/[0-9]{4}").to_numpy(dtype=bool)
+        return text.to_numpy(dtype=object), dmy
+
+    if pd.api.types.is_datetime64_dtype(series):
+        result[~missing] = series[~missing].dt.strftime("%d/%m/%Y").to_numpy(dtype=object)
+        done[:] = True
+    else:
+        _apply_to_strings(series, result, done, fast, format_log_date)
+
+    _fill_rest(result, series, done, format_log_date)
+    return pd.Series(result, index=series.index, dtype=object)
+
+
+def to_iso_series(date_series: pd.Series, time_series: pd.Series) -> pd.Series:
+    """Vectorized to_iso() over two aligned columns."""
+    result = np.full(len(date_series), None, dtype=object)
+    done = (date_series.isna() | time_series.isna()).to_numpy(copy=True)
+
+    # Excel datetime cells print as 'yyyy-mm-dd hh:mm:ss', which to_iso rejects
+    if pd.api.types.is_datetime64_dtype(date_series):
+        done[:] = True
+
+    date_codes, dates = _string_codes(date_series)
+    time_codes, times = _string_codes(time_series)
+    rows = np.flatnonzero((date_codes >= 0) & (time_codes >= 0) & ~done)
+    if len(rows):
+        # distinct dates -> 'yyyy-mm-ddT' prefix
+        text = dates.str.strip()
+        dmy = text.str.extract(r"^([0-9]{2})/([0-9]{2})/([0-9]{4})$")
+        ymd = text.str.extract(r"^([0-9]{4})-([0-9]{2})-([0-9]{2})$")
+        y, m, d = dmy[2].fillna(ymd[0]), dmy[1].fillna(ymd[1]), dmy[0].fillna(ymd[2])
+        date_fast = y.notna().to_numpy(copy=True)
+        date_ok = np.zeros(len(dates), dtype=bool)
+        year = y[date_fast].astype(int).to_numpy()
+        date_ok[date_fast] = _date_exists(
+            year, m[date_fast].astype(int).to_numpy(), d[date_fast].astype(int).to_numpy()
+        )
+        # strftime('%Y') does not zero-pad years below 1000: leave those to to_iso
+        date_fast[date_fast] = year >= 1000
+        prefix = (y + "-" + m + "-" + d + "T").to_numpy(dtype=object)
+
+        # distinct times -> 'hh:mm:ss.013Z' suffix
+        parts = times.str.strip().str.extract("^" + _CLOCK_PATTERN + r"(?:\.[0-9]*)?$")
+        time_fast = parts[0].notna().to_numpy()
+        time_ok = np.zeros(len(times), dtype=bool)
+        h, mi, s = (parts[i][time_fast].astype(int).to_numpy() for i in range(3))
+        time_ok[time_fast] = (h <= 23) & (mi <= 59) & (s <= 59)
+        suffix = (parts[0].str.zfill(2) + ":" + parts[1] + ":" + parts[2] + ".013Z").to_numpy(dtype=object)
+
+        dc, tc = date_codes[rows], time_codes[rows]
+        fast = date_fast[dc] & time_fast[tc]
+        ok = fast & date_ok[dc] & time_ok[tc]
+        result[rows[ok]] = prefix[dc[ok]] + suffix[tc[ok]]
+        done[rows[fast]] = True
+
+    rest = ~done
+    if rest.any():
+        result[rest] = [
+            to_iso(d, t)
+            for d, t in zip(date_series.to_numpy(dtype=object)[rest],
+                            time_series.to_numpy(dtype=object)[rest])
+        ]
+    return pd.Series(result, index=date_series.index, dtype=object)
+
+
 def categorise_session(types_series) -> pd.Series:
     """
     Given the 'Type' column for one session, return
@@ -376,125 +737,256 @@ INSERT INTO attendance (
 """
 
 
+def frame_records(df: pd.DataFrame) -> list[tuple]:
+    """
+    Turn an enriched DataFrame into tuples matching INSERT_SQL column order.
+    Each column is cast once (same str()/int() conversions as row by row).
+    """
+    def text(col):
+        return list(map(str, df[col].tolist()))
+
+    def number(col):
+        return list(map(int, df[col].tolist()))
+
+    def raw(col):
+        return df[col].tolist()
+
+    years = [int(y) if pd.notna(y) else None for y in df["year"].tolist()]
+    return list(zip(
+        text("sessionId"), text("subject"), raw("dateTime"), number("inProgress"),
+        years, text("batch"),
+        number("isChecklist"), number("isScanner"), number("isExcused"), number("isEdited"),
+        number("backedUp"), number("personalBackedUp"), number("synced"), text("syncedAt"),
+        text("student_id"), raw("scanTime"), text("log_date"), text("log_time"),
+        number("isManual"), text("created_at"), text("updated_at"), raw("notes"),
+        text("user_name"), text("user_id"), text("division"), text("department"),
+    ))
+
+
+def write_dbs(batches: list[tuple[Path, list[tuple]]]):
+    """
+    Create (or overwrite) one .db file per (db_path, rows) batch through a
+    single connection: rows are staged in an in-memory copy of the schema and
+    each file is written in one go with VACUUM INTO, so it never has a
+    journal or WAL of its own and ends up like a restore_durable()'d file.
+    Yields (db_path, error) per batch -- error is None on success.
+    """
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.executescript(DB_SCHEMA)
+        for db_path, rows in batches:
+            try:
+                if db_path.exists():
+                    db_path.unlink()
+                with conn:
+                    conn.execute("DELETE FROM attendance")
+                    conn.execute("DELETE FROM sqlite_sequence")   # ids restart at 1 in every file
+                    conn.executemany(INSERT_SQL, rows)
+                conn.execute("VACUUM INTO ?", (str(db_path),))
+            except Exception as e:
+                yield db_path, e
+            else:
+                yield db_path, None
+    finally:
+        conn.close()
+
+
 def write_db(db_path: Path, rows: list[tuple]):
     """Create (or overwrite) a .db file and insert all rows."""
-    if db_path.exists():
-        db_path.unlink()
-
-    conn = sqlite3.connect(db_path)
-    conn.executescript(DB_SCHEMA)
-    conn.executemany(INSERT_SQL, rows)
-    conn.commit()
-    conn.close()
+    for _, error in write_dbs([(db_path, rows)]):
+        if error is not None:
+            raise error
 
 
 # ==============================================================================
 #  PART 5 -- MAIN PIPELINE
 # ==============================================================================
 
+# Columns process_excel_file() reads (header names lower-cased, spaces -> '_')
+SHEET_COLUMNS = ("student_id", "subject", "log_date", "log_time", "type", "user_id")
+
+# Rows handed from the sheet reader to the enrichment steps at a time
+READ_BATCH_ROWS = 5000
+
+# Cell text read_excel treats as missing (its default na_values)
+EXCEL_NA_VALUES = frozenset({
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+})
+
+
+def _cell_value(value):
+    """A values_only cell as read_excel would give it (whole floats -> int, errors/NA text -> NaN)."""
+    if value is None:
+        return np.nan
+    if isinstance(value, str):
+        return np.nan if value in EXCEL_NA_VALUES or value in ERROR_CODES else value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def iter_sheet_frames(ws, batch_rows: int = READ_BATCH_ROWS):
+    """
+    Stream a read-only worksheet as DataFrames of at most batch_rows rows.
+
+    The header is the first non-blank row.  Only the SHEET_COLUMNS columns are
+    kept, under their (stripped) header names, so the column lookup of
+    process_excel_file works unchanged.  Blank rows between data rows are kept
+    (read_excel keeps them too); trailing blank rows are dropped.
+    """
+    rows = ws.iter_rows(values_only=True)
+    keep = {}
+    for row in rows:
+        if any(v is not None and v != "" for v in row):
+            names, seen = [], {}
+            for i, v in enumerate(row):
+                name = f"Unnamed: {i}" if v is None or v == "" else str(v)
+                if name in seen:                    # read_excel renames repeats to 'X.1', 'X.2'
+                    seen[name] += 1
+                    name = f"{name}.{seen[name]}"
+                else:
+                    seen[name] = 0
+                names.append(name)
+            for i, name in enumerate(names):
+                canonical = name.strip().lower().replace(" ", "_")
+                if canonical in SHEET_COLUMNS:
+                    keep[canonical] = (name.strip(), i)
+            break
+    if not keep:
+        return
+
+    columns = list(keep.values())
+    batch, blank = [], 0
+    for row in rows:
+        if not any(v is not None and v != "" for v in row):
+            blank += 1
+            continue
+        batch.extend([[np.nan] * len(columns)] * blank)
+        blank = 0
+        batch.append([_cell_value(row[i]) if i < len(row) else np.nan for _, i in columns])
+        if len(batch) >= batch_rows:
+            yield _batch_frame(batch, columns)
+            batch = []
+    if batch:
+        yield _batch_frame(batch, columns)
+
+
+def _batch_frame(batch: list, columns: list) -> pd.DataFrame:
+    values = list(zip(*batch))
+    return pd.DataFrame({name: pd.Series(values[k]) for k, (name, _) in enumerate(columns)})
+
+
 def process_excel_file(excel_path: Path, lookup: dict, meta: dict) -> Optional[pd.DataFrame]:
     """
     Read one raw Excel file and return a fully-enriched DataFrame,
     or None if there is nothing usable inside.
 
+    Sheets are streamed in row batches (iter_sheet_frames) and each batch
+    goes through the row-level steps A-C straight away; the session-level
+    steps D-I then run once on the enriched rows of the whole workbook.
+
     meta  =  output of parse_filename()
     """
     try:
-        xl = pd.ExcelFile(excel_path, engine="openpyxl")
+        wb = openpyxl.load_workbook(excel_path, read_only=True, data_only=True, keep_links=False)
     except Exception as e:
         logging.error(f"    Cannot open {excel_path.name}: {e}")
         return None
 
     frames = []
-    for sheet in xl.sheet_names:
-        try:
-            df = xl.parse(sheet)
-        except Exception as e:
-            logging.warning(f"    Skipping sheet '{sheet}': {e}")
-            continue
-
-        if df.empty:
-            continue
-
-        # -- normalise column names (strip spaces, lower for matching) ---------
-        df.columns = [c.strip() for c in df.columns]
-        col_map = {c.lower().replace(" ", "_"): c for c in df.columns}
-
-        def gcol(canonical: str):
-            """Get the actual column name regardless of capitalisation."""
-            return col_map.get(canonical)
-
-        # -- required columns --------------------------------------------------
-        sid_col  = gcol("student_id")
-        subj_col = gcol("subject")
-        date_col = gcol("log_date")
-        time_col = gcol("log_time")
-        type_col = gcol("type")
-        user_col    = gcol("user")
-        user_id_col = gcol("user_id")   # direct User ID column (scanner exports)
-
-        if not all([sid_col, date_col, time_col]):
-            logging.warning(f"    Sheet '{sheet}' missing required columns, skipping")
-            continue
-
-        out = pd.DataFrame()
-
-        # -- basic columns -----------------------------------------------------
-        out["student_id"]       = df[sid_col].apply(
-            lambda x: str(int(x)) if pd.notna(x) and str(x).replace(".0","").isdigit() else str(x) if pd.notna(x) else ""
-        )
-        out["subject"]          = df[subj_col].astype(str) if subj_col else meta["subject"]
-        out["log_date_raw"]     = df[date_col]  # keep raw for scanTime calc
-        out["log_time"]         = df[time_col].astype(str).str.strip() if time_col else ""
-        out["type_raw"]         = df[type_col].astype(str) if type_col else "scan"
-        out["user_raw"]         = df[user_col].astype(str).str.strip() if user_col else ""
-        out["user_id_raw"]      = df[user_id_col].apply(
-            lambda x: str(int(x)) if pd.notna(x) and str(x).replace(".0","").isdigit()
-            else str(x) if pd.notna(x) else ""
-        ) if user_id_col else ""
-
-        # -- session info from filename ----------------------------------------
-        # Single-sheet workbook or filename already contains a sessionId:
-        #   use it directly.
-        # Multi-sheet workbook with no sessionId in filename:
-        #   generate one per sheet so each session gets a unique ID.
-        if meta["session_id"]:
-            sheet_session_id = meta["session_id"]
-        else:
-            # Detect type from this sheet's Type column and generate ID
-            prefix = detect_session_prefix(out["type_raw"])
-            sheet_session_id = generate_session_id(prefix)
-            logging.info(f"    Generated sessionId for sheet '{sheet}': {sheet_session_id}")
-
-        out["sessionId"]        = sheet_session_id
-        out["year"]             = meta["year"]
-        out["batch"]            = meta["batch"] or ""
-
-        frames.append(out)
+    dropped = 0
+    try:
+        for sheet in wb.sheetnames:
+            sheet_frames = []
+            sheet_types  = []
+            sheet_dropped = 0
+            try:
+                for df in iter_sheet_frames(wb[sheet]):
+                    # -- normalise column names (strip spaces, lower for matching) -
+                    col_map = {c.lower().replace(" ", "_"): c for c in df.columns}
+
+                    def gcol(canonical: str):
+                        """Get the actual column name regardless of capitalisation."""
+                        return col_map.get(canonical)
+
+                    # -- required columns ------------------------------------------
+                    sid_col  = gcol("student_id")
+                    subj_col = gcol("subject")
+                    date_col = gcol("log_date")
+                    time_col = gcol("log_time")
+                    type_col = gcol("type")
+                    user_id_col = gcol("user_id")   # direct User ID column (scanner exports)
+
+                    if not all([sid_col, date_col, time_col]):
+                        logging.warning(f"    Sheet '{sheet}' missing required columns, skipping")
+                        sheet_frames = []
+                        break
+
+                    out = pd.DataFrame()
+
+                    # -- basic columns ---------------------------------------------
+                    out["student_id"]       = format_id_series(df[sid_col])
+                    out["subject"]          = df[subj_col].astype(str) if subj_col else meta["subject"]
+                    out["log_date_raw"]     = df[date_col]  # keep raw for scanTime calc
+                    out["log_time"]         = df[time_col].astype(str).str.strip() if time_col else ""
+                    out["type_raw"]         = df[type_col].astype(str) if type_col else "scan"
+                    out["user_id_raw"]      = format_id_series(df[user_id_col]) if user_id_col else ""
+                    sheet_types.append(out["type_raw"].drop_duplicates())
+
+                    # == Step A: remove invalid times ==============================
+                    valid_mask = is_valid_time_series(out["log_time"])
+                    sheet_dropped += (~valid_mask).sum()
+                    out = out[valid_mask].copy()
+
+                    # == Step B: format log_date (dd/mm/yyyy) ======================
+                    out["log_date"] = format_log_date_series(out["log_date_raw"])
+
+                    # == Step C: scanTime  (ISO datetime) ==========================
+                    out["scanTime"] = to_iso_series(out["log_date_raw"], out["log_time"])
+
+                    sheet_frames.append(out.drop(columns=["log_date_raw"]))
+            except Exception as e:
+                logging.warning(f"    Skipping sheet '{sheet}': {e}")
+                continue
+
+            if not sheet_frames:
+                continue
+            dropped += sheet_dropped
+            out = pd.concat(sheet_frames, ignore_index=True)
+
+            # -- session info from filename ------------------------------------
+            # Single-sheet workbook or filename already contains a sessionId:
+            #   use it directly.
+            # Multi-sheet workbook with no sessionId in filename:
+            #   generate one per sheet so each session gets a unique ID.
+            if meta["session_id"]:
+                sheet_session_id = meta["session_id"]
+            else:
+                # Detect type from this sheet's Type column and generate ID
+                prefix = detect_session_prefix(pd.concat(sheet_types))
+                sheet_session_id = generate_session_id(prefix)
+                logging.info(f"    Generated sessionId for sheet '{sheet}': {sheet_session_id}")
+
+            out["sessionId"]        = sheet_session_id
+            out["year"]             = meta["year"]
+            out["batch"]            = meta["batch"] or ""
+
+            frames.append(out)
+    finally:
+        wb.close()
 
     if not frames:
         return None
 
     df = pd.concat(frames, ignore_index=True)
 
-    # == Step A: remove invalid times ==========================================
-    valid_mask = df["log_time"].apply(is_valid_time)
-    dropped = (~valid_mask).sum()
     if dropped:
         logging.info(f"    Dropped {dropped:,} rows with invalid log_time")
-    df = df[valid_mask].copy()
 
     if df.empty:
         return None
 
-    # == Step B: format log_date (dd/mm/yyyy) ==================================
-    df["log_date"] = df["log_date_raw"].apply(format_log_date)
-
-    # == Step C: scanTime  (ISO datetime) ======================================
-    df["scanTime"] = df.apply(
-        lambda r: to_iso(r["log_date_raw"], r["log_time"]), axis=1
-    )
-
     # == Step D: isManual flag ==================================================
     df["isManual"] = df["type_raw"].str.lower().str.strip().eq("manual").astype(int)
 
@@ -568,9 +1060,10 @@ def process_excel_file(excel_path: Path, lookup: dict, meta: dict) -> Optional[p
         uid = user_id_raw_series[valid_uid_raw].iloc[0]
         logging.info(f"    [User resolve] Step 1 matched: User ID column -> {uid}")
         df["user_id"]    = user_id_raw_series.where(valid_uid_raw, DEVELOPER_USER["user_id"])
-        df["user_name"]  = DEVELOPER_USER["user_name"]   # not available from sheet alone
-        df["division"]   = DEVELOPER_USER["division"]
-        df["department"] = DEVELOPER_USER["department"]
+        # name / division / department come from the lookup when the ID is in it
+        users = {u: resolve_user_id(u, lookup) for u in df["user_id"].unique()}
+        for field in ("user_name", "division", "department"):
+            df[field] = df["user_id"].map({u: user[field] for u, user in users.items()})
 
     # --- Step G2: Hash in filename -> lookup table ----------------------------
     elif meta["hashed_email"]:
@@ -624,13 +1117,135 @@ def process_excel_file(excel_path: Path, lookup: dict, meta: dict) -> Optional[p
     if dupes:
         logging.info(f"    Removed {dupes:,} duplicate rows")
 
-    df.drop(columns=["log_date_raw", "type_raw", "user_raw", "user_id_raw"], inplace=True, errors="ignore")
+    df.drop(columns=["type_raw", "user_id_raw"], inplace=True, errors="ignore")
 
     return df
 
 
-def run(excel_dir: str, lookup_path: str, output_dir: str):
-    """Main entry-point: process all Excel files and write .db files."""
+def convert_file(xl_path: Path, lookup: dict, output_dir: Path, idx: int, total: int) -> dict:
+    """
+    Convert one Excel file into its .db files.
+    Returns {'dbs', 'rows', 'failed': names to report as failed, 'converted': bool}.
+    """
+    result = {"dbs": 0, "rows": 0, "failed": [], "converted": False}
+    logging.info(f"[{idx}/{total}] {xl_path.name}")
+
+    meta = parse_filename(xl_path.name)
+    logging.info(
+        f"    -> year={meta['year']}, batch={meta['batch']}, "
+        f"session={meta['session_id']}, "
+        f"hashed_email={'yes' if meta['hashed_email'] else 'not found'}"
+    )
+
+    df = process_excel_file(xl_path, lookup, meta)
+
+    if df is None or df.empty:
+        logging.warning(f"    No usable data -- skipping")
+        result["failed"].append(xl_path.name)
+        return result
+
+    # -- one .db per (sessionId, user_id) combination -------------------------
+    records = frame_records(df)
+    groups  = df.groupby(["sessionId", "user_id"]).indices
+    batches = [
+        (output_dir / f"{session_id}_{user_id}.db", [records[i] for i in groups[(session_id, user_id)]])
+        for session_id, user_id in sorted(groups)
+    ]
+    for (db_path, rows), (_, error) in zip(batches, write_dbs(batches)):
+        if error is None:
+            logging.info(f"    [OK] {db_path.name}  ({len(rows)} rows)")
+            result["dbs"]  += 1
+            result["rows"] += len(rows)
+            result["converted"] = True
+        else:
+            logging.error(f"    [FAIL] Failed to write {db_path.name}: {error}")
+            result["failed"].append(xl_path.name)
+    return result
+
+
+# Set in each pool worker by _init_worker(): the lookup is sent once per worker
+_worker_lookup: dict = {}
+
+
+class _RecordBuffer(logging.Handler):
+    """Keeps a worker's log records so the parent can emit them in file order."""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        record.msg, record.args = record.getMessage(), None   # make it picklable
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+def _init_worker(lookup: dict, log_level: int):
+    """ProcessPoolExecutor initializer: keep the lookup, capture logging."""
+    global _worker_lookup
+    import random
+    random.seed()   # forked workers must not generate the same sessionIds
+    _worker_lookup = lookup
+    root = logging.getLogger()
+    root.handlers = []
+    root.setLevel(log_level)
+
+
+def _convert_files_job(job):
+    """
+    ProcessPoolExecutor entry point: convert a run of files (those sharing a
+    sessionId, in order) and return [(idx, result, log records)].
+    """
+    output_dir, total, files = job
+    root = logging.getLogger()
+    converted = []
+    for idx, xl_path in files:
+        buffer = _RecordBuffer()
+        root.addHandler(buffer)
+        try:
+            result = convert_file(xl_path, _worker_lookup, output_dir, idx, total)
+        finally:
+            root.removeHandler(buffer)
+        converted.append((idx, result, buffer.records))
+    return converted
+
+
+def convert_files_parallel(excel_files: list, lookup: dict, output_dir: Path, jobs: int) -> list:
+    """
+    Convert excel_files on `jobs` worker processes.  Files that share a
+    sessionId in their name (and so write the same .db files) go to the same
+    worker, in order; each file's log records are replayed here in file order.
+    Returns the convert_file() results in file order.
+    """
+    runs = {}
+    for idx, xl_path in enumerate(excel_files, 1):
+        session_id = parse_filename(xl_path.name)["session_id"] or f"#{idx}"
+        runs.setdefault(session_id, []).append((idx, xl_path))
+    work = [(output_dir, len(excel_files), files) for files in runs.values()]
+
+    logging.info(f"Converting on {jobs} worker processes...")
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_worker,
+        initargs=(lookup, logging.getLogger().getEffectiveLevel()),
+    ) as pool:
+        done = [item for chunk in pool.map(_convert_files_job, work) for item in chunk]
+
+    results = []
+    for _, result, records in sorted(done, key=lambda item: item[0]):
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+        results.append(result)
+    return results
+
+
+def run(excel_dir: str, lookup_path: str, output_dir: str, jobs: int = 1):
+    """
+    Main entry-point: process all Excel files and write .db files.
+    With jobs > 1, files are converted in parallel worker processes.
+    """
 
     excel_dir  = Path(excel_dir)
     output_dir = Path(output_dir)
@@ -672,73 +1287,19 @@ def run(excel_dir: str, lookup_path: str, output_dir: str):
     failed_files      = []
     converted_files   = []   # Excel paths that produced at least one .db successfully
 
-    for idx, xl_path in enumerate(excel_files, 1):
-        logging.info(f"[{idx}/{len(excel_files)}] {xl_path.name}")
-
-        meta = parse_filename(xl_path.name)
-        logging.info(
-            f"    -> year={meta['year']}, batch={meta['batch']}, "
-            f"session={meta['session_id']}, "
-            f"hashed_email={'yes' if meta['hashed_email'] else 'not found'}"
+    if jobs > 1 and len(excel_files) > 1:
+        results = convert_files_parallel(excel_files, lookup, output_dir, jobs)
+    else:
+        results = (
+            convert_file(xl_path, lookup, output_dir, idx, len(excel_files))
+            for idx, xl_path in enumerate(excel_files, 1)
         )
 
-        df = process_excel_file(xl_path, lookup, meta)
-
-        if df is None or df.empty:
-            logging.warning(f"    No usable data -- skipping")
-            failed_files.append(xl_path.name)
-            continue
-
-        # -- one .db per (sessionId, user_id) combination ---------------------
-        groups = df.groupby(["sessionId", "user_id"])
-        file_had_success = False
-        for (session_id, user_id), group in groups:
-            db_name   = f"{session_id}_{user_id}.db"
-            db_path   = output_dir / db_name
-
-            # Build list of tuples matching INSERT_SQL column order
-            records = []
-            for _, r in group.iterrows():
-                records.append((
-                    str(r["sessionId"]),
-                    str(r["subject"]),
-                    r["dateTime"],
-                    int(r["inProgress"]),
-                    int(r["year"]) if pd.notna(r["year"]) else None,
-                    str(r["batch"]),
-                    int(r["isChecklist"]),
-                    int(r["isScanner"]),
-                    int(r["isExcused"]),
-                    int(r["isEdited"]),
-                    int(r["backedUp"]),
-                    int(r["personalBackedUp"]),
-                    int(r["synced"]),
-                    str(r["syncedAt"]),
-                    str(r["student_id"]),
-                    r["scanTime"],
-                    str(r["log_date"]),
-                    str(r["log_time"]),
-                    int(r["isManual"]),
-                    str(r["created_at"]),
-                    str(r["updated_at"]),
-                    r["notes"],
-                    str(r["user_name"]),
-                    str(r["user_id"]),
-                    str(r["division"]),
-                    str(r["department"]),
-                ))
-
-            try:
-                write_db(db_path, records)
-                logging.info(f"    [OK] {db_name}  ({len(records)} rows)")
-                total_db       += 1
-                total_rows     += len(records)
-                file_had_success = True
-            except Exception as e:
-                logging.error(f"    [FAIL] Failed to write {db_name}: {e}")
-                failed_files.append(xl_path.name)
-
-        if file_had_success:
+    for xl_path, result in zip(excel_files, results):
+        total_db   += result["dbs"]
+        total_rows += result["rows"]
+        failed_files.extend(result["failed"])
+        if result["converted"]:
             converted_files.append(xl_path)
 
     # -- Summary ----------------------------------------------------------------
@@ -760,7 +1321,7 @@ def run(excel_dir: str, lookup_path: str, output_dir: str):
 #  CLI
 # ==============================================================================
 
-def run_headless(excel_dir: str, lookup_path: str, output_dir: str):
+def run_headless(excel_dir: str, lookup_path: str, output_dir: str, jobs: int = 1):
     """
     Non-interactive entry-point for use in automated pipelines (e.g. GitHub Actions).
 
@@ -772,12 +1333,14 @@ def run_headless(excel_dir: str, lookup_path: str, output_dir: str):
         python excel_to_db.py --headless \
             --excel-dir  log_history \
             --lookup     userID-email.xlsx \
-            --output-dir log_history
+            --output-dir log_history \
+            --jobs       4
     """
     logging.info("Running in headless (non-interactive) mode")
     logging.info(f"  Excel dir  : {excel_dir}")
     logging.info(f"  Lookup     : {lookup_path}")
     logging.info(f"  Output dir : {output_dir}")
+    logging.info(f"  Jobs       : {jobs}")
 
     if not Path(excel_dir).is_dir():
         logging.error(f"Excel dir not found: '{excel_dir}'")
@@ -787,7 +1350,7 @@ def run_headless(excel_dir: str, lookup_path: str, output_dir: str):
         logging.error(f"Lookup file not found: '{lookup_path}'")
         raise SystemExit(1)
 
-    converted = run(excel_dir, lookup_path, output_dir) or []
+    converted = run(excel_dir, lookup_path, output_dir, jobs) or []
 
     # Write a manifest of successfully converted Excel paths so the calling
     # shell script can delete exactly those files and nothing else.
@@ -828,11 +1391,19 @@ def main():
         default="./output_db",
         help="Folder where .db files will be saved (default: ./output_db)",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Convert this many Excel files in parallel worker processes (default: 1)",
+    )
 
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
 
     if args.headless:
-        run_headless(args.excel_dir, args.lookup, args.output_dir)
+        run_headless(args.excel_dir, args.lookup, args.output_dir, args.jobs)
         print("\nHeadless run complete. Check the log file for full details.")
         return
 
@@ -881,7 +1452,7 @@ def main():
         return
 
     print()
-    run(excel_dir, lookup_path, output_dir)
+    run(excel_dir, lookup_path, output_dir, args.jobs)
     print("\nAll done! Check the log file for full details.")
 
 
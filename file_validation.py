@@ -0,0 +1,121 @@
+"""
+Validated-File Cache
+
+Remembers what a SQLite file looked like the last time it was probed, keyed by
+(path, size, mtime), so unchanged files are not re-opened on every run. When only
+the mtime moved (a fresh git checkout, where the mtimes are not known, see
+source_manifest.py), a matching size and SHA-256 also count as unchanged:
+
+- status             'valid', 'not_sqlite', 'lfs_pointer', 'unreadable' or 'corrupt'
+- attendance_schema  short fingerprint of the attendance table's columns (None if absent)
+- quick_check        result of PRAGMA quick_check, when the file was probed in deep mode
+
+The cache is shared by merge_user_sessions.py and cleanup_user_session_history.py and
+stored as JSON under merge_state/, with paths relative to the repository root.
+"""
+
+import hashlib
+import os
+import sqlite3
+from typing import Optional
+
+from source_manifest import MANIFEST_DIR, file_sha256, load_manifest, save_manifest
+from sqlite_profiles import connect_read_only
+
+VALIDATION_CACHE_PATH = os.path.join(MANIFEST_DIR, 'validation_cache.json')
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+LFS_POINTER_PREFIX = b'version https://git-lfs'
+
+VALID = 'valid'
+
+
+def _repo_root(cache_path: str) -> str:
+    return os.path.dirname(os.path.dirname(os.path.abspath(cache_path)))
+
+
+def _cache_key(cache_path: str, path: str) -> str:
+    return os.path.relpath(os.path.abspath(path), _repo_root(cache_path))
+
+
+def load_validation_cache(cache_path: str = VALIDATION_CACHE_PATH) -> dict:
+    """Return the cache (a dict to pass to validate_file and save_validation_cache)."""
+    return {'path': cache_path, 'files': load_manifest(cache_path), 'probed': 0}
+
+
+def save_validation_cache(cache: dict) -> None:
+    """Write the cache back, dropping entries for files that no longer exist."""
+    root = _repo_root(cache['path'])
+    files = {key: entry for key, entry in cache['files'].items() if os.path.exists(os.path.join(root, key))}
+    save_manifest(cache['path'], files)
+
+
+def attendance_schema(columns) -> Optional[str]:
+    """Short fingerprint of an attendance table's column names (in table order)."""
+    if not columns:
+        return None
+    return hashlib.sha1(','.join(columns).encode('utf-8')).hexdigest()[:12]
+
+
+def probe_file(path: str, quick_check: bool = False) -> dict:
+    """Read a file's header and, for SQLite files, its attendance schema (read-only)."""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(len(LFS_POINTER_PREFIX))
+    except OSError:
+        return {'status': 'unreadable', 'attendance_schema': None, 'quick_check': None}
+    if not header.startswith(SQLITE_HEADER):
+        status = 'lfs_pointer' if header == LFS_POINTER_PREFIX else 'not_sqlite'
+        return {'status': status, 'attendance_schema': None, 'quick_check': None}
+
+    entry = {'status': VALID, 'attendance_schema': None, 'quick_check': None}
+    try:
+        conn = connect_read_only(path)
+        try:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(attendance)')]
+            entry['attendance_schema'] = attendance_schema(columns)
+            if quick_check:
+                result = conn.execute('PRAGMA quick_check').fetchone()[0]
+                entry['quick_check'] = result
+                if result != 'ok':
+                    entry['status'] = 'corrupt'
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        entry['status'] = 'unreadable'
+    return entry
+
+
+def validate_file(cache: dict, path: str, quick_check: bool = False) -> dict:
+    """
+    Return the cached verdict for `path` if its size and mtime (or, failing that,
+    its SHA-256) are unchanged, otherwise probe it (with PRAGMA quick_check in deep
+    mode) and cache the result.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {'status': 'unreadable', 'attendance_schema': None, 'quick_check': None}
+    key = _cache_key(cache['path'], path)
+    entry = cache['files'].get(key)
+    if entry is not None and entry['size'] == stat.st_size and entry.get('mtime') == stat.st_mtime:
+        return entry
+    try:
+        sha256 = file_sha256(path)
+    except OSError:
+        sha256 = None
+    if entry is not None and entry['size'] == stat.st_size and sha256 and entry.get('sha256') == sha256:
+        entry['mtime'] = stat.st_mtime
+        return entry
+
+    entry = probe_file(path, quick_check)
+    entry['size'] = stat.st_size
+    entry['mtime'] = stat.st_mtime
+    entry['sha256'] = sha256
+    cache['files'][key] = entry
+    cache['probed'] += 1
+    return entry
+
+
+def is_valid(entry: dict) -> bool:
+    return entry['status'] == VALID
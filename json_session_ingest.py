@@ -0,0 +1,409 @@
+"""
+JSON Session Export Ingester
+
+user_session_history/ also holds per-account JSON exports from the app
+(<hashed email>.json: user_email, user_id, ..., sessions[] -> scans[]). This
+script converts them into session DBs with the same attendance schema as the
+converted Excel files (excel_to_db_github.DB_SCHEMA), so merge_user_sessions.py
+can merge them like any other session file:
+
+- each export is read incrementally (one session object at a time), never as a
+  whole document
+- the account is resolved to a user through the userID-email lookup (hashed email),
+  falling back to the Developer placeholder like excel_to_db_github.py
+- every export gets one DB, merge_state/json_sessions/<export>_<user_id>.db
+- ingestion is idempotent by session id: a session is only (re)written when it is
+  new or its content changed, replacing that session's rows; unchanged exports are
+  skipped without being read (merge_state/json_session_ingest_manifest.json)
+
+Local log_date / log_time are derived from each scan's UTC timestamp; the UTC offset
+comes from the scan's formattedTime (24h or 12h, depending on the device locale), or
+from the session's formattedDateTime when that can't be parsed.
+
+Usage:
+    python json_session_ingest.py [--workers N]
+    python merge_user_sessions.py --json-exports     # ingest, then merge
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+from excel_to_db_github import DB_SCHEMA, INSERT_SQL, load_user_lookup, resolve_user
+from sqlite_profiles import connect as connect_db, restore_durable
+from source_manifest import MANIFEST_DIR, load_manifest, save_manifest, unchanged_entry, record_file, prune_manifest
+
+EXPORT_DIR = 'user_session_history'
+INGEST_DIR = os.path.join(MANIFEST_DIR, 'json_sessions')
+INGEST_MANIFEST_PATH = os.path.join(MANIFEST_DIR, 'json_session_ingest_manifest.json')
+LOOKUP_PATH = 'userID-email.xlsx'
+
+# Characters read from an export at a time (grown while a single value doesn't fit)
+READ_CHUNK_SIZE = 64 * 1024
+
+# UTC offsets are rounded to whole quarter hours
+OFFSET_STEP = timedelta(minutes=15)
+
+LOCAL_DATETIME_FORMATS = ('%d/%m/%Y %H:%M:%S', '%m/%d/%Y %I:%M %p', '%d/%m/%Y %H:%M')
+LOCAL_TIME_FORMATS = ('%H:%M:%S', '%I:%M %p', '%H:%M')
+
+
+class _JsonStream:
+    """Reads JSON values one at a time from a text file, keeping only a window of it in memory"""
+
+    def __init__(self, f):
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self, size):
+        if self.pos > READ_CHUNK_SIZE:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.f.read(size)
+        self.eof = not chunk
+        self.buf += chunk
+
+    def peek(self):
+        """Next non-whitespace character (not consumed), '' at the end of the file"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._read(READ_CHUNK_SIZE)
+
+    def take(self, expected):
+        char = self.peek()
+        if char not in expected:
+            raise ValueError(f"expected one of {expected!r} at offset {self.pos}, found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next complete JSON value"""
+        while True:
+            self.peek()
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A value ending exactly at the buffer's end may be cut short (e.g. a number)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read(max(READ_CHUNK_SIZE, len(self.buf) - self.pos))
+
+
+def iter_export(json_path):
+    """
+    Yield ('field', key, value) for each top-level field of an export and
+    ('session', session) for each element of its sessions array, in file order.
+    """
+    with open(json_path, 'r', encoding='utf-8-sig') as f:
+        stream = _JsonStream(f)
+        stream.take('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            stream.take(':')
+            if key == 'sessions' and stream.peek() == '[':
+                stream.take('[')
+                if stream.peek() != ']':
+                    while True:
+                        yield 'session', stream.value()
+                        if stream.take(',]') == ']':
+                            break
+                else:
+                    stream.take(']')
+            else:
+                yield 'field', key, stream.value()
+            if stream.take(',}') == '}':
+                return
+
+
+def session_fingerprint(session):
+    """Short hash of a session's content; a changed fingerprint means it is re-ingested"""
+    text = json.dumps(session, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+
+def _parse_utc(value):
+    try:
+        return datetime.strptime(str(value)[:19], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+
+
+def _parse_local(value, formats):
+    # Some locales put a narrow no-break space before AM/PM
+    text = str(value or '').replace('\u202f', ' ').strip()
+    for fmt in formats:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _round_offset(delta):
+    return OFFSET_STEP * round(delta / OFFSET_STEP)
+
+
+def session_offset(session):
+    """UTC offset of the device when the session started (None if unknown)"""
+    started = _parse_utc(session.get('dateTime'))
+    local = _parse_local(session.get('formattedDateTime'), LOCAL_DATETIME_FORMATS)
+    if started is None or local is None:
+        return None
+    return _round_offset(local - started)
+
+
+def scan_offset(scanned, formatted_time, default):
+    """UTC offset at a scan, from its local formattedTime (the time of day only)"""
+    local = _parse_local(formatted_time, LOCAL_TIME_FORMATS)
+    if local is None:
+        return default
+    delta = _round_offset(datetime.combine(scanned.date(), local.time()) - scanned)
+    # Time of day only: bring the offset into -12h..+14h
+    if delta > timedelta(hours=14):
+        delta -= timedelta(days=1)
+    elif delta < timedelta(hours=-12):
+        delta += timedelta(days=1)
+    return delta
+
+
+def _session_type(session):
+    session_type = session.get('sessionType')
+    if not session_type:
+        match = re.match(r'[a-z]+', str(session.get('id', '')))
+        session_type = match.group(0) if match else ''
+    return session_type
+
+
+def _flag(value):
+    return 1 if value else 0
+
+
+def session_rows(session, user):
+    """
+    Attendance rows (tuples in INSERT_SQL column order) for one exported session.
+    Scans without a student or a readable timestamp are dropped, as are repeated
+    scans of a student at the same second.
+    """
+    session_type = _session_type(session)
+    default_offset = session_offset(session)
+    year = session.get('year')
+    try:
+        year = int(year) if year not in (None, '') else None
+    except (TypeError, ValueError):
+        year = None
+    backed_up = _flag(session.get('backedUp'))
+
+    rows = []
+    seen = set()
+    for scan in session.get('scans') or []:
+        student_id = str(scan.get('content') or '').strip()
+        scanned = _parse_utc(scan.get('timestamp') or scan.get('time'))
+        if not student_id or scanned is None:
+            continue
+        offset = scan_offset(scanned, scan.get('formattedTime'), default_offset or timedelta(0))
+        local = scanned + offset
+        log_date = local.strftime('%d/%m/%Y')
+        log_time = local.strftime('%H:%M:%S')
+        if (student_id, log_date, log_time) in seen:
+            continue
+        seen.add((student_id, log_date, log_time))
+        rows.append((
+            str(session['id']),
+            session.get('location'),
+            session.get('dateTime'),
+            _flag(session.get('inProgress')),
+            year,
+            None if session.get('batch') is None else str(session.get('batch')),
+            _flag(session.get('isChecklist', session_type == 'checklist')),
+            _flag(session.get('isScanner', session_type == 'scanner')),
+            _flag(session_type == 'excuses'),
+            _flag(session_type == 'edited'),
+            backed_up,
+            1,  # came from the account's own backup
+            backed_up,
+            session.get('backupTimestamp') or session.get('updated_at'),
+            student_id,
+            scan.get('timestamp') or scan.get('time'),
+            log_date,
+            log_time,
+            _flag(scan.get('isManual')),
+            session.get('created_at'),
+            session.get('updated_at'),
+            None,
+            user['user_name'],
+            user['user_id'],
+            user['division'],
+            user['department'],
+        ))
+    return rows
+
+
+def ingest_export(json_path, out_dir, lookup, previous, other_sessions):
+    """
+    Stream one export into its session DB in out_dir.
+    previous is this export's manifest entry from the last run (or None); sessions
+    whose fingerprint is unchanged there, or that another export already provided
+    (other_sessions, {session id: export path}), are skipped.
+    Returns {'path', 'db', 'sessions', 'rows', 'written', 'output'}.
+    """
+    output = io.StringIO()
+    with redirect_stdout(output):
+        result = _ingest_export(json_path, out_dir, lookup, previous or {}, other_sessions)
+    result['output'] = output.getvalue()
+    return result
+
+
+def _ingest_export(json_path, out_dir, lookup, previous, other_sessions):
+    name = os.path.basename(json_path)
+    stem = os.path.splitext(name)[0]
+    sessions = dict(previous.get('sessions') or {})
+    result = {'path': json_path, 'db': previous.get('db'), 'sessions': sessions, 'rows': 0, 'written': 0}
+    user = None
+    conn = None
+    try:
+        for event in iter_export(json_path):
+            if event[0] == 'field':
+                if event[1] == 'user_email' and user is None:
+                    user = resolve_user(str(event[2] or ''), lookup)
+                continue
+            session = event[1]
+            session_id = session.get('id') if isinstance(session, dict) else None
+            if not session_id:
+                continue
+            if user is None:
+                # user_email normally comes first; the export is named after the same hash
+                user = resolve_user(stem, lookup)
+
+            if conn is None:
+                db_path = os.path.join(out_dir, f"{stem}_{user['user_id']}.db")
+                if result['db'] != db_path:
+                    # First run, or the account now resolves to another user: start over
+                    if result['db'] and os.path.exists(result['db']):
+                        os.remove(result['db'])
+                    sessions.clear()
+                    result['db'] = db_path
+                os.makedirs(out_dir, exist_ok=True)
+                conn = connect_db(db_path)
+                conn.executescript(DB_SCHEMA)
+
+            fingerprint = session_fingerprint(session)
+            owner = other_sessions.get(session_id)
+            if sessions.get(session_id) == fingerprint or owner not in (None, os.path.normpath(json_path)):
+                continue
+            rows = session_rows(session, user)
+            with conn:
+                conn.execute("DELETE FROM attendance WHERE sessionId = ?", (session_id,))
+                conn.executemany(INSERT_SQL, rows)
+            sessions[session_id] = fingerprint
+            result['written'] += 1
+    except (OSError, ValueError) as e:
+        print(f"  ✗ {name}: {e}")
+        result['error'] = str(e)
+    finally:
+        if conn is not None:
+            result['rows'] = conn.execute("SELECT COUNT(*) FROM attendance").fetchone()[0]
+            conn.close()
+            restore_durable([result['db']])
+
+    if 'error' not in result:
+        db_name = os.path.basename(result['db']) if result['db'] else 'no sessions'
+        print(f"  ✓ {name} → {db_name}: {result['written']} new or changed session(s), {result['rows']} records")
+    return result
+
+
+def _ingest_export_job(job):
+    """ProcessPoolExecutor entry point for ingest_export"""
+    return ingest_export(*job)
+
+
+def list_exports(export_dir=EXPORT_DIR):
+    try:
+        filenames = sorted(os.listdir(export_dir))
+    except OSError:
+        return []
+    return [os.path.join(export_dir, f) for f in filenames if f.endswith('.json')]
+
+
+def ingest_exports(export_dir=EXPORT_DIR, out_dir=INGEST_DIR, lookup_path=LOOKUP_PATH, workers=1):
+    """
+    Convert every new or changed JSON export in export_dir into session DBs in out_dir.
+    With workers > 1, exports are streamed in parallel worker processes.
+    Returns the number of sessions written.
+    """
+    manifest = load_manifest(INGEST_MANIFEST_PATH)
+    exports = list_exports(export_dir)
+    changed = [p for p in exports if unchanged_entry(manifest, p) is None]
+    print(f"Found {len(exports)} JSON export(s), {len(changed)} new or changed")
+    if not changed:
+        return 0
+
+    try:
+        lookup = load_user_lookup(lookup_path)
+    except Exception as e:
+        print(f"  ⚠ Cannot load user lookup {lookup_path} ({e}); exports are ingested as the Developer user")
+        lookup = {}
+
+    # A session id belongs to the first export (in name order) that provided it
+    owners = {}
+    for path in sorted(manifest):
+        for session_id in manifest[path].get('sessions') or {}:
+            owners.setdefault(session_id, path)
+    jobs = [
+        (path, out_dir, lookup, manifest.get(os.path.normpath(path)), owners)
+        for path in changed
+    ]
+
+    if workers > 1 and len(jobs) > 1:
+        print(f"Ingesting exports on {workers} worker processes...")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_ingest_export_job, jobs))
+    else:
+        results = [ingest_export(*job) for job in jobs]
+
+    written = 0
+    for result in results:
+        print(result['output'], end='')
+        if 'error' in result:
+            continue
+        entry = record_file(manifest, result['path'], result['rows'])
+        entry['db'] = result['db']
+        entry['sessions'] = result['sessions']
+        written += result['written']
+
+    prune_manifest(manifest)
+    save_manifest(INGEST_MANIFEST_PATH, manifest)
+    print(f"→ Ingested {written} new or changed session(s) from {len(changed)} export(s)")
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert JSON session exports into session DBs for merge_user_sessions.py.")
+    parser.add_argument("--dir", default=EXPORT_DIR, help=f"Directory with the JSON exports (default: {EXPORT_DIR}).")
+    parser.add_argument("--out", default=INGEST_DIR, help=f"Where to write the session DBs (default: {INGEST_DIR}).")
+    parser.add_argument("--lookup", default=LOOKUP_PATH, help=f"userID-email lookup file (default: {LOOKUP_PATH}).")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes (default: 1).")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    ingest_exports(args.dir, args.out, args.lookup, args.workers)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,14 +10,52 @@ Records older than 3 years (based on scanTime) are permanently deleted.
 
 IMPORTANT: Record age is determined by the 'scanTime' field (ISO format timestamp),
 NOT by 'log_date' (which represents the batch/academic year).
+
+With --partitioned, records are also archived in monthly partition files
+(log_archive/YYYY-MM.db, listed in log_archive/catalog.json). Retention then
+drops whole partition files, log_history.db is rebuilt from the partitions
+of the last 6 months only, and log_deleted.db is no longer rewritten.
+
+With --incremental, the merged records are kept in a persisted store
+(merge_state/merged_store.db) together with a watermark per source file
+(size, mtime, SHA-256, max id / max scanTime). Each run then only reads
+source files that are new or changed since the previous run. The store is
+not committed (see .gitignore): it needs a persistent working copy, and the
+daily workflow carries it between runs in the GitHub Actions cache (a missing
+store is simply rebuilt from all sources).
+
+With --stable-output, the output databases keep their row ids between runs
+and are only rewritten when their contents change.
+
+With --workers N, source databases are read on N threads during the merge
+while a single writer inserts their rows in source order.
+
+With --plan, nothing is merged or written: the run only logs the work it would
+do (files to read, rows to merge and dedup, records aged out and moved, output
+sizes), estimated from file metadata, the watermarks and COUNT queries.
+
+Every run writes per-step metrics (wall time, rows in/out, bytes read/written,
+files skipped; files_found for the collect step and files_deleted for the cleanup
+step) to merge_state/manage_logs_report.json, also when the run stops early or
+fails; --summary also logs them as a table. The report changes on every run, so
+it is not committed (see .gitignore); the workflow uploads it as an artifact.
 """
 
 import sqlite3
 import os
 import shutil
+import argparse
+import json
+import filecmp
 from datetime import datetime, timedelta, timezone
-from pathlib import Path
 import subprocess
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlite_profiles import DURABLE, connect as connect_db, connect_read_only, read_only_uri, restore_durable
+from source_manifest import file_sha256
 
 # Configuration
 LOG_HISTORY_DIR = 'log_history'
@@ -25,6 +63,86 @@ LOG_DELETED_DIR = 'log_deleted'
 USER_SESSION_DIR = 'user_session_history'
 PROCESSED_ARCHIVE_DIR = 'archive/processed_logs'
 
+# --stable-output: outputs keep row ids between runs, new rows are added in this
+# order, and files are VACUUMed with a fixed page size so unchanged data gives
+# byte-identical files (and no git churn)
+OUTPUT_PAGE_SIZE = 4096
+DEDUP_KEY_COLUMNS = ('student_id', 'subject', 'log_date', 'log_time')
+STABLE_OUTPUT_ORDER = ('scanTime', 'student_id', 'subject', 'log_date', 'log_time', 'sessionId')
+
+# Incremental mode: persisted merged store (kept between runs) with a
+# per-source watermark table, so only new or changed source files are read.
+MERGE_STATE_DIR = 'merge_state'
+MERGED_STORE_PATH = os.path.join(MERGE_STATE_DIR, 'merged_store.db')
+
+# Machine-readable metrics of the last run (per step: wall time, rows, bytes, skips)
+RUN_REPORT_PATH = os.path.join(MERGE_STATE_DIR, 'manage_logs_report.json')
+
+# Partitioned mode: records archived in monthly files (log_archive/YYYY-MM.db,
+# keyed on scanTime) listed in a small catalog. Retention drops whole files.
+LOG_ARCHIVE_DIR = 'log_archive'
+PARTITION_CATALOG_NAME = 'catalog.json'
+# Records dated after the current month (device clock errors) share one partition.
+# The name sorts after every 'YYYY-MM' key, so it is always part of "recent" reads.
+FUTURE_PARTITION = 'future'
+
+# Rows handed from the source readers to the single writer per executemany call
+# when merging with --workers > 1
+MERGE_BATCH_SIZE = 5000
+
+# Schema shared by the merged database(s) and the two output databases
+ATTENDANCE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS attendance (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        student_id INTEGER NOT NULL,
+        subject TEXT NOT NULL,
+        log_date TEXT NOT NULL,
+        log_time TEXT NOT NULL,
+        sessionId TEXT NOT NULL,
+        dateTime TEXT NOT NULL,
+        inProgress INTEGER NOT NULL,
+        isChecklist INTEGER NOT NULL,
+        isScanner INTEGER NOT NULL,
+        isExcused INTEGER NOT NULL,
+        isEdited INTEGER NOT NULL,
+        backedUp INTEGER NOT NULL,
+        personalBackedUp INTEGER NOT NULL,
+        synced INTEGER NOT NULL,
+        syncedAt TEXT NOT NULL,
+        year INTEGER NOT NULL,
+        batch TEXT NOT NULL,
+        scanTime TEXT NOT NULL,
+        isManual INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        notes TEXT,
+        user_name TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        division TEXT NOT NULL,
+        department TEXT NOT NULL
+    )
+'''
+
+# Dedup key of the merged table: a row whose key is already present is ignored
+# at insert time, so the first occurrence (in source order) wins.
+DEDUP_INDEX_SQL = '''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_dedup_key
+    ON attendance(student_id, subject, log_date, log_time)
+'''
+
+# One row per source file already ingested into the merged store
+SOURCE_WATERMARKS_SQL = '''
+    CREATE TABLE IF NOT EXISTS _source_watermarks (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        sha256 TEXT NOT NULL,
+        max_id INTEGER,
+        max_scan_time TEXT,
+        updated_at TEXT NOT NULL
+    )
+'''
+
 # Time thresholds (UTC for record-age cutoffs; local time for file safety buffer)
 SIX_MONTHS_AGO = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=180)
 THREE_YEARS_AGO = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=1095)
@@ -50,7 +168,8 @@ def get_db_files(directory, apply_timestamp_filter=False):
     #     now_local = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     #     log(f"  Applying 5-minute safety buffer. Current time (local): {now_local}, Cutoff: {five_min_ago.strftime('%Y-%m-%d %H:%M:%S')}")
     
-    for filename in os.listdir(directory):
+    # Sorted so sources are always merged in the same order ("first occurrence wins")
+    for filename in sorted(os.listdir(directory)):
         if not filename.endswith('.db'):
             continue
         
@@ -78,47 +197,14 @@ def create_temporary_merged_db():
     if os.path.exists(temp_db_path):
         os.remove(temp_db_path)
     
-    conn = sqlite3.connect(temp_db_path)
+    conn = connect_db(temp_db_path)
     cursor = conn.cursor()
     
     # Create attendance table with all columns
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS attendance (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            student_id INTEGER NOT NULL,
-            subject TEXT NOT NULL,
-            log_date TEXT NOT NULL,
-            log_time TEXT NOT NULL,
-            sessionId TEXT NOT NULL,
-            dateTime TEXT NOT NULL,
-            inProgress INTEGER NOT NULL,
-            isChecklist INTEGER NOT NULL,
-            isScanner INTEGER NOT NULL,
-            isExcused INTEGER NOT NULL,
-            isEdited INTEGER NOT NULL,
-            backedUp INTEGER NOT NULL,
-            personalBackedUp INTEGER NOT NULL,
-            synced INTEGER NOT NULL,
-            syncedAt TEXT NOT NULL,
-            year INTEGER NOT NULL,
-            batch TEXT NOT NULL,
-            scanTime TEXT NOT NULL,
-            isManual INTEGER NOT NULL,
-            created_at TEXT NOT NULL,
-            updated_at TEXT NOT NULL,
-            notes TEXT,
-            user_name TEXT NOT NULL,
-            user_id TEXT NOT NULL,
-            division TEXT NOT NULL,
-            department TEXT NOT NULL
-        )
-    ''')
+    cursor.execute(ATTENDANCE_TABLE_SQL)
     
-    # Create index for deduplication
-    cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_dedup 
-        ON attendance(student_id, subject, log_date, log_time)
-    ''')
+    # Unique index for deduplication (duplicates are ignored on insert)
+    cursor.execute(DEDUP_INDEX_SQL)
     
     conn.commit()
     conn.close()
@@ -126,17 +212,125 @@ def create_temporary_merged_db():
     log(f"Created temporary database: {temp_db_path}")
     return temp_db_path
 
-def merge_database_into_temp(source_db_path, temp_db_path):
-    """Merge records from source database into temporary database"""
+def _log_merge_result(source_db_path, inserted_count, duplicates_ignored, null_datetime_skipped, other_errors):
+    """Report how many rows a source contributed and why any were skipped"""
+    log(f"  Merged {inserted_count} records from {os.path.basename(source_db_path)}")
+    if duplicates_ignored:
+        log(f"  Ignored {duplicates_ignored} duplicate(s) already in the merged table")
+    if null_datetime_skipped:
+        log(f"  Skipped {null_datetime_skipped} rows with NULL dateTime (bad conversion) -- re-run excel_to_db_github.py to fix")
+    for err_msg, count in other_errors.items():
+        log(f"  Skipped {count} row(s) due to: {err_msg}")
+
+def bulk_merge_database_into_temp(source_db_path, temp_db_path, since_id=None):
+    """Merge records from source database into temporary database with one INSERT ... SELECT.
+
+    The source is ATTACHed to the temporary database, so rows never pass through Python.
+    Rows that would violate a NOT NULL column of the merged table are filtered out by the
+    SELECT and counted per column (first NULL column in table order, as SQLite reports it),
+    which keeps the same skip reporting as the row-by-row path.
+    Raises sqlite3.Error on failure; merge_database_into_temp handles the fallback."""
+    temp_conn = connect_db(temp_db_path)
+    try:
+        cursor = temp_conn.cursor()
+        cursor.execute('ATTACH DATABASE ? AS src', (source_db_path,))
+
+        cursor.execute('PRAGMA src.table_info(attendance)')
+        source_columns = [col[1] for col in cursor.fetchall()]
+        if not source_columns:
+            raise sqlite3.OperationalError('no such table: attendance')
+        columns = [c for c in source_columns if c != 'id']
+
+        # NOT NULL columns of the merged table that the source provides, in table order
+        cursor.execute('PRAGMA main.table_info(attendance)')
+        required = [col[1] for col in cursor.fetchall() if col[3] and col[1] != 'id' and col[1] in columns]
+
+        conditions = []
+        params = []
+        if since_id is not None:
+            conditions.append('id > ?')
+            params.append(since_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        null_datetime_skipped = 0
+        other_errors = {}
+        candidates = None
+        if required:
+            first_null = ' '.join(f"WHEN {c} IS NULL THEN '{c}'" for c in required)
+            cursor.execute(f'''
+                SELECT first_null, COUNT(*) FROM (
+                    SELECT CASE {first_null} END AS first_null FROM src.attendance {where}
+                )
+                GROUP BY first_null
+            ''', params)
+            for column, count in cursor.fetchall():
+                if column is None:
+                    candidates = count
+                elif column == 'dateTime':
+                    null_datetime_skipped = count
+                else:
+                    other_errors[f"NOT NULL constraint failed: attendance.{column}"] = count
+            conditions.extend(f'{c} IS NOT NULL' for c in required)
+            where = f"WHERE {' AND '.join(conditions)}"
+
+        if candidates is None:
+            cursor.execute(f'SELECT COUNT(*) FROM src.attendance {where}', params)
+            candidates = cursor.fetchone()[0]
+
+        # Keep source order so "first occurrence wins"; rows whose dedup key is
+        # already present are ignored by the unique index
+        order = 'ORDER BY id' if 'id' in source_columns else ''
+        column_list = ','.join(columns)
+        cursor.execute(
+            f'INSERT OR IGNORE INTO main.attendance ({column_list}) SELECT {column_list} FROM src.attendance {where} {order}',
+            params,
+        )
+        inserted_count = cursor.rowcount
+        temp_conn.commit()
+        cursor.execute('DETACH DATABASE src')
+    except sqlite3.Error:
+        temp_conn.rollback()
+        raise
+    finally:
+        temp_conn.close()
+
+    if candidates == 0 and not null_datetime_skipped and not other_errors:
+        log(f"  No records found in {os.path.basename(source_db_path)}")
+        return 0
+
+    _log_merge_result(source_db_path, inserted_count, candidates - inserted_count,
+                      null_datetime_skipped, other_errors)
+    return inserted_count
+
+def merge_database_into_temp(source_db_path, temp_db_path, since_id=None):
+    """Merge records from source database into temporary database.
+    If since_id is given, only rows with id > since_id are read (incremental mode).
+    Uses the ATTACH-based bulk copy, falling back to row-by-row inserts if the bulk
+    statement is rejected."""
+    try:
+        return bulk_merge_database_into_temp(source_db_path, temp_db_path, since_id)
+    except sqlite3.IntegrityError as e:
+        log(f"  Bulk copy of {os.path.basename(source_db_path)} rejected ({e}), merging row by row")
+    except Exception as e:
+        log(f"  ERROR merging {source_db_path}: {e}")
+        return 0
+    return merge_database_rows_into_temp(source_db_path, temp_db_path, since_id)
+
+def merge_database_rows_into_temp(source_db_path, temp_db_path, since_id=None):
+    """Merge records from source database into temporary database one row at a time,
+    catching IntegrityError per row. Fallback for merge_database_into_temp."""
     try:
         source_conn = sqlite3.connect(source_db_path)
-        temp_conn = sqlite3.connect(temp_db_path)
+        temp_conn = connect_db(temp_db_path)
         
         source_cursor = source_conn.cursor()
         temp_cursor = temp_conn.cursor()
         
-        # Get all records from source
-        source_cursor.execute('SELECT * FROM attendance')
+        # Get all records from source (or only the ones appended since the last run)
+        if since_id is None:
+            source_cursor.execute('SELECT * FROM attendance')
+        else:
+            source_cursor.execute('SELECT * FROM attendance WHERE id > ?', (since_id,))
         records = source_cursor.fetchall()
         
         if not records:
@@ -154,6 +348,7 @@ def merge_database_into_temp(source_db_path, temp_db_path):
         insert_query = f'INSERT INTO attendance ({",".join(columns)}) VALUES ({placeholders})'
         
         inserted_count = 0
+        duplicates_ignored = 0
         null_datetime_skipped = 0
         other_errors = {}
         for record in records:
@@ -165,7 +360,9 @@ def merge_database_into_temp(source_db_path, temp_db_path):
                 inserted_count += 1
             except sqlite3.IntegrityError as e:
                 err_msg = str(e)
-                if "NOT NULL constraint failed: attendance.dateTime" in err_msg:
+                if err_msg.startswith("UNIQUE constraint failed"):
+                    duplicates_ignored += 1
+                elif "NOT NULL constraint failed: attendance.dateTime" in err_msg:
                     null_datetime_skipped += 1
                 else:
                     other_errors[err_msg] = other_errors.get(err_msg, 0) + 1
@@ -176,20 +373,309 @@ def merge_database_into_temp(source_db_path, temp_db_path):
         source_conn.close()
         temp_conn.close()
 
-        log(f"  Merged {inserted_count} records from {os.path.basename(source_db_path)}")
-        if null_datetime_skipped:
-            log(f"  Skipped {null_datetime_skipped} rows with NULL dateTime (bad conversion) -- re-run excel_to_db_github.py to fix")
-        for err_msg, count in other_errors.items():
-            log(f"  Skipped {count} row(s) due to: {err_msg}")
+        _log_merge_result(source_db_path, inserted_count, duplicates_ignored,
+                          null_datetime_skipped, other_errors)
         return inserted_count
         
     except Exception as e:
         log(f"  ERROR merging {source_db_path}: {e}")
         return 0
 
-def remove_duplicates(db_path):
-    """Remove duplicate records based on student_id, subject, log_date, log_time"""
+def read_source_rows(source_db_path, required_columns, since_id=None):
+    """Read one source's attendance rows for a parallel merge (runs in a worker thread).
+
+    The source is opened read-only; rows that would violate a NOT NULL column of the
+    merged table are filtered out and counted exactly as in bulk_merge_database_into_temp.
+    Returns a dict with the column names, the rows in id order and the skip counts, or
+    with 'error' set if the source can't be read."""
+    result = {'path': source_db_path, 'columns': [], 'rows': [],
+              'null_datetime_skipped': 0, 'other_errors': {}, 'error': None}
+    try:
+        conn = connect_read_only(source_db_path)
+    except sqlite3.Error as e:
+        result['error'] = str(e)
+        return result
+    try:
+        cursor = conn.cursor()
+        cursor.execute('PRAGMA table_info(attendance)')
+        source_columns = [col[1] for col in cursor.fetchall()]
+        if not source_columns:
+            raise sqlite3.OperationalError('no such table: attendance')
+        columns = [c for c in source_columns if c != 'id']
+        required = [c for c in required_columns if c in columns]
+
+        conditions = []
+        params = []
+        if since_id is not None:
+            conditions.append('id > ?')
+            params.append(since_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        if required:
+            first_null = ' '.join(f"WHEN {c} IS NULL THEN '{c}'" for c in required)
+            cursor.execute(f'''
+                SELECT first_null, COUNT(*) FROM (
+                    SELECT CASE {first_null} END AS first_null FROM attendance {where}
+                )
+                WHERE first_null IS NOT NULL
+                GROUP BY first_null
+            ''', params)
+            for column, count in cursor.fetchall():
+                if column == 'dateTime':
+                    result['null_datetime_skipped'] = count
+                else:
+                    result['other_errors'][f"NOT NULL constraint failed: attendance.{column}"] = count
+            conditions.extend(f'{c} IS NOT NULL' for c in required)
+            where = f"WHERE {' AND '.join(conditions)}"
+
+        order = 'ORDER BY id' if 'id' in source_columns else ''
+        cursor.execute(f"SELECT {','.join(columns)} FROM attendance {where} {order}", params)
+        result['columns'] = columns
+        result['rows'] = cursor.fetchall()
+    except sqlite3.Error as e:
+        result['error'] = str(e)
+    finally:
+        conn.close()
+    return result
+
+def write_source_rows(temp_conn, result):
+    """Insert the rows read by read_source_rows into the merged table in MERGE_BATCH_SIZE
+    batches (single writer; duplicates are ignored by the unique dedup key).
+    Returns the number of rows inserted."""
+    source_db_path = result['path']
+    if result['error']:
+        log(f"  ERROR merging {source_db_path}: {result['error']}")
+        return 0
+
+    rows = result['rows']
+    if not rows and not result['null_datetime_skipped'] and not result['other_errors']:
+        log(f"  No records found in {os.path.basename(source_db_path)}")
+        return 0
+
+    column_list = ','.join(result['columns'])
+    placeholders = ','.join('?' * len(result['columns']))
+    sql = f'INSERT OR IGNORE INTO attendance ({column_list}) VALUES ({placeholders})'
+    changes_before = temp_conn.total_changes
+    try:
+        for start in range(0, len(rows), MERGE_BATCH_SIZE):
+            temp_conn.executemany(sql, rows[start:start + MERGE_BATCH_SIZE])
+        temp_conn.commit()
+    except sqlite3.Error as e:
+        temp_conn.rollback()
+        log(f"  ERROR merging {source_db_path}: {e}")
+        return 0
+    inserted_count = temp_conn.total_changes - changes_before
+
+    _log_merge_result(source_db_path, inserted_count, len(rows) - inserted_count,
+                      result['null_datetime_skipped'], result['other_errors'])
+    return inserted_count
+
+def merge_sources_parallel(sources, temp_db_path, workers):
+    """Merge (path, since_id) pairs into the temporary database, reading sources on a
+    pool of `workers` threads while this thread is the only writer.
+
+    Results are written strictly in the order of `sources`, so the first source holding
+    a dedup key still wins and the merged table matches a serial run. At most
+    2 x workers sources are held in memory at once.
+    Returns the number of records merged."""
+    if not sources:
+        return 0
+    temp_conn = connect_db(temp_db_path)
+    try:
+        required_columns = [
+            col[1] for col in temp_conn.execute('PRAGMA table_info(attendance)') if col[3] and col[1] != 'id'
+        ]
+        total_merged = 0
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for path, since_id in sources:
+                pending.append(pool.submit(read_source_rows, path, required_columns, since_id))
+                if len(pending) >= 2 * workers:
+                    total_merged += write_source_rows(temp_conn, pending.popleft().result())
+            while pending:
+                total_merged += write_source_rows(temp_conn, pending.popleft().result())
+    finally:
+        temp_conn.close()
+    return total_merged
+
+def merge_sources(sources, temp_db_path, workers=1):
+    """Merge (path, since_id) pairs into the temporary database in order, serially
+    with the ATTACH-based copy or, with workers > 1, through merge_sources_parallel.
+    Returns the number of records merged."""
+    if workers > 1:
+        return merge_sources_parallel(sources, temp_db_path, workers)
+    return sum(merge_database_into_temp(path, temp_db_path, since_id) for path, since_id in sources)
+
+def open_merged_store(store_path=MERGED_STORE_PATH):
+    """Create (if needed) the persisted merged store used by incremental mode"""
+    store_dir = os.path.dirname(store_path)
+    if store_dir:
+        os.makedirs(store_dir, exist_ok=True)
+
+    is_new = not os.path.exists(store_path)
+    conn = connect_db(store_path, DURABLE)
+    cursor = conn.cursor()
+    cursor.execute(ATTENDANCE_TABLE_SQL)
+    cursor.execute(SOURCE_WATERMARKS_SQL)
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_dedup_key'")
+    has_unique_index = cursor.fetchone() is not None
+    conn.commit()
+    conn.close()
+
+    if not has_unique_index:
+        # Store written before dedup moved to insert time: clean it up once
+        remove_duplicates(store_path)
+        conn = connect_db(store_path)
+        conn.execute('DROP INDEX IF EXISTS idx_dedup')
+        conn.execute(DEDUP_INDEX_SQL)
+        conn.commit()
+        conn.close()
+
+    if is_new:
+        log(f"Created merged store: {store_path} (first incremental run reads every source)")
+    else:
+        log(f"Using merged store: {store_path}")
+    return store_path
+
+def read_source_extent(source_db_path, up_to_id=None):
+    """Return (max id, max scanTime) of a source's attendance table, or (None, None).
+    If up_to_id is given, max scanTime is computed over rows with id <= up_to_id only."""
+    try:
+        conn = sqlite3.connect(source_db_path)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT MAX(id), MAX(scanTime) FROM attendance')
+            max_id, max_scan_time = cursor.fetchone()
+            if up_to_id is not None:
+                cursor.execute('SELECT MAX(scanTime) FROM attendance WHERE id <= ?', (up_to_id,))
+                max_scan_time = cursor.fetchone()[0]
+            return max_id, max_scan_time
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None, None
+
+def load_source_watermarks(store_path):
+    """Return {path: watermark dict} for every source recorded in the merged store"""
+    conn = sqlite3.connect(store_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute('SELECT * FROM _source_watermarks').fetchall()
+    finally:
+        conn.close()
+    return {row['path']: dict(row) for row in rows}
+
+def save_source_watermark(store_path, source_path, size, mtime, sha256, max_id, max_scan_time):
+    """Insert or replace the watermark of one source file"""
+    conn = connect_db(store_path, DURABLE)
+    try:
+        conn.execute('''
+            INSERT OR REPLACE INTO _source_watermarks
+                (path, size, mtime, sha256, max_id, max_scan_time, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (os.path.normpath(source_path), size, mtime, sha256, max_id, max_scan_time,
+              datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')))
+        conn.commit()
+    finally:
+        conn.close()
+
+def record_source_watermarks(store_path, source_paths):
+    """Mark files as already ingested (used for the outputs this script writes itself).
+    Outputs left untouched (see --stable-output) keep their watermark as is."""
+    watermarks = load_source_watermarks(store_path)
+    for path in source_paths:
+        if not os.path.exists(path):
+            continue
+        stat = os.stat(path)
+        mark = watermarks.get(os.path.normpath(path))
+        if mark and mark['size'] == stat.st_size and mark['mtime'] == stat.st_mtime:
+            continue
+        max_id, max_scan_time = read_source_extent(path)
+        save_source_watermark(store_path, path, stat.st_size, stat.st_mtime,
+                              file_sha256(path), max_id, max_scan_time)
+
+def prune_source_watermarks(store_path):
+    """Forget watermarks of source files that no longer exist"""
+    conn = connect_db(store_path, DURABLE)
+    try:
+        paths = [row[0] for row in conn.execute('SELECT path FROM _source_watermarks')]
+        missing = [(p,) for p in paths if not os.path.exists(p)]
+        if missing:
+            conn.executemany('DELETE FROM _source_watermarks WHERE path = ?', missing)
+            conn.commit()
+    finally:
+        conn.close()
+    if missing:
+        log(f"Dropped {len(missing)} watermark(s) for source files that no longer exist")
+    return len(missing)
+
+def merge_sources_incremental(source_paths, store_path, workers=1):
+    """Ingest only new or changed source files into the merged store.
+
+    A source is skipped when its size and mtime (or, failing that, its SHA-256)
+    match the stored watermark. A changed source whose rows up to the previous
+    max id are untouched (same max scanTime) is read from that id onwards;
+    anything else (e.g. a rewritten file with fresh ids) is read in full.
+    Returns (records_merged, skipped_paths)."""
+    watermarks = load_source_watermarks(store_path)
+
+    sources = []
+    fingerprints = []
+    skipped = []
+    for path in source_paths:
+        stat = os.stat(path)
+        mark = watermarks.get(os.path.normpath(path))
+
+        if mark and mark['size'] == stat.st_size and mark['mtime'] == stat.st_mtime:
+            skipped.append(path)
+            continue
+
+        sha256 = file_sha256(path)
+        if mark and mark['sha256'] == sha256:
+            # Same content, only mtime changed (e.g. fresh git checkout)
+            save_source_watermark(store_path, path, stat.st_size, stat.st_mtime, sha256,
+                                  mark['max_id'], mark['max_scan_time'])
+            skipped.append(path)
+            continue
+
+        since_id = None
+        if mark and mark['max_id'] is not None:
+            max_id, prefix_max_scan_time = read_source_extent(path, up_to_id=mark['max_id'])
+            if max_id is not None and max_id >= mark['max_id'] and prefix_max_scan_time == mark['max_scan_time']:
+                since_id = mark['max_id']
+
+        sources.append((path, since_id))
+        fingerprints.append((path, stat, sha256))
+
+    total_merged = merge_sources(sources, store_path, workers)
+
+    for path, stat, sha256 in fingerprints:
+        max_id, max_scan_time = read_source_extent(path)
+        save_source_watermark(store_path, path, stat.st_size, stat.st_mtime, sha256,
+                              max_id, max_scan_time)
+
+    log(f"Skipped {len(skipped)} unchanged source file(s)")
+    return total_merged, skipped
+
+def count_records(db_path):
+    """Return the number of rows in the attendance table"""
     conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('SELECT COUNT(*) FROM attendance').fetchone()[0]
+    finally:
+        conn.close()
+
+def source_row_count(db_path):
+    """Return the number of attendance rows in a source file (0 if it has none or can't be read)"""
+    try:
+        return count_records(db_path)
+    except sqlite3.Error:
+        return 0
+
+def remove_duplicates(db_path):
+    """Remove duplicate records based on student_id, subject, log_date, log_time.
+    Only needed for databases created without the unique dedup index."""
+    conn = connect_db(db_path)
     cursor = conn.cursor()
     
     log("Removing duplicates...")
@@ -223,7 +709,9 @@ def remove_duplicates(db_path):
 
 def delete_old_records(db_path, cutoff_date):
     """Delete records older than cutoff_date based on scanTime"""
-    conn = sqlite3.connect(db_path)
+    # A single statement gains nothing from the bulk profile, and durable leaves an
+    # unchanged merged store byte-identical
+    conn = connect_db(db_path, DURABLE)
     cursor = conn.cursor()
     
     # scanTime is in ISO format like "2025-09-15T14:48:29.013Z"
@@ -251,103 +739,394 @@ def delete_old_records(db_path, cutoff_date):
     conn.close()
     return count_to_delete
 
-def split_into_history_and_deleted(source_db_path, history_db_path, deleted_db_path):
-    """Split records based on scanTime into log_history.db (≤6 months) and log_deleted.db (>6 months, ≤3 years).
-    Never deletes log_history.db or log_deleted.db; overwrites in place."""
-    
-    six_months_str = SIX_MONTHS_AGO.strftime('%Y-%m-%d')
-    
-    # Never delete log_history.db / log_deleted.db; overwrite in place
-    source_conn = sqlite3.connect(source_db_path)
-    history_conn = sqlite3.connect(history_db_path)
-    deleted_conn = sqlite3.connect(deleted_db_path)
-    
-    # Create or replace tables in both databases (overwrite in place)
-    for conn in [history_conn, deleted_conn]:
+def copy_records_by_scan_date(source_db_path, target_db_path, where, params):
+    """Rewrite target_db_path's attendance table with the source rows matching `where`.
+
+    The source is ATTACHed and copied with a single INSERT ... SELECT inside one
+    transaction, so rows never pass through Python and the target is either fully
+    rewritten or left untouched. Never deletes the target file; overwrites in place.
+    Returns the number of rows written."""
+    conn = connect_db(target_db_path)
+    try:
         cursor = conn.cursor()
-        cursor.execute('DROP TABLE IF EXISTS attendance')
-        cursor.execute('''
-            CREATE TABLE attendance (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                student_id INTEGER NOT NULL,
-                subject TEXT NOT NULL,
-                log_date TEXT NOT NULL,
-                log_time TEXT NOT NULL,
-                sessionId TEXT NOT NULL,
-                dateTime TEXT NOT NULL,
-                inProgress INTEGER NOT NULL,
-                isChecklist INTEGER NOT NULL,
-                isScanner INTEGER NOT NULL,
-                isExcused INTEGER NOT NULL,
-                isEdited INTEGER NOT NULL,
-                backedUp INTEGER NOT NULL,
-                personalBackedUp INTEGER NOT NULL,
-                synced INTEGER NOT NULL,
-                syncedAt TEXT NOT NULL,
-                year INTEGER NOT NULL,
-                batch TEXT NOT NULL,
-                scanTime TEXT NOT NULL,
-                isManual INTEGER NOT NULL,
-                created_at TEXT NOT NULL,
-                updated_at TEXT NOT NULL,
-                notes TEXT,
-                user_name TEXT NOT NULL,
-                user_id TEXT NOT NULL,
-                division TEXT NOT NULL,
-                department TEXT NOT NULL
+        cursor.execute('ATTACH DATABASE ? AS src', (source_db_path,))
+
+        # Get column names (excluding id)
+        # IMPORTANT: Do NOT rely on column positions; they change if schema/order changes.
+        cursor.execute('PRAGMA src.table_info(attendance)')
+        full_columns = [col[1] for col in cursor.fetchall()]  # includes 'id'
+        if 'scanTime' not in full_columns:
+            raise RuntimeError("attendance table is missing required column 'scanTime'")
+        column_list = ','.join(c for c in full_columns if c != 'id')
+
+        cursor.execute('BEGIN')
+        cursor.execute('DROP TABLE IF EXISTS main.attendance')
+        cursor.execute(ATTENDANCE_TABLE_SQL)
+        cursor.execute(
+            f'INSERT INTO main.attendance ({column_list}) '
+            f'SELECT {column_list} FROM src.attendance WHERE {where} ORDER BY id',
+            params,
+        )
+        count = cursor.rowcount
+        conn.commit()
+        cursor.execute('DETACH DATABASE src')
+        return count
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def write_stable_output(source_db_path, target_db_path, where='1', params=()):
+    """Write the source rows matching `where` to target_db_path so that unchanged data
+    gives a byte-identical file (--stable-output).
+
+    Rows already in the target keep their id; new rows get ids after the target's
+    AUTOINCREMENT sequence, in STABLE_OUTPUT_ORDER. The file is built next to the target
+    with a fixed page size and VACUUMed. If it matches the current target byte for byte
+    the target is left untouched (same bytes, same mtime); otherwise it is swapped in with
+    os.replace. Returns the number of rows written."""
+    tmp_path = target_db_path + '.stable.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    has_previous = False
+    if os.path.exists(target_db_path):
+        conn = sqlite3.connect(target_db_path)
+        try:
+            has_previous = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name='attendance'"
+            ).fetchone() is not None
+        finally:
+            conn.close()
+
+    key_match = ' AND '.join(f'p.{c} = s.{c}' for c in DEDUP_KEY_COLUMNS)
+    conn = connect_db(tmp_path, DURABLE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f'PRAGMA page_size = {OUTPUT_PAGE_SIZE}')
+        cursor.execute(ATTENDANCE_TABLE_SQL)
+        cursor.execute(DEDUP_INDEX_SQL)
+        conn.commit()
+        cursor.execute('ATTACH DATABASE ? AS src', (source_db_path,))
+        column_list = ','.join(
+            col[1] for col in cursor.execute('PRAGMA src.table_info(attendance)') if col[1] != 'id'
+        )
+        source_columns = ','.join(f's.{c}' for c in column_list.split(','))
+
+        cursor.execute('BEGIN')
+        if has_previous:
+            cursor.execute('ATTACH DATABASE ? AS prev', (target_db_path,))
+            # Rows still present keep the id they had in the previous output
+            cursor.execute(
+                f'INSERT OR IGNORE INTO main.attendance (id,{column_list}) '
+                f'SELECT p.id,{source_columns} FROM prev.attendance p '
+                f'JOIN (SELECT * FROM src.attendance WHERE {where}) s '
+                f'ON {key_match} ORDER BY p.id',
+                params,
             )
-        ''')
+            # Ids of rows that left the output are never reused
+            previous_seq = cursor.execute(
+                "SELECT seq FROM prev.sqlite_sequence WHERE name = 'attendance'"
+            ).fetchone()
+            if previous_seq is not None:
+                if cursor.execute("SELECT 1 FROM sqlite_sequence WHERE name = 'attendance'").fetchone():
+                    cursor.execute(
+                        "UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'attendance'", previous_seq
+                    )
+                else:
+                    cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('attendance', ?)", previous_seq)
+        # New rows only: INSERT OR IGNORE would still advance the AUTOINCREMENT
+        # sequence for every ignored row
+        new_row_match = ' AND '.join(f'm.{c} = s.{c}' for c in DEDUP_KEY_COLUMNS)
+        cursor.execute(
+            f'INSERT INTO main.attendance ({column_list}) '
+            f'SELECT {source_columns} FROM src.attendance s WHERE ({where}) '
+            f'AND NOT EXISTS (SELECT 1 FROM main.attendance m WHERE {new_row_match}) '
+            f'ORDER BY {", ".join(f"s.{c}" for c in STABLE_OUTPUT_ORDER)}',
+            params,
+        )
+        count = cursor.execute('SELECT COUNT(*) FROM main.attendance').fetchone()[0]
         conn.commit()
-    
-    # Get column names (excluding id)
-    source_cursor = source_conn.cursor()
-    source_cursor.execute('PRAGMA table_info(attendance)')
-    columns = [col[1] for col in source_cursor.fetchall() if col[1] != 'id']
-    
-    placeholders = ','.join(['?' for _ in columns])
-    insert_query = f'INSERT INTO attendance ({",".join(columns)}) VALUES ({placeholders})'
-    
-    # Split records based on scanTime
-    # IMPORTANT: Do NOT hardcode the scanTime index; it changes if schema/order changes.
-    source_cursor.execute('PRAGMA table_info(attendance)')
-    full_columns = [col[1] for col in source_cursor.fetchall()]  # includes 'id'
-    if 'scanTime' not in full_columns:
-        raise RuntimeError("attendance table is missing required column 'scanTime'")
-    scan_idx = full_columns.index('scanTime')
+        if has_previous:
+            cursor.execute('DETACH DATABASE prev')
+        cursor.execute('DETACH DATABASE src')
+        # Outputs carry no index; VACUUM lays the rows out in id order on fresh pages
+        cursor.execute('DROP INDEX idx_dedup_key')
+        conn.commit()
+        cursor.execute('VACUUM')
+    except Exception:
+        conn.rollback()
+        conn.close()
+        os.remove(tmp_path)
+        raise
+    conn.close()
+
+    if os.path.exists(target_db_path) and filecmp.cmp(tmp_path, target_db_path, shallow=False):
+        os.remove(tmp_path)
+        log(f"  {os.path.basename(target_db_path)} unchanged ({count} records), file left as is")
+    else:
+        os.replace(tmp_path, target_db_path)
+    return count
+
+def split_into_history_and_deleted(source_db_path, history_db_path, deleted_db_path, stable=False):
+    """Split records based on scanTime into log_history.db (≤6 months) and log_deleted.db (>6 months, ≤3 years).
+    Never deletes log_history.db or log_deleted.db; overwrites in place.
+    The split is set-based (one INSERT ... SELECT per target keyed on the scanTime date),
+    so memory use does not grow with history size.
+    With stable=True each target is written by write_stable_output instead."""
+    copy_records = write_stable_output if stable else copy_records_by_scan_date
+
+    # scanTime is an ISO string like "2025-09-15T14:48:29.013Z"; compare its YYYY-MM-DD part
+    six_months_str = SIX_MONTHS_AGO.strftime('%Y-%m-%d')
+
+    # Recent records (≤ 6 months) -> log_history.db
+    history_count = copy_records(
+        source_db_path, history_db_path, 'substr(scanTime, 1, 10) >= ?', (six_months_str,)
+    )
+    # Old records (> 6 months) -> log_deleted.db
+    deleted_count = copy_records(
+        source_db_path, deleted_db_path, 'substr(scanTime, 1, 10) < ?', (six_months_str,)
+    )
 
-    source_cursor.execute('SELECT * FROM attendance')
-    records = source_cursor.fetchall()
-    
-    history_count = 0
-    deleted_count = 0
-    
-    for record in records:
-        # scanTime is an ISO string like "2025-09-15T14:48:29.013Z"
-        scan_time = record[scan_idx]
-        scan_date = str(scan_time)[:10]  # Extract YYYY-MM-DD part safely
-        record_without_id = record[1:]  # Exclude id
-        
-        if scan_date >= six_months_str:
-            # Recent record (≤ 6 months) -> log_history.db
-            history_conn.cursor().execute(insert_query, record_without_id)
-            history_count += 1
-        else:
-            # Old record (> 6 months) -> log_deleted.db
-            deleted_conn.cursor().execute(insert_query, record_without_id)
-            deleted_count += 1
-    
-    history_conn.commit()
-    deleted_conn.commit()
-    
-    source_conn.close()
-    history_conn.close()
-    deleted_conn.close()
-    
     log(f"Split into log_history.db: {history_count} records (≤ 6 months)")
     log(f"Split into log_deleted.db: {deleted_count} records (> 6 months, ≤ 3 years)")
-    
+
     return history_count, deleted_count
 
+def partition_month(scan_date):
+    """Return the 'YYYY-MM' partition key of a date/datetime"""
+    return scan_date.strftime('%Y-%m')
+
+def current_partition_month():
+    """Partition key of the current (UTC) month; later months share FUTURE_PARTITION"""
+    return partition_month(datetime.now(timezone.utc))
+
+def next_partition_month(month):
+    """Return the partition key that follows 'YYYY-MM'"""
+    year, mon = int(month[:4]), int(month[5:7])
+    if mon == 12:
+        return f"{year + 1:04d}-01"
+    return f"{year:04d}-{mon + 1:02d}"
+
+def partition_path(archive_dir, month):
+    """Path of the partition file holding records whose scanTime falls in `month`"""
+    return os.path.join(archive_dir, f"{month}.db")
+
+def list_partition_months(archive_dir=LOG_ARCHIVE_DIR):
+    """Return the sorted 'YYYY-MM' keys of the partition files present on disk"""
+    if not os.path.exists(archive_dir):
+        return []
+    months = []
+    for filename in os.listdir(archive_dir):
+        month = filename[:-3]
+        if filename.endswith('.db') and ((len(month) == 7 and month[4] == '-') or month == FUTURE_PARTITION):
+            months.append(month)
+    return sorted(months)
+
+def partition_files(archive_dir=LOG_ARCHIVE_DIR):
+    """Return the paths of the partition files present on disk"""
+    return [partition_path(archive_dir, month) for month in list_partition_months(archive_dir)]
+
+def load_partition_catalog(archive_dir=LOG_ARCHIVE_DIR):
+    """Return {month: entry} from the archive catalog (empty if there is none yet)"""
+    catalog_path = os.path.join(archive_dir, PARTITION_CATALOG_NAME)
+    if not os.path.exists(catalog_path):
+        return {}
+    with open(catalog_path, 'r', encoding='utf-8') as f:
+        return json.load(f).get('partitions', {})
+
+def refresh_partition_catalog(archive_dir=LOG_ARCHIVE_DIR):
+    """Rebuild the catalog from the partition files on disk.
+    Only row counts and scanTime bounds are stored (no timestamps), so the
+    catalog only changes when a partition's contents change."""
+    catalog = {}
+    for month in list_partition_months(archive_dir):
+        filename = os.path.basename(partition_path(archive_dir, month))
+        conn = sqlite3.connect(os.path.join(archive_dir, filename))
+        try:
+            rows, min_scan_time, max_scan_time = conn.execute(
+                'SELECT COUNT(*), MIN(scanTime), MAX(scanTime) FROM attendance'
+            ).fetchone()
+        finally:
+            conn.close()
+        catalog[month] = {
+            'file': filename,
+            'rows': rows,
+            'min_scan_time': min_scan_time,
+            'max_scan_time': max_scan_time,
+        }
+
+    catalog_path = os.path.join(archive_dir, PARTITION_CATALOG_NAME)
+    with open(catalog_path, 'w', encoding='utf-8') as f:
+        json.dump({'partitions': catalog}, f, indent=2, sort_keys=True)
+        f.write('\n')
+    return catalog
+
+def write_monthly_partitions(source_db_path, archive_dir=LOG_ARCHIVE_DIR):
+    """Add the merged records to their monthly partition files (log_archive/YYYY-MM.db).
+
+    Partitions are append-only: rows are copied with INSERT OR IGNORE on the dedup key,
+    so records already archived are kept as they are and a partition with nothing new
+    is not written at all (its file, and therefore git, sees no change).
+    Returns {month: rows added}."""
+    os.makedirs(archive_dir, exist_ok=True)
+
+    source_conn = connect_db(source_db_path, DURABLE)
+    try:
+        # Range scans per month below use this index instead of substr() over every row
+        source_conn.execute('CREATE INDEX IF NOT EXISTS idx_scan_time ON attendance(scanTime)')
+        source_conn.commit()
+        months = [row[0] for row in source_conn.execute(
+            'SELECT DISTINCT substr(scanTime, 1, 7) FROM attendance ORDER BY 1'
+        )]
+        column_list = ','.join(
+            col[1] for col in source_conn.execute('PRAGMA table_info(attendance)') if col[1] != 'id'
+        )
+    finally:
+        source_conn.close()
+
+    # Mis-clocked devices produce scanTimes years ahead; keep them in one partition
+    # instead of one file per bogus month
+    current_month = current_partition_month()
+    ranges = [
+        (month, 'scanTime >= ? AND scanTime < ?', (month, next_partition_month(month)))
+        for month in months if month <= current_month
+    ]
+    if any(month > current_month for month in months):
+        ranges.append((FUTURE_PARTITION, 'scanTime >= ?', (next_partition_month(current_month),)))
+
+    # Durable profile: switching a file to WAL rewrites its header, which would make
+    # partitions with nothing new differ from the committed copy
+    added = {}
+    for month, where, params in ranges:
+        conn = connect_db(partition_path(archive_dir, month), DURABLE)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(ATTENDANCE_TABLE_SQL)
+            cursor.execute(DEDUP_INDEX_SQL)
+            cursor.execute('ATTACH DATABASE ? AS src', (source_db_path,))
+            cursor.execute(
+                f'INSERT OR IGNORE INTO main.attendance ({column_list}) '
+                f'SELECT {column_list} FROM src.attendance '
+                f'WHERE {where} ORDER BY id',
+                params,
+            )
+            added[month] = cursor.rowcount
+            if cursor.rowcount:
+                conn.commit()
+            else:
+                # Nothing new: roll back so not even sqlite_sequence is rewritten
+                conn.rollback()
+            cursor.execute('DETACH DATABASE src')
+        finally:
+            conn.close()
+
+    # Rows parked in the future partition whose month has now arrived were just
+    # copied into their monthly partition above; drop them from the overflow file
+    future_path = partition_path(archive_dir, FUTURE_PARTITION)
+    if os.path.exists(future_path):
+        conn = connect_db(future_path, DURABLE)
+        try:
+            cursor = conn.execute('DELETE FROM attendance WHERE scanTime < ?',
+                                  (next_partition_month(current_month),))
+            if cursor.rowcount:
+                conn.commit()
+                log(f"  Moved {cursor.rowcount} records out of {os.path.basename(future_path)} into monthly partitions")
+            else:
+                conn.rollback()
+        finally:
+            conn.close()
+
+    new_rows = sum(added.values())
+    changed = sum(1 for count in added.values() if count)
+    log(f"Archived {new_rows} new records into {changed} of {len(ranges)} partition(s) in {archive_dir}")
+    return added
+
+def drop_expired_partitions(cutoff_date, archive_dir=LOG_ARCHIVE_DIR):
+    """Apply retention to the archive: partitions that end before cutoff_date are deleted
+    as whole files; only the partition containing the cutoff is trimmed row by row.
+    Returns the number of partition files removed."""
+    if not os.path.exists(archive_dir):
+        return 0
+
+    cutoff_str = cutoff_date.strftime('%Y-%m-%d')
+    cutoff_month = partition_month(cutoff_date)
+
+    removed = 0
+    for month in list_partition_months(archive_dir):
+        path = partition_path(archive_dir, month)
+        if month < cutoff_month:
+            os.remove(path)
+            log(f"  Dropped partition {os.path.basename(path)} (older than {cutoff_str})")
+            removed += 1
+        elif month == cutoff_month:
+            conn = connect_db(path, DURABLE)
+            try:
+                cursor = conn.execute('DELETE FROM attendance WHERE substr(scanTime, 1, 10) < ?', (cutoff_str,))
+                if cursor.rowcount:
+                    log(f"  Trimmed {cursor.rowcount} records older than {cutoff_str} from {os.path.basename(path)}")
+                conn.commit()
+            finally:
+                conn.close()
+
+    log(f"Dropped {removed} expired partition(s) from {archive_dir}")
+    return removed
+
+def partitions_since(start_date, archive_dir=LOG_ARCHIVE_DIR):
+    """Return the partition files that can hold records with scanTime on or after start_date.
+    Readers attach only these instead of opening the whole archive."""
+    start_month = partition_month(start_date)
+    catalog = load_partition_catalog(archive_dir)
+    return [
+        os.path.join(archive_dir, entry['file'])
+        for month, entry in sorted(catalog.items())
+        if month >= start_month
+    ]
+
+def build_history_from_partitions(history_db_path, start_date, archive_dir=LOG_ARCHIVE_DIR, stable=False):
+    """Rebuild log_history.db (records with scanTime on or after start_date) from the
+    monthly partitions that cover that range only. The file is assembled next to the
+    target and swapped in with os.replace, so readers never see a half-written file.
+    With stable=True the assembled rows are installed by write_stable_output instead.
+    Returns the number of records written."""
+    start_str = start_date.strftime('%Y-%m-%d')
+    tmp_path = history_db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = connect_db(tmp_path)
+    total = 0
+    try:
+        cursor = conn.cursor()
+        cursor.execute(ATTENDANCE_TABLE_SQL)
+        conn.commit()
+        column_list = ','.join(
+            col[1] for col in cursor.execute('PRAGMA table_info(attendance)') if col[1] != 'id'
+        )
+        for path in partitions_since(start_date, archive_dir):
+            cursor.execute('ATTACH DATABASE ? AS part', (path,))
+            cursor.execute(
+                f'INSERT INTO main.attendance ({column_list}) '
+                f'SELECT {column_list} FROM part.attendance '
+                f'WHERE substr(scanTime, 1, 10) >= ? ORDER BY scanTime, id',
+                (start_str,),
+            )
+            total += cursor.rowcount
+            conn.commit()
+            cursor.execute('DETACH DATABASE part')
+    finally:
+        conn.close()
+    restore_durable([tmp_path])
+
+    if stable:
+        write_stable_output(tmp_path, history_db_path)
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, history_db_path)
+    log(f"Built log_history.db from partitions: {total} records (≤ 6 months)")
+    return total
+
 def archive_processed_files(files_to_archive):
     """Move processed files to archive directory"""
     if not files_to_archive:
@@ -377,7 +1156,7 @@ def archive_processed_files(files_to_archive):
 def delete_merged_files_from_log_history():
     """Delete all .db files in log_history except log_history.db (keep only the merged output)."""
     if not os.path.exists(LOG_HISTORY_DIR):
-        return
+        return 0
     kept = 'log_history.db'
     deleted_count = 0
     for filename in os.listdir(LOG_HISTORY_DIR):
@@ -394,6 +1173,75 @@ def delete_merged_files_from_log_history():
         log(f"Deleted {deleted_count} merged files from {LOG_HISTORY_DIR} (kept {kept})")
     else:
         log(f"No extra .db files to delete in {LOG_HISTORY_DIR}")
+    return deleted_count
+
+@contextmanager
+def run_stage(stages, name):
+    """Time one step of main() and append its metrics dict to `stages`.
+    The caller fills in rows_in/rows_out, bytes_read/bytes_written and
+    files_skipped where they apply; the rest stay None."""
+    metrics = {
+        'stage': name,
+        'seconds': None,
+        'rows_in': None,
+        'rows_out': None,
+        'bytes_read': None,
+        'bytes_written': None,
+        'files_skipped': None,
+    }
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics['seconds'] = round(time.perf_counter() - start, 3)
+        stages.append(metrics)
+
+def file_stats(paths):
+    """Return {path: (size, mtime)} for the paths that exist"""
+    stats = {}
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats[path] = (stat.st_size, stat.st_mtime)
+    return stats
+
+def bytes_changed(before, after):
+    """Total size of the files in `after` that are new or changed since `before` (see file_stats)"""
+    return sum(size for path, (size, mtime) in after.items() if before.get(path) != (size, mtime))
+
+def write_run_report(report_path, stages, options, success):
+    """Write the per-step metrics of this run as JSON (overwritten every run)"""
+    report_dir = os.path.dirname(report_path)
+    if report_dir:
+        os.makedirs(report_dir, exist_ok=True)
+    report = {
+        'finished_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'success': success,
+        'options': options,
+        'total_seconds': round(sum(stage['seconds'] for stage in stages), 3),
+        'stages': stages,
+    }
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+    log(f"Run report written to {report_path}")
+
+def log_stage_summary(stages):
+    """Log the per-step metrics as a table"""
+    def cell(value, scale=1):
+        if value is None:
+            return '-'
+        return f"{value / scale:.1f}" if scale != 1 else str(value)
+
+    header = f"{'Stage':<12}{'Seconds':>9}{'Rows in':>10}{'Rows out':>10}{'Read MB':>9}{'Written MB':>12}{'Skipped':>9}"
+    log(header)
+    log('-' * len(header))
+    for stage in stages:
+        log(f"{stage['stage']:<12}{stage['seconds']:>9.2f}{cell(stage['rows_in']):>10}{cell(stage['rows_out']):>10}"
+            f"{cell(stage['bytes_read'], 1024 * 1024):>9}{cell(stage['bytes_written'], 1024 * 1024):>12}"
+            f"{cell(stage['files_skipped']):>9}")
+    log('-' * len(header))
+    log(f"{'total':<12}{sum(stage['seconds'] for stage in stages):>9.2f}")
 
 def git_commit_and_push(message):
     """Commit and push changes to GitHub with safety checks"""
@@ -431,52 +1279,223 @@ def git_commit_and_push(message):
         log(f"Git operation failed: {e}")
         return False
 
-def main():
-    """Main execution function"""
-    log("=" * 60)
-    log("Starting Log Database Management Script")
-    log("=" * 60)
-    
+def plan_source_reads(source_paths, args):
+    """--plan: [(path, rows to read)] for the sources a run would read, and the number
+    skipped, decided as the merge step would (watermarks with --incremental; a full run
+    reads every source). Only file metadata and COUNT queries; nothing is recorded."""
+    reads = []
+    skipped = 0
+    if args.incremental:
+        watermarks = load_source_watermarks(args.store) if os.path.exists(args.store) else {}
+        for path in source_paths:
+            stat = os.stat(path)
+            mark = watermarks.get(os.path.normpath(path))
+            if mark and ((mark['size'] == stat.st_size and mark['mtime'] == stat.st_mtime)
+                         or mark['sha256'] == file_sha256(path)):
+                skipped += 1
+                continue
+            since_id = None
+            if mark and mark['max_id'] is not None:
+                max_id, prefix_max_scan_time = read_source_extent(path, up_to_id=mark['max_id'])
+                if max_id is not None and max_id >= mark['max_id'] and prefix_max_scan_time == mark['max_scan_time']:
+                    since_id = mark['max_id']
+            reads.append((path, count_source_rows_since(path, since_id)))
+    else:
+        reads = [(path, source_row_count(path)) for path in source_paths]
+    return reads, skipped
+
+def count_source_rows_since(db_path, since_id=None):
+    """Rows of a source's attendance table with id > since_id (all rows if None)"""
+    if since_id is None:
+        return source_row_count(db_path)
+    try:
+        conn = connect_read_only(db_path)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM attendance WHERE id > ?', (since_id,)).fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return 0
+
+def count_records_where(db_path, where='1', params=()):
+    """COUNT(*) of a database's attendance rows matching `where` (0 if it is missing or unreadable)"""
+    if not os.path.exists(db_path):
+        return 0
+    try:
+        conn = connect_read_only(db_path)
+        try:
+            return conn.execute(f'SELECT COUNT(*) FROM attendance WHERE {where}', params).fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return 0
+
+def count_new_upload_records(upload_path, reference_db_path):
+    """Rows of an uploaded session file whose dedup key is not in the reference database yet"""
+    if not os.path.exists(reference_db_path):
+        return source_row_count(upload_path)
+    match = ' AND '.join(f'r.{col} = u.{col}' for col in DEDUP_KEY_COLUMNS)
+    try:
+        conn = connect_read_only(upload_path)
+        try:
+            conn.execute('ATTACH DATABASE ? AS reference', (read_only_uri(reference_db_path),))
+            # LEFT JOIN: SQLite indexes the reference once if it has no dedup index
+            return conn.execute(
+                f'SELECT COUNT(*) FROM main.attendance u LEFT JOIN reference.attendance r ON {match} '
+                f'WHERE r.rowid IS NULL'
+            ).fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return source_row_count(upload_path)
+
+def expected_output_size(db_path, records, records_after, rewritten):
+    """Estimated size of an output holding records_after records (it holds `records` now).
+    Outputs overwritten in place keep their free pages, so they never shrink unless
+    the file is rewritten (--stable-output VACUUMs, --partitioned rebuilds log_history.db)."""
+    if not os.path.exists(db_path):
+        return 0
+    size = os.path.getsize(db_path)
+    estimate = round(records_after * size / records) if records else size
+    return estimate if rewritten else max(size, estimate)
+
+def plan_run(all_files, args):
+    """--plan: log the work a run would do and its expected result without writing
+    anything: files to read and skip, rows to merge, duplicates, records aged out and
+    moved to log_deleted.db, uploads deleted from log_history, and output sizes.
+    Returns True if the run would change its outputs."""
+    history_db_path = os.path.join(LOG_HISTORY_DIR, 'log_history.db')
+    deleted_db_path = os.path.join(LOG_DELETED_DIR, 'log_deleted.db')
+    three_years_str = THREE_YEARS_AGO.strftime('%Y-%m-%d')
+    six_months_str = SIX_MONTHS_AGO.strftime('%Y-%m-%d')
+
+    reads, skipped = plan_source_reads(all_files, args)
+    rows_to_read = sum(rows for _, rows in reads)
+    bytes_to_read = sum(os.path.getsize(path) for path, _ in reads)
+    log(f"Merge: read {len(reads)} source file(s) ({bytes_to_read / (1024 * 1024):.1f} MB, "
+        f"{rows_to_read} rows), skip {skipped} unchanged")
+
+    # Session files uploaded to log_history are the new data; everything else was merged before
+    uploads = [p for p in all_files if os.path.dirname(p) == LOG_HISTORY_DIR
+               and os.path.basename(p) != 'log_history.db']
+    reference_db = args.store if args.incremental else history_db_path
+    new_records = sum(count_new_upload_records(path, reference_db) for path in uploads)
+
+    history_records = count_records_where(history_db_path)
+    if args.incremental:
+        current_records = count_records_where(args.store)
+    elif args.partitioned:
+        current_records = sum(entry['rows'] for entry in load_partition_catalog(args.archive_dir).values())
+    else:
+        current_records = history_records + count_records_where(deleted_db_path)
+    if not current_records and not os.path.exists(reference_db):
+        # First run: nothing to compare the sources with, so only an upper bound is known
+        log(f"Dedup: no previous output, up to {rows_to_read} unique records (duplicates not estimated)")
+        log(f"Cleanup: delete {len(uploads)} merged upload(s) from {LOG_HISTORY_DIR}")
+        return True
+    unique_after = current_records + new_records
+    log(f"Dedup: ~{unique_after} unique records ({new_records} new from {len(uploads)} upload(s)), "
+        f"~{max(rows_to_read - new_records, 0)} of the rows read already merged or duplicated")
+
+    aging = ('substr(scanTime, 1, 10) < ?', (three_years_str,))
+    moving = ('substr(scanTime, 1, 10) < ?', (six_months_str,))
+    if args.partitioned:
+        cutoff_month = partition_month(THREE_YEARS_AGO)
+        catalog = load_partition_catalog(args.archive_dir)
+        expired = sum(entry['rows'] for month, entry in catalog.items() if month < cutoff_month)
+        expired_files = sum(1 for month in catalog if month < cutoff_month)
+        log(f"Retention: drop {expired_files} partition file(s) ({expired} records older than {three_years_str})")
+    elif args.incremental:
+        expired = count_records_where(args.store, *aging)
+        log(f"Retention: delete {expired} records older than {three_years_str}")
+    else:
+        expired = count_records_where(deleted_db_path, *aging)
+        log(f"Retention: delete {expired} records older than {three_years_str}")
+
+    moved = count_records_where(history_db_path, *moving)
+    history_after = history_records - moved + new_records
+    history_size = os.path.getsize(history_db_path) if os.path.exists(history_db_path) else 0
+    history_size_after = expected_output_size(
+        history_db_path, history_records, history_after, args.stable_output or args.partitioned
+    )
+    log(f"Split: {moved} records leave log_history.db (older than {six_months_str}); "
+        f"log_history.db ~{history_after} records, {history_size / 1024:.0f} KB -> ~{history_size_after / 1024:.0f} KB")
+    if not args.partitioned:
+        deleted_records = count_records_where(deleted_db_path)
+        deleted_after = max(deleted_records + moved - expired, 0)
+        deleted_size = os.path.getsize(deleted_db_path) if os.path.exists(deleted_db_path) else 0
+        deleted_size_after = expected_output_size(deleted_db_path, deleted_records, deleted_after, args.stable_output)
+        log(f"Split: log_deleted.db ~{deleted_after} records, {deleted_size / 1024:.0f} KB -> ~{deleted_size_after / 1024:.0f} KB")
+    log(f"Cleanup: delete {len(uploads)} merged upload(s) from {LOG_HISTORY_DIR}")
+
+    changes = new_records or expired or moved or uploads
+    if not changes:
+        log("Nothing new to merge, age out or move: the run would be a no-op")
+    return bool(changes)
+
+def run_steps(args, stages):
+    """Run steps 1-7 of main(), appending per-step metrics to `stages`.
+    Returns True when the run (including the git push) succeeded."""
     # Step 1: Collect all .db files from three directories
     log("\n[Step 1] Collecting database files...")
     
-    # Apply timestamp filter ONLY to log_history (safety buffer)
-    log_history_files = get_db_files(LOG_HISTORY_DIR, apply_timestamp_filter=True)
-    
-    # No filter for these (they're reference databases, not user uploads)
-    log_deleted_files = get_db_files(LOG_DELETED_DIR, apply_timestamp_filter=False)
-    user_session_files = get_db_files(USER_SESSION_DIR, apply_timestamp_filter=False)
-    
-    all_files = log_history_files + log_deleted_files + user_session_files
+    with run_stage(stages, 'collect') as metrics:
+        # Apply timestamp filter ONLY to log_history (safety buffer)
+        log_history_files = get_db_files(LOG_HISTORY_DIR, apply_timestamp_filter=True)
+        
+        # No filter for these (they're reference databases, not user uploads)
+        log_deleted_files = get_db_files(LOG_DELETED_DIR, apply_timestamp_filter=False)
+        user_session_files = get_db_files(args.user_shards or USER_SESSION_DIR, apply_timestamp_filter=False)
+        
+        all_files = log_history_files + log_deleted_files + user_session_files
+        metrics['files_found'] = len(all_files)
     
     if not all_files:
         log("No database files found. Exiting.")
-        return
+        return True
     
     log(f"Total files to process: {len(all_files)}")
     
-    # Step 2: Create temporary database and merge all files
-    log("\n[Step 2] Merging all databases...")
+    if args.plan:
+        log("\n[Plan] Estimating the work of this run (nothing is written)...")
+        plan_run(all_files, args)
+        return True
     
-    temp_db = create_temporary_merged_db()
+    # Step 2: Create temporary database (or open the persisted store) and merge files
+    log("\n[Step 2] Merging all databases...")
     
-    total_records_merged = 0
-    for db_file in all_files:
-        count = merge_database_into_temp(db_file, temp_db)
-        total_records_merged += count
+    with run_stage(stages, 'merge') as metrics:
+        source_stats = file_stats(all_files)
+        if args.incremental:
+            temp_db = open_merged_store(args.store)
+            merged_before = file_stats([temp_db])
+            total_records_merged, skipped = merge_sources_incremental(all_files, temp_db, args.workers)
+        else:
+            temp_db = create_temporary_merged_db()
+            merged_before = file_stats([temp_db])
+            total_records_merged = merge_sources([(path, None) for path in all_files], temp_db, args.workers)
+            skipped = []
+        metrics['rows_out'] = total_records_merged
+        metrics['files_skipped'] = len(skipped)
+        skipped_paths = set(skipped)
+        metrics['bytes_read'] = sum(size for path, (size, _) in source_stats.items() if path not in skipped_paths)
+        metrics['bytes_written'] = bytes_changed(merged_before, file_stats([temp_db]))
     
     log(f"Total records merged: {total_records_merged}")
     
-    # Step 3: Remove duplicates
-    log("\n[Step 3] Removing duplicates...")
-    remove_duplicates(temp_db)
+    # Step 3: Duplicates were ignored at insert time by the unique dedup key
+    log("\n[Step 3] Checking deduplicated record count...")
+    with run_stage(stages, 'dedup') as metrics:
+        unique_records = count_records(temp_db)
+        metrics['rows_out'] = unique_records
+    log(f"Merged table holds {unique_records} unique records")
     
     # Step 4: Delete records older than 3 years
     log("\n[Step 4] Deleting records older than 3 years...")
-    delete_old_records(temp_db, THREE_YEARS_AGO)
-    
-    # Step 5: Split into log_history.db and log_deleted.db
-    log("\n[Step 5] Splitting into log_history.db and log_deleted.db...")
+    with run_stage(stages, 'retention') as metrics:
+        deleted_records = delete_old_records(temp_db, THREE_YEARS_AGO)
+        metrics['rows_in'] = unique_records
+        metrics['rows_out'] = unique_records - deleted_records
     
     history_db_path = os.path.join(LOG_HISTORY_DIR, 'log_history.db')
     deleted_db_path = os.path.join(LOG_DELETED_DIR, 'log_deleted.db')
@@ -485,24 +1504,154 @@ def main():
     os.makedirs(LOG_HISTORY_DIR, exist_ok=True)
     os.makedirs(LOG_DELETED_DIR, exist_ok=True)
     
-    split_into_history_and_deleted(temp_db, history_db_path, deleted_db_path)
+    if args.partitioned:
+        # Step 5: Archive into monthly partitions; only log_history.db is rebuilt
+        log("\n[Step 5] Archiving into monthly partitions and rebuilding log_history.db...")
+        with run_stage(stages, 'partition') as metrics:
+            outputs_before = file_stats(partition_files(args.archive_dir) + [history_db_path])
+            write_monthly_partitions(temp_db, args.archive_dir)
+            drop_expired_partitions(THREE_YEARS_AGO, args.archive_dir)
+            refresh_partition_catalog(args.archive_dir)
+            history_count = build_history_from_partitions(history_db_path, SIX_MONTHS_AGO, args.archive_dir, args.stable_output)
+            written_outputs = [history_db_path]
+            metrics['rows_in'] = unique_records - deleted_records
+            metrics['rows_out'] = history_count
+            metrics['bytes_read'] = os.path.getsize(temp_db)
+            metrics['bytes_written'] = bytes_changed(outputs_before, file_stats(partition_files(args.archive_dir) + [history_db_path]))
+    else:
+        # Step 5: Split into log_history.db and log_deleted.db
+        log("\n[Step 5] Splitting into log_history.db and log_deleted.db...")
+        with run_stage(stages, 'split') as metrics:
+            outputs_before = file_stats([history_db_path, deleted_db_path])
+            history_count, deleted_count = split_into_history_and_deleted(
+                temp_db, history_db_path, deleted_db_path, args.stable_output
+            )
+            written_outputs = [history_db_path, deleted_db_path]
+            metrics['rows_in'] = unique_records - deleted_records
+            metrics['rows_out'] = history_count + deleted_count
+            metrics['bytes_read'] = os.path.getsize(temp_db)
+            metrics['bytes_written'] = bytes_changed(outputs_before, file_stats(written_outputs))
+    
+    # Outputs are fingerprinted below and committed, so they leave the bulk profile now
+    restore_durable(written_outputs)
+    
+    # The outputs are also sources on the next run; their rows are already in the store
+    if args.incremental:
+        record_source_watermarks(temp_db, written_outputs)
     
     # Step 6: Delete merged .db files in log_history; keep only log_history.db
     log("\n[Step 6] Deleting merged files from log_history (keeping log_history.db only)...")
-    delete_merged_files_from_log_history()
-    
-    # Clean up temporary database
-    if os.path.exists(temp_db):
-        os.remove(temp_db)
-        log("Cleaned up temporary database")
+    with run_stage(stages, 'cleanup') as metrics:
+        metrics['files_deleted'] = delete_merged_files_from_log_history()
+        
+        if args.incremental:
+            prune_source_watermarks(temp_db)
+        # Clean up temporary database (the incremental store is kept for the next run)
+        if not args.incremental and os.path.exists(temp_db):
+            os.remove(temp_db)
+            log("Cleaned up temporary database")
+        
+        # Files written with the bulk (WAL) profile go back to the durable profile before commit
+        restored = restore_durable()
+        if restored:
+            log(f"Restored durable SQLite settings on {len(restored)} bulk-written file(s)")
     
     # Step 7: Commit and push to GitHub
     log("\n[Step 7] Committing changes to GitHub...")
     
     commit_message = f"Log management: merged and split logs [{datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M')}]"
     
-    success = git_commit_and_push(commit_message)
+    with run_stage(stages, 'git'):
+        return git_commit_and_push(commit_message)
+
+def main():
+    """Main execution function"""
+    parser = argparse.ArgumentParser(description="Merge, deduplicate, age out and split attendance log databases.")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Keep a persisted merged store and only ingest new or changed source files.",
+    )
+    parser.add_argument(
+        "--store",
+        default=MERGED_STORE_PATH,
+        help=f"Path of the persisted merged store used by --incremental (default: {MERGED_STORE_PATH}).",
+    )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="Archive records in monthly partition files instead of rewriting log_deleted.db; "
+             "log_history.db is rebuilt from the last 6 months of partitions.",
+    )
+    parser.add_argument(
+        "--archive-dir",
+        default=LOG_ARCHIVE_DIR,
+        help=f"Directory of the monthly partitions used by --partitioned (default: {LOG_ARCHIVE_DIR}).",
+    )
+    parser.add_argument(
+        "--stable-output",
+        action="store_true",
+        help="Write log_history.db / log_deleted.db with stable row ids and page layout, and leave "
+             "them untouched when their contents did not change.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads reading source databases during the merge step; one writer "
+             "inserts their rows in source order, so results match a serial run (default: 1).",
+    )
+    parser.add_argument(
+        "--report",
+        default=RUN_REPORT_PATH,
+        help=f"Where to write the JSON run report with per-step metrics (default: {RUN_REPORT_PATH}).",
+    )
+    parser.add_argument(
+        "--user-shards",
+        metavar="DIR",
+        default=None,
+        help="Read user history from the sharded store in DIR instead of user_session_history/ (see sharded_history.py).",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Log a table of per-step timings, row counts and bytes at the end of the run.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Only log the work a run would do (files, rows to merge, dedup and age out, output "
+             "sizes) from file metadata and COUNT queries; write nothing and skip git.",
+    )
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    log("=" * 60)
+    log("Starting Log Database Management Script")
+    log("=" * 60)
+    
+    stages = []
+    success = False
+    try:
+        success = run_steps(args, stages)
+    finally:
+        # Also written when the run stops early or raises; --plan writes nothing
+        if not args.plan:
+            options = {
+                'incremental': args.incremental,
+                'partitioned': args.partitioned,
+                'stable_output': args.stable_output,
+                'workers': args.workers,
+                'user_shards': args.user_shards,
+            }
+            write_run_report(args.report, stages, options, success)
+            if args.summary:
+                log("\n[Summary]")
+                log_stage_summary(stages)
     
+    if args.plan:
+        return
     if success:
         log("\n" + "=" * 60)
         log("Log Database Management Completed Successfully")
@@ -513,4 +1662,4 @@ def main():
         log("=" * 60)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
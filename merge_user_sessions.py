@@ -1,7 +1,34 @@
+import argparse
+import io
 import sqlite3
 import os
 import re
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+
+from sqlite_profiles import connect as connect_db, connect_read_only, read_only_uri, restore_durable
+from source_manifest import MANIFEST_DIR, load_manifest, save_manifest, unchanged_entry, record_file, prune_manifest
+from file_validation import load_validation_cache, save_validation_cache, validate_file
+from compact_history import ROWS_TABLE, encoded_columns, insert_sqls as compact_insert_sqls, is_compact, pack_user_db
+from sharded_history import (
+    APPENDED_COLUMNS, SHARD_TABLE, add_user, append_rows, open_shard, shard_for, shard_path, shard_users,
+)
+
+# Session files already merged (size, mtime, SHA-256, row count); unchanged ones are skipped
+SESSION_MANIFEST_PATH = os.path.join(MANIFEST_DIR, 'merge_user_sessions_manifest.json')
+# Same, for merges into the sharded store (--shards)
+SHARD_SESSION_MANIFEST_PATH = os.path.join(MANIFEST_DIR, 'merge_user_sessions_shards_manifest.json')
+
+# UNIQUE index on (student_id, log_date, log_time, subject, sessionId) in each user DB;
+# merges use INSERT OR IGNORE, so rows already present are skipped at insert time
+USER_DEDUP_INDEX = 'idx_user_dedup_key'
+
+# Session files ATTACHed to a user DB per transaction (SQLite allows 10 attached DBs by default)
+ATTACH_BATCH_SIZE = 8
+
+# {(table, session CREATE, user CREATE): columns to copy}, see column_mapping
+_column_mapping_cache = {}
 
 def extract_user_id(filename):
     """
@@ -47,10 +74,26 @@ def is_valid_sqlite_db(db_path):
     except sqlite3.Error:
         return False
 
-def get_session_files():
+def count_attendance_rows(db_path):
+    """
+    Return the number of rows in a database's attendance table (None if it can't be read).
     """
-    Scan log_history directory and group session files by user_id
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM attendance").fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+
+def get_session_files(validation_cache=None, quick_check=False, extra_dirs=()):
+    """
+    Scan log_history directory (and extra_dirs, e.g. the session DBs ingested from
+    JSON exports) and group session files by user_id
     Returns dict: {user_id: [list of session db files]}
+    With a validation cache, only new or changed files are opened to check them
+    (and, with quick_check, also run PRAGMA quick_check on).
     """
     log_history_dir = 'log_history'
     user_sessions = defaultdict(list)
@@ -59,34 +102,36 @@ def get_session_files():
         print(f"Directory '{log_history_dir}' not found.")
         return user_sessions
     
-    for filename in os.listdir(log_history_dir):
-        if filename.endswith('.db') and filename != 'log_history.db':
-            user_id = extract_user_id(filename)
-            if user_id:
-                filepath = os.path.join(log_history_dir, filename)
-                # Only include valid SQLite databases
-                if is_valid_sqlite_db(filepath):
-                    user_sessions[user_id].append(filepath)
-                else:
-                    print(f"  ⚠ Skipping invalid database: {filename}")
+    session_dirs = [log_history_dir] + [d for d in extra_dirs if os.path.isdir(d)]
+    for session_dir in session_dirs:
+        # Sorted, so each user's sessions are appended (and get ids) in the same order every run
+        for filename in sorted(os.listdir(session_dir)):
+            if filename.endswith('.db') and filename != 'log_history.db':
+                user_id = extract_user_id(filename)
+                if user_id:
+                    filepath = os.path.join(session_dir, filename)
+                    # Only include valid SQLite databases
+                    if validation_cache is None:
+                        status = 'valid' if is_valid_sqlite_db(filepath) else 'invalid'
+                    else:
+                        status = validate_file(validation_cache, filepath, quick_check)['status']
+                    if status == 'valid':
+                        user_sessions[user_id].append(filepath)
+                    else:
+                        print(f"  ⚠ Skipping invalid database ({status}): {filename}")
     
     return user_sessions
 
-def merge_session_into_user_history(session_db_path, user_db_path):
+def check_session_file(session_db_path):
     """
-    Merge data from a session database into the user's history database
+    Verify a session database looks valid before opening it (exists, non-empty, SQLite header).
     """
-    # print(f"  → Attempting to merge: {session_db_path}")
-    
-    # Verify session database is valid before opening
     if not os.path.exists(session_db_path):
         print(f"  ✗ Session file not found: {session_db_path}")
         return False
     
     # Check file size
-    file_size = os.path.getsize(session_db_path)
-    # print(f"  → File size: {file_size} bytes")
-    if file_size == 0:
+    if os.path.getsize(session_db_path) == 0:
         print(f"  ✗ Session file is empty: {session_db_path}")
         return False
     
@@ -94,13 +139,188 @@ def merge_session_into_user_history(session_db_path, user_db_path):
     try:
         with open(session_db_path, 'rb') as f:
             header = f.read(16)
-            # print(f"  → File header (hex): {header.hex()}")
             if header[:15] != b'SQLite format 3':
                 print(f"  ✗ Not a valid SQLite file - invalid header")
                 return False
     except Exception as e:
         print(f"  ✗ Cannot read file header: {e}")
         return False
+    return True
+
+def column_mapping(table, source_sql, target_sql, read_source_info, read_target_info, filled=()):
+    """
+    Return the column names to copy from a session table into the user table of the
+    same name, matched by name rather than position (app versions order and add columns
+    differently). The source's AUTOINCREMENT id is left out so the user DB assigns its
+    own ids; source columns the target lacks are dropped, with a warning. Target
+    columns in `filled` are set by the caller, so they do not count as missing.
+    Compiled once per (table, source CREATE, target CREATE) signature and cached, so
+    table_info is only read (via read_source_info / read_target_info) for new signatures.
+    """
+    key = (table, source_sql, target_sql, tuple(filled))
+    columns = _column_mapping_cache.get(key)
+    if columns is None:
+        source_info = read_source_info()
+        target_info = read_target_info()
+        source_columns = [col[1] for col in source_info]
+        # col[5] is the pk flag: an AUTOINCREMENT id column is not copied
+        if 'AUTOINCREMENT' in source_sql.upper() and source_info and source_info[0][5] == 1:
+            source_columns = source_columns[1:]
+        target_columns = {col[1] for col in target_info}
+        columns = tuple(c for c in source_columns if c in target_columns)
+
+        dropped = [c for c in source_columns if c not in target_columns]
+        if dropped:
+            print(f"  ⚠ {table}: user DB has no column(s) {', '.join(dropped)}; not copied")
+        # NOT NULL without default and not provided: INSERT OR IGNORE would skip every row
+        missing = [col[1] for col in target_info
+                   if col[3] and col[4] is None and not col[5] and col[1] not in columns
+                   and col[1] not in filled]
+        if missing:
+            print(f"  ⚠ {table}: session has no value for required column(s) {', '.join(missing)}")
+        _column_mapping_cache[key] = columns
+    return columns
+
+def table_insert_sqls(conn, schema, table, source_sql, target_sql):
+    """
+    Return the statements copying `table` from an attached session schema (written
+    with a {schema} placeholder), with columns matched by name; the last statement's
+    rowcount is the number of rows added. A user DB in the compact layout (attendance
+    is a view, see compact_history.py) gets its dictionary values added first.
+    """
+    columns = column_mapping(
+        table, source_sql, target_sql,
+        lambda: conn.execute(f"PRAGMA {schema}.table_info({table})").fetchall(),
+        lambda: conn.execute(f"PRAGMA main.table_info({table})").fetchall(),
+    )
+    if target_sql.upper().startswith('CREATE VIEW'):
+        return compact_insert_sqls(columns, encoded_columns(conn), f"{{schema}}.{table}")
+    column_names = ', '.join(columns)
+    return [f"INSERT OR IGNORE INTO main.{table} ({column_names}) SELECT {column_names} FROM {{schema}}.{table}"]
+
+def merge_attached_session(user_conn, schema, user_tables):
+    """
+    Copy every non-empty table of an attached session schema into the user DB,
+    creating tables the user DB does not have yet (user_tables, {name: CREATE statement},
+    is kept up to date).
+    Returns the number of rows inserted, or None if the session has no tables.
+    """
+    tables = user_conn.execute(f"SELECT name, sql FROM {schema}.sqlite_master WHERE type='table'").fetchall()
+    if not tables:
+        return None
+    
+    merged_count = 0
+    for table, create_sql in tables:
+        if table == 'sqlite_sequence':  # Skip internal SQLite table
+            continue
+        try:
+            if user_conn.execute(f"SELECT 1 FROM {schema}.{table} LIMIT 1").fetchone() is None:
+                continue
+        except sqlite3.Error as e:
+            print(f"  ✗ Error reading table {table}: {e}")
+            continue
+        
+        if table not in user_tables:
+            user_conn.execute(create_sql)
+            user_tables[table] = create_sql
+        insert_sqls = table_insert_sqls(user_conn, schema, table, create_sql, user_tables[table])
+        try:
+            for insert_sql in insert_sqls:
+                rowcount = user_conn.execute(insert_sql.format(schema=schema)).rowcount
+            merged_count += rowcount
+        except sqlite3.Error as e:
+            print(f"  ✗ Error inserting into table {table}: {e}")
+            continue
+    return merged_count
+
+def _user_tables(user_conn):
+    """{name: CREATE statement} of the tables (and the compact layout's attendance view) in the user DB"""
+    return {row[0]: row[1] for row in user_conn.execute(
+        "SELECT name, sql FROM main.sqlite_master WHERE type IN ('table', 'view')"
+    )}
+
+def merge_session_batch(user_conn, session_files, user_tables):
+    """
+    ATTACH a batch of session files to the open user DB and merge them in one
+    transaction, with a savepoint per session so a failing session is rolled back
+    on its own. Returns the session files that were merged.
+    """
+    schemas = []
+    merged = []
+    try:
+        for session_db_path in session_files:
+            schema = f"session{len(schemas)}"
+            user_conn.execute(f"ATTACH DATABASE ? AS {schema}", (session_db_path,))
+            schemas.append(schema)
+        
+        user_conn.execute("BEGIN")
+        for schema, session_db_path in zip(schemas, session_files):
+            user_conn.execute("SAVEPOINT session")
+            try:
+                merged_count = merge_attached_session(user_conn, schema, user_tables)
+            except sqlite3.Error as e:
+                user_conn.execute("ROLLBACK TO session")
+                user_conn.execute("RELEASE session")
+                user_tables.clear()
+                user_tables.update(_user_tables(user_conn))
+                print(f"  ✗ Error merging {session_db_path}: {e}")
+                continue
+            user_conn.execute("RELEASE session")
+            if merged_count is not None:
+                print(f"  ✓ Merged {os.path.basename(session_db_path)} - {merged_count} records")
+            merged.append(session_db_path)
+        user_conn.execute("COMMIT")
+        return merged
+    finally:
+        if user_conn.in_transaction:
+            user_conn.execute("ROLLBACK")
+        for schema in schemas:
+            user_conn.execute(f"DETACH DATABASE {schema}")
+
+def merge_sessions_into_user_history(session_files, user_db_path):
+    """
+    Merge several session databases into the user's history database in one go.
+    The user DB is opened once and session files are ATTACHed ATTACH_BATCH_SIZE at a time,
+    one transaction per batch (SQLite can't DETACH a database read in an open transaction,
+    and allows 10 attached databases by default). If a batch fails as a whole, its
+    sessions are merged one by one with merge_session_into_user_history.
+    Returns the session files that were merged.
+    """
+    mergeable = [f for f in session_files if check_session_file(f)]
+    merged = []
+    if not mergeable:
+        return merged
+    
+    try:
+        user_conn = connect_db(user_db_path, isolation_level=None)
+    except sqlite3.Error as e:
+        print(f"  ✗ Cannot open user database {user_db_path}: {e}")
+        return merged
+    
+    try:
+        user_tables = _user_tables(user_conn)
+        for start in range(0, len(mergeable), ATTACH_BATCH_SIZE):
+            batch = mergeable[start:start + ATTACH_BATCH_SIZE]
+            try:
+                merged.extend(merge_session_batch(user_conn, batch, user_tables))
+            except sqlite3.Error as e:
+                print(f"  ✗ Batched merge failed ({e}), merging these sessions one at a time")
+                for session_db_path in batch:
+                    if merge_session_into_user_history(session_db_path, user_db_path):
+                        merged.append(session_db_path)
+                user_tables = _user_tables(user_conn)
+    finally:
+        user_conn.close()
+    return merged
+
+def merge_session_into_user_history(session_db_path, user_db_path):
+    """
+    Merge data from a session database into the user's history database
+    (one file at a time; fallback for merge_sessions_into_user_history)
+    """
+    # Verify session database is valid before opening
+    if not check_session_file(session_db_path):
+        return False
     
     # print(f"  → Attempting to connect to session DB...")
     # Connect to both databases
@@ -115,7 +335,7 @@ def merge_session_into_user_history(session_db_path, user_db_path):
     
     # print(f"  → Attempting to connect to user DB: {user_db_path}")
     try:
-        user_conn = sqlite3.connect(user_db_path)
+        user_conn = connect_db(user_db_path)
         # print(f"  → Successfully connected to user DB")
     except sqlite3.Error as e:
         print(f"  ✗ Cannot open user database {user_db_path}: {e}")
@@ -143,84 +363,53 @@ def merge_session_into_user_history(session_db_path, user_db_path):
                 # print(f"  → Skipping internal table: {table}")
                 continue
                 
-            # Get all data from session table
             session_cursor = session_conn.cursor()
             try:
-                # print(f"  → Reading data from table {table}...")
-                session_cursor.execute(f"SELECT * FROM {table}")
-                rows = session_cursor.fetchall()
-                # print(f"  → Found {len(rows)} rows in {table}")
+                # print(f"  → Checking table {table} for data...")
+                session_cursor.execute(f"SELECT 1 FROM {table} LIMIT 1")
+                has_rows = session_cursor.fetchone() is not None
             except sqlite3.Error as e:
                 print(f"  ✗ Error reading table {table}: {e}")
                 continue
             
-            if not rows:
+            if not has_rows:
                 # print(f"  → No data in table {table}, skipping")
                 continue
             
-            # Get column information including whether it's a primary key with autoincrement
-            # print(f"  → Getting column info for {table}...")
-            session_cursor.execute(f"PRAGMA table_info({table})")
-            col_info = session_cursor.fetchall()
-            columns = [col[1] for col in col_info]
-            # print(f"  → Columns: {columns[:5]}... (showing first 5)")
-            
-            # Check if first column is an AUTOINCREMENT primary key
-            # print(f"  → Getting CREATE statement for {table}...")
-            session_cursor.execute(f"SELECT sql FROM sqlite_master WHERE type='table' AND name='{table}'")
+            session_cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,))
             create_sql = session_cursor.fetchone()[0]
-            has_autoincrement = 'AUTOINCREMENT' in create_sql.upper()
-            # print(f"  → Has AUTOINCREMENT: {has_autoincrement}")
             
             # Insert into user history database
             user_cursor = user_conn.cursor()
             
-            # Check if table exists in user database
-            # print(f"  → Checking if table {table} exists in user DB...")
-            user_cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table}'")
-            if not user_cursor.fetchone():
-                # Create table if it doesn't exist
-                # print(f"  → Creating table {table} in user DB...")
+            # Check if table exists in user database; create it if it doesn't
+            user_cursor.execute("SELECT sql FROM sqlite_master WHERE type IN ('table', 'view') AND name=?", (table,))
+            target = user_cursor.fetchone()
+            if target is None:
                 user_cursor.execute(create_sql)
-                # print(f"  → Table {table} created successfully")
+                target_sql = create_sql
             else:
-                pass  # print(f"  → Table {table} already exists in user DB")
+                target_sql = target[0]
             
-            # If there's an AUTOINCREMENT column, exclude it from INSERT
-            if has_autoincrement and col_info[0][5] == 1:  # col_info[0][5] is the pk flag
-                # print(f"  → Inserting without AUTOINCREMENT id column...")
-                # Skip the first column (id) and insert the rest
-                insert_columns = columns[1:]
-                insert_column_names = ', '.join(insert_columns)
-                placeholders = ','.join(['?' for _ in insert_columns])
-                # Remove first value from each row (the id)
-                rows_without_id = [row[1:] for row in rows]
-                
-                try:
-                    user_cursor.executemany(
-                        f"INSERT OR IGNORE INTO {table} ({insert_column_names}) VALUES ({placeholders})", 
-                        rows_without_id
-                    )
-                    merged_count += user_cursor.rowcount
-                    # print(f"  → Inserted {user_cursor.rowcount} rows into {table}")
-                except sqlite3.Error as e:
-                    print(f"  ✗ Error inserting into table {table}: {e}")
-                    # print(f"  → Error type: {type(e).__name__}")
-                    # print(f"  → Error args: {e.args}")
-                    continue
-            else:
-                # print(f"  → Inserting all columns...")
-                # No AUTOINCREMENT, insert all columns normally
-                placeholders = ','.join(['?' for _ in columns])
-                try:
-                    user_cursor.executemany(f"INSERT OR IGNORE INTO {table} VALUES ({placeholders})", rows)
-                    merged_count += user_cursor.rowcount
-                    # print(f"  → Inserted {user_cursor.rowcount} rows into {table}")
-                except sqlite3.Error as e:
-                    print(f"  ✗ Error inserting into table {table}: {e}")
-                    # print(f"  → Error type: {type(e).__name__}")
-                    # print(f"  → Error args: {e.args}")
-                    continue
+            # Copy by column name (the AUTOINCREMENT id is left to the user DB)
+            columns = column_mapping(
+                table, create_sql, target_sql,
+                lambda: session_conn.execute(f"PRAGMA table_info({table})").fetchall(),
+                lambda: user_conn.execute(f"PRAGMA table_info({table})").fetchall(),
+            )
+            column_names = ', '.join(columns)
+            placeholders = ','.join(['?' for _ in columns])
+            try:
+                session_cursor.execute(f"SELECT {column_names} FROM {table}")
+                user_cursor.executemany(
+                    f"INSERT OR IGNORE INTO {table} ({column_names}) VALUES ({placeholders})",
+                    session_cursor.fetchall()
+                )
+                merged_count += user_cursor.rowcount
+                # print(f"  → Inserted {user_cursor.rowcount} rows into {table}")
+            except sqlite3.Error as e:
+                print(f"  ✗ Error inserting into table {table}: {e}")
+                continue
             
         # print(f"  → Committing changes...")
         user_conn.commit()
@@ -237,38 +426,46 @@ def merge_session_into_user_history(session_db_path, user_db_path):
 
 def remove_duplicates(user_db_path):
     """
-    Remove duplicate rows in the user session history DB.
+    Make the user session history DB duplicate-free and keep it that way.
     Duplicates are rows with the same (student_id, log_date, log_time, subject, sessionId).
-    Keeps one row per group (smallest id). If sessionId column is missing, dedup by
-    (student_id, log_date, log_time, subject) only.
+    Keeps one row per group (smallest id), then creates a UNIQUE index on that key so
+    later merges (INSERT OR IGNORE) never add duplicates again. Once the index exists this
+    is a no-op, so the full-table pass only runs once per DB (migration of older files).
+    If sessionId column is missing, dedup by (student_id, log_date, log_time, subject) only.
+    In the compact layout the rows table is deduplicated and indexed (its value ids
+    stand for exactly one text each, so equal ids mean equal values).
     """
     if not os.path.exists(user_db_path) or not has_sqlite_header(user_db_path):
         return 0
-    conn = sqlite3.connect(user_db_path)
+    conn = connect_db(user_db_path)
     cursor = conn.cursor()
     try:
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='attendance'")
+        table = ROWS_TABLE if is_compact(conn) else 'attendance'
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table,))
         if not cursor.fetchone():
             return 0
-        cursor.execute("PRAGMA table_info(attendance)")
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name=?", (USER_DEDUP_INDEX,))
+        if cursor.fetchone():
+            return 0
+        cursor.execute(f"PRAGMA table_info({table})")
         columns = [row[1] for row in cursor.fetchall()]
-        cursor.execute("SELECT COUNT(*) FROM attendance")
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
         count_before = cursor.fetchone()[0]
         # Use sessionId in dedup key if the column exists
-        required = ["student_id", "log_date", "log_time", "subject"]
         if "sessionId" in columns:
             group_cols = "student_id, log_date, log_time, subject, sessionId"
         else:
             group_cols = "student_id, log_date, log_time, subject"
         cursor.execute(f"""
-            DELETE FROM attendance
+            DELETE FROM {table}
             WHERE id NOT IN (
-                SELECT MIN(id) FROM attendance
+                SELECT MIN(id) FROM {table}
                 GROUP BY {group_cols}
             )
         """)
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {USER_DEDUP_INDEX} ON {table}({group_cols})")
         conn.commit()
-        cursor.execute("SELECT COUNT(*) FROM attendance")
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
         count_after = cursor.fetchone()[0]
         removed = count_before - count_after
         if removed > 0:
@@ -281,20 +478,273 @@ def remove_duplicates(user_db_path):
         conn.close()
 
 
-def merge_all_sessions():
+def create_user_db(user_db_path):
+    """
+    Make sure user_db_path is a SQLite database we can merge into.
+    Only creates or replaces the file when it does not exist or is clearly NOT SQLite
+    (e.g. a Git LFS pointer); a file with the SQLite header is a real DB and is kept.
+    Returns False if an invalid file could not be replaced.
+    """
+    if os.path.exists(user_db_path):
+        if has_sqlite_header(user_db_path):
+            return True
+        # print(f"  → Replacing non-SQLite file (e.g. LFS pointer) with fresh database: {user_db_path}")
+        try:
+            os.remove(user_db_path)
+        except OSError as e:
+            print(f"  ✗ Could not remove invalid file: {e}")
+            return False
+    # print(f"  → Creating new user history database: {user_db_path}")
+    conn = connect_db(user_db_path)
+    cursor = conn.cursor()
+    cursor.execute("CREATE TABLE IF NOT EXISTS _init (id INTEGER PRIMARY KEY)")
+    cursor.execute("DROP TABLE IF EXISTS _init")
+    conn.commit()
+    conn.close()
+    return True
+
+
+def merge_user(user_id, user_db_path, session_files, skipped, compact=False):
     """
-    Main function to merge all session databases into user history databases
+    Merge one user's session files into their user history DB and dedup it.
+    Users are independent (each only writes its own DB), so this can run in a worker
+    process; its output is captured and returned instead of printed, so the caller
+    can print every user's block in order.
+    With compact, a user DB that received sessions is packed into the compact layout.
+    Returns a dict with the merged session files (and their row counts) and the output.
+    """
+    result = {'user_id': user_id, 'merged': [], 'failed': 0, 'skipped': skipped, 'output': ''}
+    output = io.StringIO()
+    with redirect_stdout(output):
+        print(f"\nProcessing user {user_id} ({len(session_files) + skipped} sessions)...")
+        if skipped:
+            print(f"  → {skipped} session file(s) unchanged since they were merged")
+
+        if session_files and create_user_db(user_db_path):
+            # Dedup key index first (one-time migration of older DBs), so the merge
+            # below ignores rows already present instead of deduplicating afterwards
+            remove_duplicates(user_db_path)
+
+            # Merge the sessions into user history (always append; never replace existing data)
+            merged_files = merge_sessions_into_user_history(session_files, user_db_path)
+            result['merged'] = [(f, count_attendance_rows(f)) for f in merged_files]
+            result['failed'] = len(session_files) - len(merged_files)
+
+            # The attendance table may only have been created by this merge
+            if result['merged']:
+                remove_duplicates(user_db_path)
+
+            # Written with the bulk (WAL) profile; leave the DB self-contained for git
+            restore_durable([user_db_path])
+            if compact and result['merged'] and pack_user_db(user_db_path):
+                print("  → Packed into the compact layout")
+        elif session_files:
+            result['failed'] = len(session_files)
+    result['output'] = output.getvalue()
+    return result
+
+
+def merge_shard_batch(shard_conn, user_id, session_files):
+    """
+    ATTACH a batch of one user's session files to an open shard and append their
+    attendance rows in one transaction (a savepoint per session, as in merge_session_batch).
+    Returns the session files that were merged.
+    """
+    target_sql = shard_conn.execute(
+        "SELECT sql FROM main.sqlite_master WHERE type='table' AND name=?", (SHARD_TABLE,)
+    ).fetchone()[0]
+    schemas = []
+    merged = []
+    try:
+        for session_db_path in session_files:
+            schema = f"session{len(schemas)}"
+            shard_conn.execute(f"ATTACH DATABASE ? AS {schema}", (session_db_path,))
+            schemas.append(schema)
+
+        shard_conn.execute("BEGIN")
+        for schema, session_db_path in zip(schemas, session_files):
+            shard_conn.execute("SAVEPOINT session")
+            try:
+                row = shard_conn.execute(
+                    f"SELECT sql FROM {schema}.sqlite_master WHERE type='table' AND name='attendance'"
+                ).fetchone()
+                merged_count = 0
+                if row is not None:
+                    # A user new to the shard gets the session's attendance table as their schema
+                    add_user(shard_conn, user_id, [row[0]])
+                    columns = column_mapping(
+                        'attendance', row[0], target_sql,
+                        lambda: shard_conn.execute(f"PRAGMA {schema}.table_info(attendance)").fetchall(),
+                        lambda: shard_conn.execute(f"PRAGMA main.table_info({SHARD_TABLE})").fetchall(),
+                        filled=APPENDED_COLUMNS,
+                    )
+                    merged_count = append_rows(shard_conn, user_id, columns, f"{schema}.attendance")
+            except sqlite3.Error as e:
+                shard_conn.execute("ROLLBACK TO session")
+                shard_conn.execute("RELEASE session")
+                print(f"  ✗ Error merging {session_db_path}: {e}")
+                continue
+            shard_conn.execute("RELEASE session")
+            print(f"  ✓ Merged {os.path.basename(session_db_path)} - {merged_count} records")
+            merged.append(session_db_path)
+        shard_conn.execute("COMMIT")
+        return merged
+    finally:
+        if shard_conn.in_transaction:
+            shard_conn.execute("ROLLBACK")
+        for schema in schemas:
+            shard_conn.execute(f"DETACH DATABASE {schema}")
+
+
+def merge_shard(shard_db_path, users):
+    """
+    Merge the session files of every user of one shard of the consolidated store
+    (see sharded_history.py), opening the shard once.
+    users is [(user_id, session_files, unchanged_files)]; unchanged files are only
+    skipped for users the shard already holds.
+    Returns a result dict per user, as merge_user does.
+    """
+    results = []
+    shard_conn = open_shard(shard_db_path)
+    try:
+        known_users = shard_users(shard_conn)
+        for user_id, session_files, unchanged_files in users:
+            to_merge = [f for f in session_files if user_id not in known_users or f not in unchanged_files]
+            skipped = len(session_files) - len(to_merge)
+            result = {'user_id': user_id, 'merged': [], 'failed': 0, 'skipped': skipped, 'output': ''}
+            output = io.StringIO()
+            with redirect_stdout(output):
+                print(f"\nProcessing user {user_id} ({len(session_files)} sessions)...")
+                if skipped:
+                    print(f"  → {skipped} session file(s) unchanged since they were merged")
+                mergeable = [f for f in to_merge if check_session_file(f)]
+                merged_files = []
+                for start in range(0, len(mergeable), ATTACH_BATCH_SIZE):
+                    batch = mergeable[start:start + ATTACH_BATCH_SIZE]
+                    try:
+                        merged_files.extend(merge_shard_batch(shard_conn, user_id, batch))
+                    except sqlite3.Error as e:
+                        print(f"  ✗ Batched merge failed: {e}")
+                result['merged'] = [(f, count_attendance_rows(f)) for f in merged_files]
+                result['failed'] = len(to_merge) - len(merged_files)
+            result['output'] = output.getvalue()
+            results.append(result)
+    finally:
+        shard_conn.close()
+    # Written with the bulk (WAL) profile; leave the shard self-contained for git
+    restore_durable([shard_db_path])
+    return results
+
+
+def _merge_shard_job(job):
+    """ProcessPoolExecutor entry point for merge_shard"""
+    return merge_shard(*job)
+
+
+def migrate_dedup_indexes(user_session_dir='user_session_history'):
+    """
+    Backfill the dedup key index on every user DB at once (instead of lazily on
+    each user's next merge). Returns the total number of duplicates removed.
+    """
+    if not os.path.exists(user_session_dir):
+        return 0
+    removed = 0
+    for filename in sorted(os.listdir(user_session_dir)):
+        if filename.endswith('.db'):
+            removed += remove_duplicates(os.path.join(user_session_dir, filename))
+    restore_durable()
+    print(f"✓ Dedup index present on all user DBs ({removed} duplicate(s) removed)")
+    return removed
+
+
+def _merge_user_job(job):
+    """ProcessPoolExecutor entry point for merge_user"""
+    return merge_user(*job)
+
+
+def merge_all_sessions(workers=1, quick_check=False, compact=False, shard_dir=None, json_exports=False):
+    """
+    Main function to merge all session databases into user history databases.
+    With workers > 1, users are merged in parallel worker processes.
+    With quick_check, new or changed session files also get PRAGMA quick_check.
+    With compact, user DBs that receive sessions are packed (see compact_history.py).
+    With shard_dir, sessions are merged into the sharded store there instead
+    (see sharded_history.py), one worker job per shard.
+    With json_exports, the JSON session exports in user_session_history are ingested
+    first (see json_session_ingest.py) and their session DBs merged along with log_history.
     """
     print("Starting session merge process...")
     
+    extra_dirs = ()
+    if json_exports:
+        # Imported here: json_session_ingest pulls in pandas, numpy and openpyxl
+        from json_session_ingest import INGEST_DIR, ingest_exports
+        ingest_exports(workers=workers)
+        extra_dirs = (INGEST_DIR,)
+    
+    manifest_path = SHARD_SESSION_MANIFEST_PATH if shard_dir else SESSION_MANIFEST_PATH
+    manifest = load_manifest(manifest_path)
+    validation_cache = load_validation_cache()
+
     # Get all session files grouped by user_id
-    user_sessions = get_session_files()
+    user_sessions = get_session_files(validation_cache, quick_check, extra_dirs)
+    save_validation_cache(validation_cache)
+    print(f"→ Validated {validation_cache['probed']} new or changed session file(s)")
     
     if not user_sessions:
         print("No valid session database files found to merge.")
         print("Note: Files with prefixes like 'excuses', 'scanner', 'checklist', 'edited' may not be valid SQLite databases.")
         return
     
+    total_sessions = sum(len(sessions) for sessions in user_sessions.values())
+    print(f"Found {total_sessions} session files for {len(user_sessions)} users")
+    
+    if shard_dir:
+        results = merge_all_into_shards(user_sessions, manifest, shard_dir, workers)
+    else:
+        results = merge_all_into_user_dbs(user_sessions, manifest, workers, compact)
+
+    merged_sessions = 0
+    failed_sessions = 0
+    skipped_unchanged = 0
+    for result in results:
+        print(result['output'], end='')
+        for session_file, row_count in result['merged']:
+            record_file(manifest, session_file, row_count)
+        merged_sessions += len(result['merged'])
+        failed_sessions += result['failed']
+        skipped_unchanged += result['skipped']
+    
+    prune_manifest(manifest)
+    save_manifest(manifest_path, manifest)
+    
+    print(f"\n→ Merged {merged_sessions} session file(s), {failed_sessions} failed")
+    if skipped_unchanged:
+        print(f"→ Skipped {skipped_unchanged} unchanged session file(s) already merged")
+    print(f"\n✓ Merge completed! Processed {len(user_sessions)} users.")
+
+
+def merge_all_into_shards(user_sessions, manifest, shard_dir, workers=1):
+    """Merge every user's sessions into their shard; returns the per-user results in user order"""
+    jobs = {}
+    for user_id, session_files in user_sessions.items():
+        unchanged_files = {f for f in session_files if unchanged_entry(manifest, f) is not None}
+        index = shard_for(user_id)
+        jobs.setdefault(index, (shard_path(index, shard_dir), []))[1].append((user_id, session_files, unchanged_files))
+    jobs = [jobs[index] for index in sorted(jobs)]
+
+    if workers > 1:
+        print(f"Merging shards on {workers} worker processes...")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            shard_results = list(pool.map(_merge_shard_job, jobs))
+    else:
+        shard_results = [merge_shard(*job) for job in jobs]
+    by_user = {result['user_id']: result for results in shard_results for result in results}
+    return [by_user[user_id] for user_id in user_sessions]
+
+
+def merge_all_into_user_dbs(user_sessions, manifest, workers=1, compact=False):
+    """Merge every user's sessions into user_session_history/<user_id>.db; returns the per-user results"""
     user_session_dir = 'user_session_history'
     
     # Create user_session_history directory if it doesn't exist
@@ -302,47 +752,229 @@ def merge_all_sessions():
         os.makedirs(user_session_dir)
         print(f"Created directory: {user_session_dir}")
     
-    total_sessions = sum(len(sessions) for sessions in user_sessions.values())
-    print(f"Found {total_sessions} session files for {len(user_sessions)} users")
-    
-    # Process each user
+    # Decide per user which session files still need merging (the manifest lives in this process)
+    jobs = []
     for user_id, session_files in user_sessions.items():
         user_db_path = os.path.join(user_session_dir, f"{user_id}.db")
-        
-        print(f"\nProcessing user {user_id} ({len(session_files)} sessions)...")
-        
-        # Only create or replace user DB when it does not exist or is clearly NOT SQLite (e.g. Git LFS pointer).
-        # Never delete a file that has the SQLite header - that is a real DB and we merge into it.
-        if not os.path.exists(user_db_path):
-            # print(f"  → Creating new user history database: {user_db_path}")
-            conn = sqlite3.connect(user_db_path)
-            cursor = conn.cursor()
-            cursor.execute("CREATE TABLE IF NOT EXISTS _init (id INTEGER PRIMARY KEY)")
-            cursor.execute("DROP TABLE IF EXISTS _init")
-            conn.commit()
-            conn.close()
-        elif not has_sqlite_header(user_db_path):
-            # print(f"  → Replacing non-SQLite file (e.g. LFS pointer) with fresh database: {user_db_path}")
+        # A fresh user DB holds none of the earlier merges, so nothing may be skipped for it
+        user_db_created = not os.path.exists(user_db_path) or not has_sqlite_header(user_db_path)
+        to_merge = [
+            f for f in session_files
+            if user_db_created or unchanged_entry(manifest, f) is None
+        ]
+        jobs.append((user_id, user_db_path, to_merge, len(session_files) - len(to_merge), compact))
+
+    if workers > 1:
+        print(f"Merging users on {workers} worker processes...")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_merge_user_job, jobs))
+    else:
+        results = [merge_user(*job) for job in jobs]
+    return results
+
+def dedup_key_columns(user_conn):
+    """Columns of the user DB's dedup key (those of its index, or the ones remove_duplicates would use)"""
+    columns = [row[2] for row in user_conn.execute(f"PRAGMA main.index_info({USER_DEDUP_INDEX})")]
+    if columns:
+        return columns
+    table = ROWS_TABLE if is_compact(user_conn) else 'attendance'
+    table_columns = [row[1] for row in user_conn.execute(f"PRAGMA main.table_info({table})")]
+    if not table_columns:
+        return []
+    return ['student_id', 'log_date', 'log_time', 'subject'] + (['sessionId'] if 'sessionId' in table_columns else [])
+
+def count_new_rows(user_conn, session_db_path, key_columns):
+    """
+    Number of a session's attendance rows whose dedup key is not in the user DB yet
+    (what INSERT OR IGNORE would add). Uses the dedup key index when the DB has one
+    (SQLite builds a temporary index otherwise).
+    user_conn is a read-only connection; returns None if the estimate can't be made.
+    """
+    user_conn.execute("ATTACH DATABASE ? AS session", (read_only_uri(session_db_path),))
+    try:
+        session_columns = {row[1] for row in user_conn.execute("PRAGMA session.table_info(attendance)")}
+        if not session_columns:
+            return 0
+        # A key column the session lacks is inserted as NULL, which never matches
+        if not key_columns or not set(key_columns) <= session_columns:
+            return user_conn.execute("SELECT COUNT(*) FROM session.attendance").fetchone()[0]
+        # A LEFT JOIN (unlike NOT EXISTS) lets SQLite build that temporary index once
+        match = ' AND '.join(f"u.{col} = s.{col}" for col in key_columns)
+        return user_conn.execute(
+            f"SELECT COUNT(*) FROM session.attendance s "
+            f"LEFT JOIN main.attendance u ON {match} WHERE u.rowid IS NULL"
+        ).fetchone()[0]
+    except sqlite3.Error:
+        return None
+    finally:
+        user_conn.execute("DETACH DATABASE session")
+
+def count_duplicate_rows(user_conn):
+    """Duplicates the one-time dedup migration (remove_duplicates) would delete; 0 once it ran"""
+    if user_conn.execute(
+        "SELECT 1 FROM main.sqlite_master WHERE type='index' AND name=?", (USER_DEDUP_INDEX,)
+    ).fetchone() is not None:
+        return 0
+    table = ROWS_TABLE if is_compact(user_conn) else 'attendance'
+    columns = [row[1] for row in user_conn.execute(f"PRAGMA main.table_info({table})")]
+    if not columns:
+        return 0
+    group_cols = "student_id, log_date, log_time, subject" + (", sessionId" if "sessionId" in columns else "")
+    return user_conn.execute(
+        f"SELECT COUNT(*) - (SELECT COUNT(*) FROM (SELECT 1 FROM {table} GROUP BY {group_cols})) FROM {table}"
+    ).fetchone()[0]
+
+def plan_user(user_id, user_db_path, session_files):
+    """
+    --plan for one user: rows the session files hold, how many of them the merge
+    would add (estimated from the user DB's dedup index when it has one, else all of
+    them), duplicates a one-time dedup would delete, and the user DB's size before
+    and (estimated) after. Only reads: file sizes and aggregate queries.
+    """
+    rows = sum(count_attendance_rows(f) or 0 for f in session_files)
+    plan = {'user_id': user_id, 'files': len(session_files), 'rows': rows, 'new_rows': rows,
+            'duplicates': 0, 'size': 0, 'size_after': 0, 'new_db': True}
+    session_bytes = sum(os.path.getsize(f) for f in session_files)
+    bytes_per_row = session_bytes / rows if rows else 0
+
+    if user_db_path is not None and os.path.exists(user_db_path) and has_sqlite_header(user_db_path):
+        plan['new_db'] = False
+        plan['size'] = os.path.getsize(user_db_path)
+        try:
+            user_conn = connect_read_only(user_db_path)
             try:
-                os.remove(user_db_path)
-            except OSError as e:
-                print(f"  ✗ Could not remove invalid file: {e}")
-                continue
-            conn = sqlite3.connect(user_db_path)
-            cursor = conn.cursor()
-            cursor.execute("CREATE TABLE IF NOT EXISTS _init (id INTEGER PRIMARY KEY)")
-            cursor.execute("DROP TABLE IF EXISTS _init")
-            conn.commit()
-            conn.close()
+                user_rows = user_conn.execute("SELECT COUNT(*) FROM attendance").fetchone()[0]
+                if user_rows:
+                    bytes_per_row = plan['size'] / user_rows
+                plan['duplicates'] = count_duplicate_rows(user_conn)
+                if not is_compact(user_conn):
+                    key_columns = dedup_key_columns(user_conn)
+                    new_rows = [count_new_rows(user_conn, f, key_columns) for f in session_files]
+                    if None not in new_rows:
+                        plan['new_rows'] = sum(new_rows)
+            finally:
+                user_conn.close()
+        except sqlite3.Error:
+            pass
+    plan['size_after'] = plan['size'] + round(plan['new_rows'] * bytes_per_row)
+    return plan
+
+def plan_all_sessions(quick_check=False, shard_dir=None, json_exports=False):
+    """
+    --plan: report the work merge_all_sessions would do (files to merge, rows to insert
+    and dedup, size of the user DBs) without writing anything. Reads only file metadata,
+    the manifests and cheap aggregate queries. Returns the number of session files that
+    would be merged (0 means the run would be a no-op).
+    """
+    print("Planning session merge (nothing is written)...")
 
-        # Merge each session into user history (always append; never replace existing data)
-        for session_file in session_files:
-            merge_session_into_user_history(session_file, user_db_path)
+    extra_dirs = ()
+    if json_exports:
+        from json_session_ingest import INGEST_DIR, INGEST_MANIFEST_PATH, list_exports
+        ingest_manifest = load_manifest(INGEST_MANIFEST_PATH)
+        pending = [p for p in list_exports() if unchanged_entry(ingest_manifest, p) is None]
+        print(f"→ {len(pending)} new or changed JSON export(s) would be ingested first (not counted below)")
+        extra_dirs = (INGEST_DIR,)
 
-        # Remove duplicates: same (student_id, log_date, log_time, subject, sessionId) -> keep one
-        remove_duplicates(user_db_path)
-    
-    print(f"\n✓ Merge completed! Processed {len(user_sessions)} users.")
+    manifest = load_manifest(SHARD_SESSION_MANIFEST_PATH if shard_dir else SESSION_MANIFEST_PATH)
+    # Probed files are not written back to the cache
+    user_sessions = get_session_files(load_validation_cache(), quick_check, extra_dirs)
+
+    plans = []
+    unchanged = 0
+    for user_id, session_files in user_sessions.items():
+        if shard_dir:
+            # Sessions of a user the shard doesn't hold yet are always merged
+            shard_db_path = shard_path(shard_for(user_id), shard_dir)
+            known_users = set()
+            if os.path.exists(shard_db_path):
+                conn = connect_read_only(shard_db_path)
+                try:
+                    known_users = shard_users(conn)
+                finally:
+                    conn.close()
+            user_db_path = None
+            fresh = user_id not in known_users
+        else:
+            user_db_path = os.path.join('user_session_history', f"{user_id}.db")
+            fresh = not os.path.exists(user_db_path) or not has_sqlite_header(user_db_path)
+        to_merge = [f for f in session_files if fresh or unchanged_entry(manifest, f) is None]
+        unchanged += len(session_files) - len(to_merge)
+        if to_merge:
+            plans.append(plan_user(user_id, user_db_path, to_merge))
+
+    for plan in plans:
+        note = " (new user DB)" if plan['new_db'] and not shard_dir else ""
+        if plan['duplicates']:
+            note += f", {plan['duplicates']} duplicate(s) to remove first"
+        print(f"  {plan['user_id']}: {plan['files']} session file(s), {plan['rows']} row(s), "
+              f"~{plan['new_rows']} new{note}")
+
+    files = sum(plan['files'] for plan in plans)
+    rows = sum(plan['rows'] for plan in plans)
+    new_rows = sum(plan['new_rows'] for plan in plans)
+    size = sum(plan['size'] for plan in plans)
+    size_after = sum(plan['size_after'] for plan in plans)
+    print(f"\n→ Would merge {files} session file(s) for {len(plans)} user(s); {unchanged} unchanged file(s) skipped")
+    print(f"→ Rows: {rows} to read, ~{new_rows} to insert, ~{rows - new_rows} ignored as duplicates")
+    duplicates = sum(plan['duplicates'] for plan in plans)
+    if duplicates:
+        print(f"→ One-time dedup would delete {duplicates} duplicate row(s)")
+    if shard_dir:
+        print(f"→ Sharded store grows by ~{(size_after - size) / 1024:.0f} KB")
+    else:
+        created = sum(1 for plan in plans if plan['new_db'])
+        print(f"→ User DBs: {len(plans) - created} to update, {created} to create; "
+              f"{size / 1024:.0f} KB → ~{size_after / 1024:.0f} KB")
+    if not files:
+        print("→ Nothing to merge: the run would be a no-op")
+    return files
 
 if __name__ == '__main__':
-    merge_all_sessions()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Merge session DBs from log_history into per-user history DBs.")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes; users are merged in parallel (default: 1).",
+    )
+    parser.add_argument(
+        "--migrate-index",
+        action="store_true",
+        help="Deduplicate every user DB and create its dedup key index, then exit.",
+    )
+    parser.add_argument(
+        "--quick-check",
+        action="store_true",
+        help="Also run PRAGMA quick_check on new or changed session files.",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Pack user DBs that receive sessions into the compact layout (see compact_history.py).",
+    )
+    parser.add_argument(
+        "--shards",
+        metavar="DIR",
+        default=None,
+        help="Merge into the sharded user history store in DIR instead of per-user DBs (see sharded_history.py).",
+    )
+    parser.add_argument(
+        "--json-exports",
+        action="store_true",
+        help="Ingest the JSON session exports in user_session_history first and merge them too (see json_session_ingest.py).",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Only report the work a merge would do (files, rows to insert and dedup, DB sizes); write nothing.",
+    )
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.plan:
+        plan_all_sessions(args.quick_check, args.shards, args.json_exports)
+    elif args.migrate_index:
+        migrate_dedup_indexes()
+    else:
+        merge_all_sessions(args.workers, args.quick_check, args.compact, args.shards, args.json_exports)
@@ -0,0 +1,359 @@
+"""
+Sharded User History Store
+
+Optional consolidated form of user_session_history/: instead of one SQLite file
+per user, every user's attendance rows live in one of SHARD_COUNT shard files
+(user_history_shards/shard_NN.db), chosen by a stable hash of the user id.
+
+Each shard holds:
+- users            one row per user: the CREATE statements of their per-user DB
+                   and the AUTOINCREMENT sequence of its attendance table
+- user_attendance  the rows of all its users (owner_id, user_row_id = the row's
+                   id in the per-user DB, and the attendance columns)
+- attendance       a view with the attendance columns, so the shards can be read
+                   like user DBs (manage_logs.py --user-shards)
+
+merge_user_sessions.py --shards and cleanup_user_session_history.py --shards work
+on the shards directly; the per-user files the app downloads are regenerated on
+demand with the export command.
+
+Usage:
+    python sharded_history.py import              # user_session_history/*.db -> shards
+    python sharded_history.py export              # shards -> user_session_history/*.db
+    python sharded_history.py export 123 456 --out exported/
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+
+from compact_history import is_compact
+from source_manifest import MANIFEST_DIR, load_manifest, save_manifest, unchanged_entry, record_file, prune_manifest
+from sqlite_profiles import connect as connect_db, restore_durable
+
+SHARD_DIR = 'user_history_shards'
+SHARD_COUNT = 16
+
+USERS_TABLE = 'users'
+SHARD_TABLE = 'user_attendance'
+
+# Shard table columns that append_rows() fills itself (not copied from the source)
+APPENDED_COLUMNS = ('owner_id', 'user_row_id')
+
+# Per-user DBs already imported (size, mtime, SHA-256); unchanged ones are skipped
+IMPORT_MANIFEST_PATH = os.path.join(MANIFEST_DIR, 'sharded_history_import_manifest.json')
+
+# Attendance columns kept in the shards (the columns of the user DBs' attendance table).
+# They are declared without a type, so values are stored exactly as the user DB holds
+# them (its schema varies by app version, e.g. student_id is TEXT in some).
+ATTENDANCE_COLUMNS = (
+    'sessionId', 'subject', 'dateTime', 'inProgress', 'year', 'batch', 'isChecklist',
+    'isScanner', 'isExcused', 'isEdited', 'backedUp', 'personalBackedUp', 'synced',
+    'syncedAt', 'student_id', 'scanTime', 'log_date', 'log_time', 'isManual',
+    'created_at', 'notes', 'updated_at', 'user_name', 'user_id', 'division', 'department',
+)
+
+SHARD_SCHEMA = [
+    f'''CREATE TABLE IF NOT EXISTS {USERS_TABLE} (
+        user_id TEXT PRIMARY KEY,
+        schema_json TEXT NOT NULL,
+        seq INTEGER NOT NULL DEFAULT 0
+    )''',
+    f'''CREATE TABLE IF NOT EXISTS {SHARD_TABLE} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner_id TEXT NOT NULL,
+        user_row_id INTEGER NOT NULL,
+        {', '.join(ATTENDANCE_COLUMNS)}
+    )''',
+    f'CREATE UNIQUE INDEX IF NOT EXISTS idx_shard_user_row ON {SHARD_TABLE}(owner_id, user_row_id)',
+    # Same dedup key as the per-user DBs (merge_user_sessions.USER_DEDUP_INDEX), per owner
+    f'''CREATE UNIQUE INDEX IF NOT EXISTS idx_shard_dedup_key
+        ON {SHARD_TABLE}(owner_id, student_id, log_date, log_time, subject, sessionId)''',
+    f"CREATE VIEW IF NOT EXISTS attendance AS SELECT id, {', '.join(ATTENDANCE_COLUMNS)} FROM {SHARD_TABLE}",
+]
+
+
+def shard_for(user_id, shard_count=SHARD_COUNT):
+    """Shard number of a user (stable across runs and machines, unlike hash())"""
+    return int(hashlib.sha1(str(user_id).encode('utf-8')).hexdigest(), 16) % shard_count
+
+
+def shard_path(index, shard_dir=SHARD_DIR):
+    return os.path.join(shard_dir, f'shard_{index:02d}.db')
+
+
+def list_shards(shard_dir=SHARD_DIR):
+    """Shard files present on disk, in shard order"""
+    if not os.path.isdir(shard_dir):
+        return []
+    return [os.path.join(shard_dir, name) for name in sorted(os.listdir(shard_dir))
+            if name.startswith('shard_') and name.endswith('.db')]
+
+
+def is_shard(conn, schema='main'):
+    """True if the DB is a shard of this store"""
+    return conn.execute(
+        f"SELECT 1 FROM {schema}.sqlite_master WHERE type='table' AND name=?", (SHARD_TABLE,)
+    ).fetchone() is not None
+
+
+def open_shard(path):
+    """Open (creating if needed) a shard with the bulk profile; restore_durable() it when done"""
+    shard_dir = os.path.dirname(path)
+    if shard_dir:
+        os.makedirs(shard_dir, exist_ok=True)
+    conn = connect_db(path, isolation_level=None)
+    for statement in SHARD_SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def shard_users(conn):
+    """{user_id: AUTOINCREMENT sequence} of the users stored in a shard"""
+    return dict(conn.execute(f'SELECT user_id, seq FROM {USERS_TABLE}').fetchall())
+
+
+def user_db_schema(conn, schema='main'):
+    """CREATE statements of a per-user DB's tables and indexes, in creation order"""
+    return [row[0] for row in conn.execute(
+        f"SELECT sql FROM {schema}.sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY rowid"
+    )]
+
+
+def add_user(conn, user_id, schema_sqls, seq=0):
+    """Register a user in the shard (no-op if already there)"""
+    conn.execute(
+        f'INSERT OR IGNORE INTO {USERS_TABLE} (user_id, schema_json, seq) VALUES (?, ?, ?)',
+        (user_id, json.dumps(schema_sqls), seq),
+    )
+
+
+def user_column_types(conn, user_id):
+    """{column: declared type} of the attendance table in a user's per-user DB schema"""
+    row = conn.execute(f'SELECT schema_json FROM {USERS_TABLE} WHERE user_id = ?', (user_id,)).fetchone()
+    if row is None:
+        return {}
+    scratch = sqlite3.connect(':memory:')
+    try:
+        for statement in json.loads(row[0]):
+            scratch.execute(statement)
+        return {col[1]: col[2] for col in scratch.execute('PRAGMA table_info(attendance)')}
+    finally:
+        scratch.close()
+
+
+def append_rows(conn, user_id, columns, source):
+    """
+    Append the rows of `source` (a table or schema.table with attendance columns) to a
+    user in the open shard and return how many were added. Rows get the next per-user
+    ids after the user's sequence (advanced past every staged row, as AUTOINCREMENT
+    does); rows whose dedup key is already present are ignored.
+    Rows pass through a staging table typed like the user's own attendance table, so
+    values get the same column affinity as in the per-user DB (a session may store
+    student_id as TEXT where the user DB declares INTEGER).
+    """
+    types = user_column_types(conn, user_id)
+    column_list = ', '.join(columns)
+    conn.execute('DROP TABLE IF EXISTS temp.staged_rows')
+    conn.execute(f"CREATE TEMP TABLE staged_rows ({', '.join(f'{c} {types.get(c, str())}'.rstrip() for c in columns)})")
+    try:
+        staged = conn.execute(
+            f'INSERT INTO temp.staged_rows ({column_list}) SELECT {column_list} FROM {source} ORDER BY rowid'
+        ).rowcount
+        added = conn.execute(
+            f"INSERT OR IGNORE INTO {SHARD_TABLE} (owner_id, user_row_id, {column_list}) "
+            f"SELECT ?, (SELECT seq FROM {USERS_TABLE} WHERE user_id = ?) + ROW_NUMBER() OVER (ORDER BY rowid), "
+            f"{column_list} FROM temp.staged_rows",
+            (user_id, user_id),
+        ).rowcount
+    finally:
+        conn.execute('DROP TABLE temp.staged_rows')
+    # Like AUTOINCREMENT, ids handed to ignored rows are not reused
+    conn.execute(f'UPDATE {USERS_TABLE} SET seq = seq + ? WHERE user_id = ?', (staged, user_id))
+    return added
+
+
+def update_sequence(conn, user_id):
+    """Advance a user's sequence past the highest per-user id in use"""
+    conn.execute(
+        f'''UPDATE {USERS_TABLE} SET seq = MAX(seq, COALESCE(
+                (SELECT MAX(user_row_id) FROM {SHARD_TABLE} WHERE owner_id = ?), 0))
+            WHERE user_id = ?''',
+        (user_id, user_id),
+    )
+
+
+def prune_users(conn):
+    """Forget users left without rows (e.g. after cleanup); returns how many"""
+    return conn.execute(
+        f'DELETE FROM {USERS_TABLE} WHERE user_id NOT IN (SELECT DISTINCT owner_id FROM {SHARD_TABLE})'
+    ).rowcount
+
+
+def import_user_db(conn, user_id, user_db_path):
+    """
+    Replace a user's rows in the open shard with the contents of their per-user DB
+    (ids and sequence kept). Returns the number of rows imported.
+    """
+    conn.execute('ATTACH DATABASE ? AS u', (user_db_path,))
+    try:
+        conn.execute('BEGIN')
+        try:
+            conn.execute(f'DELETE FROM {SHARD_TABLE} WHERE owner_id = ?', (user_id,))
+            conn.execute(f'DELETE FROM {USERS_TABLE} WHERE user_id = ?', (user_id,))
+            columns = [col[1] for col in conn.execute('PRAGMA u.table_info(attendance)')
+                       if col[1] in ATTENDANCE_COLUMNS]
+            seq = 0
+            if conn.execute("SELECT 1 FROM u.sqlite_master WHERE name='sqlite_sequence'").fetchone():
+                row = conn.execute("SELECT seq FROM u.sqlite_sequence WHERE name='attendance'").fetchone()
+                seq = row[0] if row else 0
+            add_user(conn, user_id, user_db_schema(conn, 'u'), seq)
+            imported = 0
+            if columns:
+                column_list = ', '.join(columns)
+                imported = conn.execute(
+                    f'INSERT OR IGNORE INTO {SHARD_TABLE} (owner_id, user_row_id, {column_list}) '
+                    f'SELECT ?, id, {column_list} FROM u.attendance ORDER BY id',
+                    (user_id,),
+                ).rowcount
+            update_sequence(conn, user_id)
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+    finally:
+        conn.execute('DETACH DATABASE u')
+    return imported
+
+
+def export_user_db(conn, user_id, out_path):
+    """
+    Regenerate a per-user DB from the open shard (same tables, indexes, ids and
+    sequence as the file it was imported from; attendance rows only).
+    Returns the number of rows written, or None if the user is not in the shard.
+    """
+    row = conn.execute(f'SELECT schema_json, seq FROM {USERS_TABLE} WHERE user_id = ?', (user_id,)).fetchone()
+    if row is None:
+        return None
+    schema_sqls, seq = json.loads(row[0]), row[1]
+    tmp_path = out_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    out_conn = sqlite3.connect(tmp_path, isolation_level=None)
+    try:
+        out_conn.execute('BEGIN')
+        for statement in schema_sqls:
+            out_conn.execute(statement)
+        columns = [col[1] for col in out_conn.execute('PRAGMA table_info(attendance)')
+                   if col[1] in ATTENDANCE_COLUMNS]
+        written = 0
+        if columns:
+            column_list = ', '.join(columns)
+            rows = conn.execute(
+                f'SELECT user_row_id, {column_list} FROM {SHARD_TABLE} WHERE owner_id = ? ORDER BY user_row_id',
+                (user_id,),
+            ).fetchall()
+            out_conn.executemany(
+                f"INSERT INTO attendance (id, {column_list}) VALUES ({', '.join('?' * (len(columns) + 1))})", rows
+            )
+            written = len(rows)
+        if out_conn.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_sequence'").fetchone():
+            out_conn.execute("DELETE FROM sqlite_sequence WHERE name='attendance'")
+            if seq:
+                out_conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('attendance', ?)", (seq,))
+        out_conn.execute('COMMIT')
+    finally:
+        out_conn.close()
+    os.replace(tmp_path, out_path)
+    return written
+
+
+def _user_id_from_filename(filename):
+    name = filename[:-3]
+    return name if filename.endswith('.db') and name.isdigit() else None
+
+
+def import_user_dbs(user_dir, shard_dir=SHARD_DIR):
+    """Import every changed per-user DB of user_dir into the shards"""
+    manifest = load_manifest(IMPORT_MANIFEST_PATH)
+    by_shard = {}
+    for filename in sorted(os.listdir(user_dir)):
+        user_id = _user_id_from_filename(filename)
+        if user_id:
+            by_shard.setdefault(shard_for(user_id), []).append((user_id, os.path.join(user_dir, filename)))
+
+    imported_users = 0
+    unchanged = 0
+    for index, users in sorted(by_shard.items()):
+        path = shard_path(index, shard_dir)
+        conn = open_shard(path)
+        try:
+            known = shard_users(conn)
+            for user_id, user_db_path in users:
+                if user_id in known and unchanged_entry(manifest, user_db_path) is not None:
+                    unchanged += 1
+                    continue
+                try:
+                    user_conn = sqlite3.connect(user_db_path)
+                    try:
+                        compact = is_compact(user_conn)
+                    finally:
+                        user_conn.close()
+                    if compact:
+                        print(f"  ⚠ {user_id}: compact layout, unpack it first (compact_history.py --unpack)")
+                        continue
+                    rows = import_user_db(conn, user_id, user_db_path)
+                except sqlite3.Error as e:
+                    print(f"  ✗ {user_id}: {e}")
+                    continue
+                record_file(manifest, user_db_path, rows)
+                imported_users += 1
+                print(f"  ✓ {user_id} → {os.path.basename(path)}: {rows} records")
+        finally:
+            conn.close()
+        restore_durable([path])
+
+    prune_manifest(manifest)
+    save_manifest(IMPORT_MANIFEST_PATH, manifest)
+    print(f"\n✓ Imported {imported_users} user DB(s) into {len(by_shard)} shard(s) ({unchanged} unchanged)")
+
+
+def export_user_dbs(out_dir, user_ids=None, shard_dir=SHARD_DIR):
+    """Regenerate per-user DBs (all users, or only user_ids) in out_dir"""
+    os.makedirs(out_dir, exist_ok=True)
+    wanted = None if user_ids is None else set(user_ids)
+    exported = 0
+    for path in list_shards(shard_dir):
+        conn = sqlite3.connect(path)
+        try:
+            for user_id in sorted(shard_users(conn)):
+                if wanted is not None and user_id not in wanted:
+                    continue
+                rows = export_user_db(conn, user_id, os.path.join(out_dir, f'{user_id}.db'))
+                exported += 1
+                print(f"  ✓ {user_id}.db: {rows} records")
+        finally:
+            conn.close()
+    print(f"\n✓ Exported {exported} user DB(s) to {out_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consolidate user history DBs into shards, or regenerate them.")
+    parser.add_argument("command", choices=("import", "export"))
+    parser.add_argument("user_ids", nargs="*", help="Users to export (default: all).")
+    parser.add_argument("--shards", default=SHARD_DIR, help=f"Shard directory (default: {SHARD_DIR}).")
+    parser.add_argument("--dir", default="user_session_history", help="Per-user DB directory to import (default: user_session_history).")
+    parser.add_argument("--out", default="user_session_history", help="Where to export per-user DBs (default: user_session_history).")
+    args = parser.parse_args()
+
+    if args.command == "import":
+        import_user_dbs(args.dir, args.shards)
+    else:
+        export_user_dbs(args.out, args.user_ids or None, args.shards)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Source File Manifest
+
+Persisted record of the source .db files a pipeline script has already read,
+so unchanged files can be skipped on the next run without opening them.
+
+Each manifest is a small JSON file mapping a source path to:
+- size, mtime   (cheap check: both equal -> unchanged)
+- sha256        (fallback when only mtime moved, e.g. after a fresh git checkout)
+- row_count     (rows in the source's attendance table when it was last read)
+
+Every script keeps its own manifest (merge_user_sessions.py, json_session_ingest.py
+and sharded_history.py read files at different times), stored under merge_state/.
+
+The manifest itself is committed, so it holds only the content fingerprint
+(size, sha256, row_count) and stays identical while the sources do. The mtimes
+move on every checkout and live in a local side file (<manifest>.mtimes.json,
+gitignored); without it every source is matched by its hash.
+"""
+
+import hashlib
+import json
+import os
+from typing import Optional
+
+MANIFEST_DIR = 'merge_state'
+
+
+def file_sha256(path: str) -> str:
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def mtimes_path(manifest_path: str) -> str:
+    """Return the path of the local side file holding the mtimes of a manifest."""
+    return os.path.splitext(manifest_path)[0] + '.mtimes.json'
+
+
+def _read_json(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path: str, data: dict) -> None:
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        f.write('\n')
+    os.replace(tmp_path, path)
+
+
+def load_manifest(manifest_path: str) -> dict:
+    """Return {path: entry} from a manifest file (empty if missing or unreadable)."""
+    manifest = _read_json(manifest_path).get('files', {})
+    mtimes = _read_json(mtimes_path(manifest_path)).get('files', {})
+    for path, entry in manifest.items():
+        entry['mtime'] = mtimes.get(path)
+    return manifest
+
+
+def save_manifest(manifest_path: str, manifest: dict) -> None:
+    """
+    Write the manifest (sorted, so unchanged content gives an identical file)
+    and its mtimes to the local side file.
+    """
+    manifest_dir = os.path.dirname(manifest_path)
+    if manifest_dir:
+        os.makedirs(manifest_dir, exist_ok=True)
+    files = {path: {k: v for k, v in entry.items() if k != 'mtime'} for path, entry in manifest.items()}
+    mtimes = {path: entry.get('mtime') for path, entry in manifest.items()}
+    _write_json(manifest_path, {'files': files})
+    _write_json(mtimes_path(manifest_path), {'files': mtimes})
+
+
+def unchanged_entry(manifest: dict, path: str) -> Optional[dict]:
+    """
+    Return the manifest entry for `path` if the file is unchanged since it was
+    recorded, else None. A matching hash with a different mtime refreshes the
+    stored mtime so the next check is the cheap one again.
+    """
+    entry = manifest.get(os.path.normpath(path))
+    if entry is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    if entry['size'] != stat.st_size:
+        return None
+    if entry.get('mtime') == stat.st_mtime:
+        return entry
+    if entry['sha256'] == file_sha256(path):
+        entry['mtime'] = stat.st_mtime
+        return entry
+    return None
+
+
+def record_file(manifest: dict, path: str, row_count: Optional[int], sha256: Optional[str] = None) -> dict:
+    """Store the current fingerprint of `path` in the manifest and return the entry."""
+    stat = os.stat(path)
+    entry = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': sha256 or file_sha256(path),
+        'row_count': row_count,
+    }
+    manifest[os.path.normpath(path)] = entry
+    return entry
+
+
+def prune_manifest(manifest: dict) -> int:
+    """Drop entries for files that no longer exist; return how many were dropped."""
+    missing = [p for p in manifest if not os.path.exists(p)]
+    for p in missing:
+        del manifest[p]
+    return len(missing)
@@ -0,0 +1,104 @@
+"""
+SQLite Connection Profiles
+
+Shared connection factory for the pipeline scripts that write SQLite files.
+
+- bulk     WAL journal, synchronous=NORMAL, in-memory temp store, a larger page
+           cache and memory-mapped I/O. Used while batch work is running.
+- durable  rollback journal (DELETE) and synchronous=FULL: SQLite's defaults.
+           Every file is switched back to it before it is committed to git, so
+           the repository only ever holds self-contained .db files (no -wal/-shm).
+
+connect() records which profile each file was opened with; restore_durable()
+then switches the files written with the bulk profile back to durable.
+connect_read_only() opens a file for reading only (the scripts' --plan modes).
+"""
+
+import os
+import sqlite3
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+BULK = 'bulk'
+DURABLE = 'durable'
+
+PROFILES = {
+    BULK: (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('temp_store', 'MEMORY'),
+        ('cache_size', -65536),      # KiB -> 64 MiB page cache
+        ('mmap_size', 268435456),    # 256 MiB
+    ),
+    DURABLE: (
+        ('journal_mode', 'DELETE'),
+        ('synchronous', 'FULL'),
+    ),
+}
+
+# {path: profiles used for it, in order} for every file opened through connect()
+_profiles_used: Dict[str, List[str]] = {}
+
+
+def _record(db_path, profile: str) -> None:
+    used = _profiles_used.setdefault(os.path.normpath(str(db_path)), [])
+    if not used or used[-1] != profile:
+        used.append(profile)
+
+
+def apply_profile(conn: sqlite3.Connection, profile: str) -> None:
+    """Apply a profile's PRAGMAs to an open connection (must be outside a transaction)."""
+    for name, value in PROFILES[profile]:
+        conn.execute(f'PRAGMA {name} = {value}')
+
+
+def connect(db_path, profile: str = BULK, **kwargs) -> sqlite3.Connection:
+    """Open db_path with the given profile applied and record which profile was used."""
+    conn = sqlite3.connect(db_path, **kwargs)
+    try:
+        apply_profile(conn, profile)
+    except sqlite3.Error:
+        conn.close()
+        raise
+    _record(db_path, profile)
+    return conn
+
+
+def connect_read_only(db_path) -> sqlite3.Connection:
+    """Open db_path read-only (no profile, nothing written, not recorded); ATTACH accepts URIs on it."""
+    return sqlite3.connect(read_only_uri(db_path), uri=True)
+
+
+def read_only_uri(db_path) -> str:
+    """URI opening db_path read-only, for connect_read_only() and ATTACH"""
+    return Path(db_path).resolve().as_uri() + '?mode=ro'
+
+
+def profiles_used() -> Dict[str, List[str]]:
+    """Return {path: profiles used, in order} for every file opened through connect()."""
+    return {path: list(used) for path, used in sorted(_profiles_used.items())}
+
+
+def restore_durable(paths: Optional[Iterable] = None) -> List[str]:
+    """
+    Switch files last opened with the bulk profile back to the durable profile,
+    checkpointing the WAL first so no -wal/-shm files are left next to them.
+    Only `paths` are restored if given; files that no longer exist are skipped.
+    Returns the paths restored.
+    """
+    wanted = None if paths is None else {os.path.normpath(str(p)) for p in paths}
+    restored = []
+    for path, used in sorted(_profiles_used.items()):
+        if used[-1] != BULK or (wanted is not None and path not in wanted):
+            continue
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            apply_profile(conn, DURABLE)
+        finally:
+            conn.close()
+        used.append(DURABLE)
+        restored.append(path)
+    return restored
@@ -0,0 +1,115 @@
+"""
+Checks that the vectorized *_series helpers of excel_to_db_github.py give the
+same results as applying their scalar versions cell by cell.
+
+Run with:  python -m pytest test_excel_to_db_github.py
+"""
+
+import pandas as pd
+import pytest
+
+from excel_to_db_github import (
+    format_id, format_id_series,
+    format_log_date, format_log_date_series,
+    is_valid_time, is_valid_time_series,
+    to_iso, to_iso_series,
+)
+
+NAN = float("nan")
+
+ID_COLUMNS = {
+    "object": [211559, 211559.0, 12.5, 1.05, "007", "0", "211559", "S-12",
+               " 42 ", "٣٤٥", "", NAN, None, "abc"],
+    "float": [211559.0, 12.5, 1.05, 0.0, 7.0, NAN],
+    "int": [211559, 7, 0, 42],
+    "str": ["007", "000", "211559", "٣٤٥", "x1", ""],
+}
+
+TIME_COLUMNS = {
+    "object": ["08:15:00", "8:15:00", " 08:15:00 ", "23:59:59", "24:00:00", "12:60:00",
+               "12:00:61", "12:00", "12:00:00.5", "١٢:٠٠:٠٠", "", NAN, None, 815, 8.25,
+               pd.Timestamp("2024-01-05 08:15:00")],
+    "str": ["08:15:00", "99:99:99", "", "7:05:09"],
+}
+
+DATE_COLUMNS = {
+    "object": ["05/01/2024", " 05/01/2024 ", "31/02/2024", "2024-01-05", "2024-01-05 08:15:00",
+               "5/1/2024", "not a date", "٠٥/٠١/٢٠٢٤", "", NAN, None, 20240105, 45296.0,
+               pd.Timestamp("2024-01-05")],
+    "datetime64": pd.to_datetime(["2024-01-05 00:00:00", "2023-12-31 23:59:00", None]),
+}
+
+ISO_PAIRS = [
+    ("05/01/2024", "08:15:00"),
+    ("31/01/2024", "23:59:59"),
+    ("31/02/2024", "08:15:00"),
+    ("2024-01-05", "08:15:00"),
+    ("2024-01-05 08:15:00", "08:15:00"),
+    ("05/01/2024", "8:15:00"),
+    ("05/01/2024", "24:00:00"),
+    ("05/01/2024", "08:15"),
+    (" 05/01/2024 ", " 08:15:00 "),
+    ("٠٥/٠١/٢٠٢٤", "08:15:00"),
+    ("05/01/2024", "٠٨:١٥:٠٠"),
+    ("05/01/2024", NAN),
+    (NAN, "08:15:00"),
+    (None, None),
+    ("", ""),
+    (pd.Timestamp("2024-01-05"), "08:15:00"),
+]
+
+
+def _column(values, kind):
+    if kind == "object":
+        return pd.Series(values, dtype=object)
+    if kind == "float":
+        return pd.Series(values, dtype="float64")
+    if kind == "int":
+        return pd.Series(values, dtype="int64")
+    if kind == "str":
+        return pd.Series(values).astype(str)
+    return pd.Series(values)
+
+
+def _assert_same(actual, expected):
+    assert list(actual.index) == list(expected.index)
+    assert list(actual) == list(expected)
+
+
+@pytest.mark.parametrize("kind", ID_COLUMNS)
+def test_format_id_series(kind):
+    series = _column(ID_COLUMNS[kind], kind)
+    _assert_same(format_id_series(series), series.apply(format_id))
+
+
+@pytest.mark.parametrize("kind", TIME_COLUMNS)
+def test_is_valid_time_series(kind):
+    series = _column(TIME_COLUMNS[kind], kind)
+    _assert_same(is_valid_time_series(series), series.apply(is_valid_time))
+
+
+@pytest.mark.parametrize("kind", DATE_COLUMNS)
+def test_format_log_date_series(kind):
+    series = _column(DATE_COLUMNS[kind], kind)
+    _assert_same(format_log_date_series(series), series.apply(format_log_date))
+
+
+def test_to_iso_series():
+    dates = pd.Series([d for d, _ in ISO_PAIRS], dtype=object)
+    times = pd.Series([t for _, t in ISO_PAIRS], dtype=object)
+    expected = pd.Series([to_iso(d, t) for d, t in zip(dates, times)], dtype=object)
+    _assert_same(to_iso_series(dates, times), expected)
+
+
+def test_to_iso_series_datetime64_dates():
+    dates = pd.Series(pd.to_datetime(["2024-01-05", None, "2024-02-29"]))
+    times = pd.Series(["08:15:00", "08:15:00", None], dtype=object)
+    expected = pd.Series([to_iso(d, t) for d, t in zip(dates, times)], dtype=object)
+    _assert_same(to_iso_series(dates, times), expected)
+
+
+def test_series_helpers_keep_the_index():
+    series = pd.Series(["007", NAN, "12.5"], index=[10, 3, 7], dtype=object)
+    _assert_same(format_id_series(series), series.apply(format_id))
+    times = pd.Series(["08:15:00", "25:00:00", None], index=[10, 3, 7], dtype=object)
+    _assert_same(is_valid_time_series(times), times.apply(is_valid_time))